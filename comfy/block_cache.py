@@ -0,0 +1,228 @@
+import collections
+import contextlib
+import logging
+import threading
+
+import torch
+
+import comfy.patcher_extension
+
+# Model calls (cond/uncond batches of the prompts being sampled) that keep their cached residuals.
+MAX_ENTRIES = 8
+# Weight of a new measurement in the calibration of a model.
+CALIBRATION_RATE = 0.25
+
+
+def _relative_change(new, old):
+    """Mean absolute difference relative to the mean magnitude of old, summed over lists of tensors."""
+    diff = sum((n - o).abs().float().sum() for n, o in zip(new, old))
+    norm = sum(o.abs().float().sum() for o in old)
+    return (diff / norm.clamp(min=1e-8)).item()
+
+
+class _Entry:
+    def __init__(self):
+        self.sigma = None
+        # Residual of the first block the last time all the blocks ran
+        self.probe_residual = None
+        # block kind -> {output name: output of the last block of that kind - input of its first block}
+        self.residuals = {}
+
+
+class _Call:
+    """Block cache state of one call of the diffusion model."""
+    def __init__(self, cache, entry, can_skip):
+        self.cache = cache
+        self.entry = entry
+        self.can_skip = can_skip
+        self.probe = None
+        self.skip = False
+        self.probe_residual = None
+        self.start = {}
+        self.last = {}
+        self.residuals = {}
+        self.seen = set()
+
+    def block(self, key, args, run):
+        # Blocks can update their inputs in place, everything that is kept is a copy. Some outputs can
+        # be None (the text tokens of the last joint block of sd3), they are left out.
+        kind = key[0]
+        if self.probe is None:
+            probe_input = args["img"].clone()
+            out = run()
+            self.probe = key
+            self.probe_residual = out["img"] - probe_input
+            self.skip = self.can_skip and self.cache.should_skip(self.entry, self.probe_residual)
+            if not self.skip:
+                self.start[kind] = {n: o.clone() for n, o in out.items() if o is not None}
+                self.last[kind] = out
+            return out
+
+        if self.skip:
+            residual = self.entry.residuals.get(kind, None)
+            if residual is not None:
+                names = set(residual).union(n for n in ("img", "txt") if args.get(n, None) is not None)
+                if kind in self.seen:
+                    return {n: args[n] for n in names}
+                self.seen.add(kind)
+                return {n: args[n] + residual[n] if n in residual else args[n] for n in names}
+            # Block kind that didn't run the last time: nothing cached for it
+            return run()
+
+        if kind not in self.start:
+            self.close_segments()
+            self.start[kind] = {n: args[n].clone() for n in ("img", "txt") if args.get(n, None) is not None}
+        out = run()
+        self.last[kind] = out
+        return out
+
+    def close_segments(self):
+        """Residuals of the blocks that ran, before their outputs are modified by what comes next."""
+        for kind, out in self.last.items():
+            start = self.start[kind]
+            self.residuals[kind] = {n: o - start[n] for n, o in out.items() if o is not None and n in start and start[n].shape == o.shape}
+        self.last = {}
+
+    def finish(self):
+        if self.probe is None or self.skip:
+            return
+        self.close_segments()
+        self.cache.computed(self.entry, self.probe_residual, self.residuals)
+
+
+class BlockCache:
+    """
+    Skips the transformer blocks of DiT models when their output changes little between steps
+    (first block cache).
+
+    The first block always runs. If the relative change of its residual since the last step that
+    ran every block, scaled by the calibration of the model, is under threshold, the other blocks
+    are skipped and the residual they added at that step is added instead. Each model call (cond
+    or uncond batch of a prompt) has its own cache, a model call with a different composition (a
+    different batch of conds) starts a new one.
+
+    The calibration is the ratio between the change of the residual of all the blocks and the
+    change of the residual of the first block, measured every time all the blocks run, so that the
+    threshold is roughly the relative error of the skipped blocks for every model.
+
+    The blocks are hooked in with the "dit" patches_replace of models that support them (flux,
+    chroma, wan, hunyuan video, sd3, ltxv, ...). Model calls with a controlnet aren't cached.
+    """
+    # Diffusion model class name -> calibration
+    calibration = {}
+
+    def __init__(self, threshold, sigma_start=float("inf"), sigma_end=0.0, model_name=None):
+        self.threshold = threshold
+        self.sigma_start = sigma_start
+        self.sigma_end = sigma_end
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.entries = collections.OrderedDict()
+        self.calls = 0
+        self.skipped_calls = 0
+
+    def scale(self):
+        return self.calibration.get(self.model_name, 1.0)
+
+    def should_skip(self, entry, probe_residual):
+        if entry.probe_residual is None or entry.probe_residual.shape != probe_residual.shape:
+            return False
+        if len(entry.residuals) == 0 or any(len(r) == 0 for r in entry.residuals.values()):
+            return False
+        return _relative_change([probe_residual], [entry.probe_residual]) * self.scale() < self.threshold
+
+    def computed(self, entry, probe_residual, residuals):
+        old = [(r, entry.residuals[k][n]) for k, v in residuals.items() for n, r in v.items()
+               if n in entry.residuals.get(k, {}) and entry.residuals[k][n].shape == r.shape]
+        if len(old) > 0 and entry.probe_residual is not None and entry.probe_residual.shape == probe_residual.shape:
+            probe_change = _relative_change([probe_residual], [entry.probe_residual])
+            if probe_change > 0:
+                ratio = _relative_change([n for n, _ in old], [o for _, o in old]) / probe_change
+                with self.lock:
+                    scale = self.calibration.get(self.model_name, None)
+                    self.calibration[self.model_name] = ratio if scale is None else scale + (ratio - scale) * CALIBRATION_RATE
+        entry.probe_residual = probe_residual
+        entry.residuals = residuals
+
+    def _entry(self, x, transformer_options, sigma):
+        key = (tuple(transformer_options.get("cond_or_uncond", [])), tuple(transformer_options.get("uuids", [])), tuple(x.shape), x.dtype)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry.sigma is None or sigma > entry.sigma:
+                # New sampling run
+                entry = _Entry()
+            self.entries[key] = entry
+            while len(self.entries) > MAX_ENTRIES:
+                self.entries.popitem(last=False)
+        entry.sigma = sigma
+        return entry
+
+    @contextlib.contextmanager
+    def model_call(self, x, sigma, transformer_options, control=None):
+        """Context for a call of the diffusion model, the blocks it runs go through the cache."""
+        if control is not None or getattr(self.local, "call", None) is not None:
+            yield
+            return
+        sigma = float(sigma.reshape(-1)[0])
+        entry = self._entry(x, transformer_options, sigma)
+        call = _Call(self, entry, self.sigma_end <= sigma <= self.sigma_start)
+        self.local.call = call
+        try:
+            yield
+            call.finish()
+        finally:
+            self.local.call = None
+        with self.lock:
+            self.calls += 1
+            self.skipped_calls += int(call.skip)
+        if hasattr(self.local, "run_calls"):
+            self.local.run_calls += 1
+            self.local.run_skipped += int(call.skip)
+
+    def block_patch(self, key, previous=None):
+        """A "dit" patches_replace patch for the block key, previous is the patch it replaces if any."""
+        def patch(args, extra_args):
+            def run():
+                if previous is not None:
+                    return previous(args, extra_args)
+                return extra_args["original_block"](args)
+            call = getattr(self.local, "call", None)
+            if call is None:
+                return run()
+            return call.block(key, args, run)
+        return patch
+
+    def apply_model_wrapper(self, executor, x, t, c_concat=None, c_crossattn=None, control=None, transformer_options={}, **kwargs):
+        with self.model_call(x, t, transformer_options, control=control):
+            return executor(x, t, c_concat, c_crossattn, control, transformer_options, **kwargs)
+
+    def outer_sample_wrapper(self, executor, *args, **kwargs):
+        self.local.run_calls = 0
+        self.local.run_skipped = 0
+        try:
+            return executor(*args, **kwargs)
+        finally:
+            logging.info("Block cache: skipped the blocks of {} of {} model calls ({} calibration {:.2f})".format(
+                self.local.run_skipped, self.local.run_calls, self.model_name, self.scale()))
+            del self.local.run_calls
+            del self.local.run_skipped
+
+    def get_stats(self):
+        with self.lock:
+            return {"calls": self.calls, "skipped_calls": self.skipped_calls, "calibration": self.scale()}
+
+
+def apply_block_cache(model_patcher, threshold, sigma_start=float("inf"), sigma_end=0.0):
+    """Adds a BlockCache to a clone of model_patcher."""
+    diffusion_model = model_patcher.get_model_object("diffusion_model")
+    blocks = max([len(m) for m in diffusion_model.children() if isinstance(m, torch.nn.ModuleList)], default=0)
+    cache = BlockCache(threshold, sigma_start=sigma_start, sigma_end=sigma_end, model_name=diffusion_model.__class__.__name__)
+    m = model_patcher.clone()
+    blocks_replace = m.model_options["transformer_options"].get("patches_replace", {}).get("dit", {})
+    for kind in ("double_block", "single_block"):
+        for i in range(blocks):
+            m.set_model_patch_replace(cache.block_patch((kind, i), blocks_replace.get((kind, i), None)), "dit", kind, i)
+    m.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.APPLY_MODEL, "block_cache", cache.apply_model_wrapper)
+    m.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, "block_cache", cache.outer_sample_wrapper)
+    return m, cache
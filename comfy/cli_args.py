@@ -103,8 +103,24 @@ parser.add_argument("--preview-size", type=int, default=512, help="Sets the maxi
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
+cache_group.add_argument("--cache-ram", type=float, default=0, metavar="GB", help="Use caching bounded by memory usage instead of the number of node results: cached outputs are evicted when they use more than this many GB of RAM, the ones that are cheapest to recompute for the memory they hold first.")
 cache_group.add_argument("--cache-none", action="store_true", help="Reduced RAM/VRAM usage at the expense of executing every node for each run.")
 
+parser.add_argument("--cache-vram", type=float, default=None, metavar="GB", help="Used with --cache-ram: move cached tensors to the CPU when they use more than this many GB of VRAM.")
+
+parser.add_argument("--prompt-workers", type=int, default=1, metavar="N", help="Run N prompts at the same time. Each worker has its own cache and is assigned one of the available devices (round robin), queued prompts are preferably given to the worker that already has their models loaded.")
+parser.add_argument("--queue-model-affinity", type=int, default=0, metavar="WINDOW", help="Reorder the queue so that prompts using the same models run back to back, looking at the WINDOW oldest queued prompts. A prompt is never passed over more than WINDOW times.")
+parser.add_argument("--prefetch-models", type=int, default=0, metavar="N", help="While a prompt runs, get the models of the next N queued prompts ready: models already in memory are loaded to the GPU if they fit in the free VRAM and the other model files are read into the OS file cache.")
+parser.add_argument("--batch-prompts", type=int, default=0, metavar="N", help="When prompt workers on the same device sample with the same model at the same time, run the model calls of up to N of them as one batch if their latents and conds have the same shapes. Each prompt keeps its own seed, conds and sampler.")
+parser.add_argument("--parallel-execution", type=int, default=0, metavar="WORKERS", help="Execute independent branches of a workflow at the same time using N worker threads for the nodes that declare they don't use the GPU (DEVICE_NODE = False). The other nodes are still executed one at a time.")
+
+parser.add_argument("--save-image-workers", type=int, default=0, metavar="N", help="Encode and write the images of SaveImage and PreviewImage on N background threads so the next prompt can start right away. The history entry of a prompt is added once its files are written.")
+parser.add_argument("--save-image-format", type=str, default="png", choices=["png", "png-fast", "webp-lossless"], help="File format used by SaveImage. png-fast uses less zlib compression (bigger files, faster saves), webp-lossless stores the workflow in the EXIF data like the animated WEBP node.")
+
+parser.add_argument("--disk-cache-size", type=float, default=0, metavar="GB", help="Keep the outputs of some nodes (text encoding, VAE encoding...) in an on disk cache of up to this many GB that persists across restarts.")
+parser.add_argument("--disk-cache-directory", type=str, default=None, help="Set the directory used by --disk-cache-size (default: node_cache in the user directory).")
+parser.add_argument("--disk-cache-nodes", type=str, nargs='+', default=None, metavar="CLASS", help="Only store the outputs of these node classes in the disk cache instead of the nodes that opt in by default.")
+
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
 attn_group.add_argument("--use-quad-cross-attention", action="store_true", help="Use the sub-quadratic cross attention optimization . Ignored when xformers is used.")
@@ -133,6 +149,10 @@ parser.add_argument("--async-offload", action="store_true", help="Use async weig
 
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
+parser.add_argument("--eviction-policy", type=str, default="default", choices=["default", "cost"], help="How models are picked when some have to be unloaded to free VRAM. default: partially loaded models first, then the least referenced and the smallest. cost: the ones with the lowest measured load and patch time for the memory they free, weighted by how often they were used recently and whether a queued prompt uses them.")
+parser.add_argument("--host-ram-tier", type=float, default=0, metavar="GB", help="Keep up to this many GB of the weights of models unloaded from VRAM in RAM, in a pool of pinned memory when possible so they load back faster. The weights of the least recently used models past that are moved to memory mapped files that the OS can drop from RAM without swapping. 0 leaves unloaded weights in regular RAM.")
+parser.add_argument("--deduplicate-weights", action="store_true", help="Make identical weights of different models in RAM share the same memory, for example the text encoder or VAE of checkpoints finetuned from the same base model.")
+parser.add_argument("--lora-cache-ram", type=float, default=0, metavar="GB", help="Keep up to this many GB of LoRA patched model weights in RAM so loading a model again with a LoRA combination that was used recently copies the patched weights instead of recomputing them.")
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
@@ -144,6 +164,9 @@ class PerformanceFeature(enum.Enum):
 parser.add_argument("--fast", nargs="*", type=PerformanceFeature, help="Enable some untested and potentially quality deteriorating optimizations. --fast with no arguments enables everything. You can pass a list specific optimizations if you only want to enable specific ones. Current valid optimizations: fp16_accumulation fp8_matrix_mult cublas_ops")
 
 parser.add_argument("--mmap-torch-files", action="store_true", help="Use mmap when loading ckpt/pt files.")
+parser.add_argument("--disable-mmap-safetensors", action="store_true", help="Read safetensors files fully in memory when loading them instead of memory mapping them.")
+parser.add_argument("--weight-streaming", type=int, default=0, metavar="N", help="For models that don't fit in VRAM, copy the weights of the next N layers that aren't loaded on the GPU while the current layer runs, in the layer order recorded on the first step. Uses up to N layers worth of extra VRAM. 0 copies the weights of each layer when it runs.")
+parser.add_argument("--weight-load-threads", type=int, default=0, metavar="N", help="Copy the weights of a model being loaded into its parameters on up to N threads, so reading the file, casting to the model dtype and the transfer to the GPU overlap. By default (0) a plain single threaded load_state_dict is used.")
 
 parser.add_argument("--dont-print-server", action="store_true", help="Don't print server output.")
 parser.add_argument("--quick-test-for-ci", action="store_true", help="Quick test for CI.")
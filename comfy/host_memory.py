@@ -0,0 +1,276 @@
+import collections
+import logging
+import os
+import tempfile
+import threading
+import weakref
+from typing import Optional
+
+import psutil
+import safetensors.torch
+import torch
+
+import comfy.utils
+from comfy.cli_args import args
+
+# Offsets of the tensors packed in a buffer are aligned to this many bytes.
+ALIGNMENT = 64
+# Never pin more than this fraction of the total RAM, the OS needs pageable memory to work with.
+MAX_PINNED_RATIO = 0.5
+# A free buffer is only reused for a request that uses at least this fraction of it.
+MIN_REUSE_RATIO = 0.5
+
+MB = 1024 * 1024
+
+
+def _aligned(nbytes):
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class PinnedBufferPool:
+    """
+    Pool of page locked host buffers. Buffers are allocated up to budget bytes and go back to the
+    pool when released, so offloading models over and over doesn't allocate and register new pinned
+    memory (which is slow) every time. If pin is False the buffers are regular pageable memory.
+    """
+    def __init__(self, budget, pin=True):
+        self.budget = budget
+        self.pin = pin
+        self.allocated = 0
+        self.free = []
+        self.reused = 0
+
+    def allocate(self, nbytes) -> Optional[torch.Tensor]:
+        """A uint8 buffer of at least nbytes, or None if it doesn't fit in the budget."""
+        best = None
+        for i, buf in enumerate(self.free):
+            if nbytes <= buf.numel() and nbytes >= buf.numel() * MIN_REUSE_RATIO:
+                if best is None or buf.numel() < self.free[best].numel():
+                    best = i
+        if best is not None:
+            self.reused += 1
+            return self.free.pop(best)
+
+        # Make room by dropping free buffers that are too big or too small to reuse
+        self.free.sort(key=lambda b: b.numel())
+        while self.allocated + nbytes > self.budget and len(self.free) > 0:
+            self.allocated -= self.free.pop().numel()
+        if self.allocated + nbytes > self.budget:
+            return None
+        try:
+            buf = torch.empty((nbytes,), dtype=torch.uint8, pin_memory=self.pin)
+        except RuntimeError as e:
+            logging.warning("Could not allocate {:.1f} MB of pinned memory: {}".format(nbytes / MB, e))
+            return None
+        self.allocated += nbytes
+        return buf
+
+    def release(self, buf):
+        self.free.append(buf)
+
+    def free_bytes(self):
+        return sum(b.numel() for b in self.free)
+
+
+class _HostEntry:
+    def __init__(self, model):
+        self.model = weakref.ref(model)
+        self.name = model.__class__.__name__
+        self.nbytes = 0
+        self.buffer = None
+        self.demoted = False
+
+
+class HostMemoryTier:
+    """
+    Manages the weights of models offloaded from VRAM to host RAM. Offloaded weights are packed in
+    buffers from a PinnedBufferPool, which makes the copy back to VRAM faster than from pageable
+    memory. When the offloaded models use more than ram_ceiling bytes, the least recently used ones
+    are demoted: their weights are written to a spill file that is memory mapped in their place, so
+    the OS can drop them from RAM without swapping and page them back in when the model is loaded.
+    """
+    def __init__(self, ram_ceiling, pin=None, spill_dir=None):
+        if pin is None:
+            pin = torch.cuda.is_available()
+        self.ram_ceiling = ram_ceiling
+        self.pool = PinnedBufferPool(min(ram_ceiling, int(psutil.virtual_memory().total * MAX_PINNED_RATIO)), pin=pin)
+        self.spill_dir = spill_dir
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.demotions = 0
+
+    def _entry(self, model):
+        entry = self.entries.get(id(model), None)
+        if entry is not None and entry.model() is not model:
+            entry = None
+        if entry is None:
+            entry = self.entries[id(model)] = _HostEntry(model)
+            weakref.finalize(model, self._forget, id(model), entry)
+        return entry
+
+    def _forget(self, key, entry):
+        with self.lock:
+            if self.entries.get(key, None) is entry:
+                del self.entries[key]
+            if entry.buffer is not None:
+                self.pool.release(entry.buffer)
+                entry.buffer = None
+
+    def offloaded(self, patcher):
+        """Called once all the weights of a model were moved back to the offload device."""
+        if patcher.offload_device != torch.device("cpu") or patcher.load_device == torch.device("cpu"):
+            return
+        model = patcher.model
+        with self.lock:
+            tensors = comfy.utils.module_tensors(model)
+            if any(t.device.type != "cpu" for _, _, _, t in tensors):
+                return
+            entry = self._entry(model)
+            self.entries.move_to_end(id(model))
+            entry.nbytes = sum(_aligned(t.nbytes) for _, _, _, t in tensors)
+            entry.demoted = False
+            self._pack(entry, tensors)
+            self._enforce_ceiling()
+
+    def _pack(self, entry, tensors):
+        # The same tensors always get the same offsets, so a buffer can be packed again in place as
+        # long as the tensors that are already in it are at their own offset.
+        buffer = entry.buffer
+        if buffer is not None and buffer.numel() >= entry.nbytes:
+            start = buffer.data_ptr()
+            offset = 0
+            for _, _, _, t in tensors:
+                if start <= t.data_ptr() < start + buffer.numel() and t.data_ptr() != start + offset:
+                    buffer = None
+                    break
+                offset += _aligned(t.nbytes)
+        else:
+            buffer = None
+        if buffer is None:
+            buffer = self.pool.allocate(entry.nbytes)
+            if buffer is None:
+                return
+        offset = 0
+        for m, name, is_param, t in tensors:
+            nbytes = t.nbytes
+            view = buffer[offset:offset + nbytes].view(t.dtype).view(t.shape)
+            if view.data_ptr() != t.data_ptr():
+                view.copy_(t)
+            comfy.utils.set_module_tensor(m, name, is_param, view)
+            offset += _aligned(nbytes)
+        if entry.buffer is not None and entry.buffer is not buffer:
+            self.pool.release(entry.buffer)
+        entry.buffer = buffer
+
+    def loaded(self, patcher):
+        """Called after (part of) a model was loaded to its device."""
+        model = patcher.model
+        with self.lock:
+            entry = self.entries.get(id(model), None)
+            if entry is None or entry.model() is not model:
+                return
+            if any(t.device.type == "cpu" for _, _, _, t in comfy.utils.module_tensors(model)):
+                # Partially loaded, the rest of the weights stay where they are
+                self.entries.move_to_end(id(model))
+                return
+            if entry.buffer is not None and self._backed_up_in(patcher, entry.buffer):
+                # The backups are restored when the model is unpatched, offloaded() then packs them again
+                self.entries.move_to_end(id(model))
+                return
+            del self.entries[id(model)]
+            if entry.buffer is not None:
+                self.pool.release(entry.buffer)
+                entry.buffer = None
+
+    def _backed_up_in(self, patcher, buffer):
+        # Weights patched without inplace_update are backed up as they are, so their backup is in the buffer.
+        start = buffer.data_ptr()
+        end = start + buffer.numel()
+        return any(start <= bk.weight.data_ptr() < end for bk in patcher.backup.values())
+
+    def in_buffer(self, tensor) -> bool:
+        """If tensor is in the buffer of an offloaded model, which is reused once that model is loaded."""
+        ptr = tensor.data_ptr()
+        with self.lock:
+            return any(e.buffer is not None and e.buffer.data_ptr() <= ptr < e.buffer.data_ptr() + e.buffer.numel() for e in self.entries.values())
+
+    def resident_bytes(self):
+        return sum(e.nbytes for e in self.entries.values() if not e.demoted)
+
+    def _enforce_ceiling(self):
+        resident = self.resident_bytes()
+        for entry in list(self.entries.values()):
+            if resident <= self.ram_ceiling:
+                break
+            if entry.demoted:
+                continue
+            model = entry.model()
+            if model is None:
+                continue
+            if self._demote(entry, model):
+                resident -= entry.nbytes
+
+    def _demote(self, entry, model):
+        tensors = comfy.utils.module_tensors(model)
+        if any(t.device.type != "cpu" for _, _, _, t in tensors):
+            return False
+        fd, path = tempfile.mkstemp(prefix="comfy_offload_", suffix=".safetensors", dir=self.spill_dir)
+        os.close(fd)
+        try:
+            safetensors.torch.save_file({str(i): x[3].contiguous() for i, x in enumerate(tensors)}, path)
+            sd, _ = comfy.utils.load_safetensors_mmap(path)
+            for i, (m, name, is_param, t) in enumerate(tensors):
+                comfy.utils.set_module_tensor(m, name, is_param, sd[str(i)])
+        except Exception as e:
+            logging.warning("Could not move the offloaded weights of {} to disk: {}".format(entry.name, e))
+            return False
+        finally:
+            try:
+                os.remove(path)  # The mapping stays valid
+            except OSError:
+                weakref.finalize(model, _remove_file, path)
+        if entry.buffer is not None:
+            self.pool.release(entry.buffer)
+            entry.buffer = None
+        entry.demoted = True
+        self.demotions += 1
+        logging.info("Moved the offloaded weights of {} ({:.1f} MB) from RAM to a memory mapped file".format(entry.name, entry.nbytes / MB))
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "ram_ceiling": self.ram_ceiling,
+                "resident_bytes": self.resident_bytes(),
+                "mmap_bytes": sum(e.nbytes for e in self.entries.values() if e.demoted),
+                "pinned": self.pool.pin,
+                "pinned_bytes": sum(e.buffer.numel() for e in self.entries.values() if e.buffer is not None),
+                "pool_bytes": self.pool.allocated,
+                "pool_free_bytes": self.pool.free_bytes(),
+                "pool_reused": self.pool.reused,
+                "models_resident": sum(1 for e in self.entries.values() if not e.demoted),
+                "models_demoted": sum(1 for e in self.entries.values() if e.demoted),
+                "demotions": self.demotions,
+            }
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+host_memory_tier: Optional[HostMemoryTier] = None
+host_memory_tier_lock = threading.Lock()
+
+def get_host_memory_tier() -> Optional[HostMemoryTier]:
+    """Returns the shared HostMemoryTier, or None if offloaded weights are left as they are."""
+    global host_memory_tier
+    if args.host_ram_tier <= 0:
+        return None
+    with host_memory_tier_lock:
+        if host_memory_tier is None:
+            host_memory_tier = HostMemoryTier(int(args.host_ram_tier * 1024 * 1024 * 1024))
+            logging.info("Keeping up to {} GB of offloaded model weights in RAM".format(args.host_ram_tier))
+        return host_memory_tier
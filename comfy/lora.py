@@ -329,7 +329,33 @@ def pad_tensor_to_shape(tensor: torch.Tensor, new_shape: list[int]) -> torch.Ten
 
     return padded_tensor
 
+# Consecutive plain LoRA patches of a weight are applied with a single matrix multiplication.
+STACK_LORA_PATCHES = True
+
+def stack_lora_patches(patches):
+    """Replaces runs of plain LoRA patches (no strength_model, offset or function) with a StackedLoRAAdapter patch."""
+    out = []
+    run = []
+
+    def flush():
+        if len(run) > 1:
+            out.append((1.0, weight_adapter.StackedLoRAAdapter([(p[0], p[1]) for p in run]), 1.0, None, None))
+        else:
+            out.extend(run)
+        run.clear()
+
+    for p in patches:
+        if isinstance(p[1], weight_adapter.LoRAAdapter) and weight_adapter.StackedLoRAAdapter.stackable(p[1]) and p[2] == 1.0 and p[3] is None and p[4] is None:
+            run.append(p)
+        else:
+            flush()
+            out.append(p)
+    flush()
+    return out
+
 def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None):
+    if STACK_LORA_PATCHES:
+        patches = stack_lora_patches(patches)
     for p in patches:
         strength = p[0]
         v = p[1]
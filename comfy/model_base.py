@@ -47,6 +47,7 @@ import comfy.model_management
 import comfy.patcher_extension
 import comfy.conds
 import comfy.ops
+import comfy.weight_loader
 from enum import Enum
 from . import utils
 import comfy.latent_formats
@@ -288,7 +289,7 @@ class BaseModel(torch.nn.Module):
                 to_load[k[len(unet_prefix):]] = sd.pop(k)
 
         to_load = self.model_config.process_unet_state_dict(to_load)
-        m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
+        m, u = comfy.weight_loader.load_state_dict(self.diffusion_model, to_load)
         if len(m) > 0:
             logging.warning("unet missing: {}".format(m))
 
@@ -0,0 +1,176 @@
+import logging
+import sys
+import threading
+import time
+import weakref
+
+from comfy.cli_args import args
+
+# Assumed host to device bandwidth for models that were never timed loading.
+DEFAULT_LOAD_BYTES_PER_SECOND = 2 * 1024 * 1024 * 1024
+# A use of a model counts half as much after this many seconds.
+USE_HALF_LIFE = 600.0
+# Expected reuse of a model that one of the queued prompts loads.
+UPCOMING_REUSE = 4.0
+# How many of the queued prompts are looked at for the models they use.
+UPCOMING_PROMPTS = 8
+
+MB = 1024 * 1024
+
+
+class ModelUsageStats:
+    def __init__(self):
+        self.load_seconds = 0.0
+        self.loaded_bytes = 0
+        self.patch_seconds = 0.0
+        self.uses = 0.0
+        self.last_use = None
+
+    def record_use(self, now):
+        self.uses = self.decayed_uses(now) + 1.0
+        self.last_use = now
+
+    def decayed_uses(self, now):
+        if self.last_use is None:
+            return 0.0
+        return self.uses * 0.5 ** ((now - self.last_use) / USE_HALF_LIFE)
+
+    def reload_seconds(self, nbytes):
+        """Estimated time to load nbytes of the model again, patching included."""
+        if self.loaded_bytes > 0 and self.load_seconds > 0:
+            seconds = nbytes * self.load_seconds / self.loaded_bytes
+        else:
+            seconds = nbytes / DEFAULT_LOAD_BYTES_PER_SECOND
+        return seconds + self.patch_seconds
+
+
+# Keyed by the torch model, which is shared by a ModelPatcher and its clones.
+usage_stats = weakref.WeakKeyDictionary()
+upcoming_models = weakref.WeakSet()
+stats_lock = threading.Lock()
+
+
+def stats_for(patcher) -> ModelUsageStats:
+    model = getattr(patcher, "model", None)
+    if model is None:
+        return ModelUsageStats()
+    with stats_lock:
+        stats = usage_stats.get(model, None)
+        if stats is None:
+            stats = usage_stats[model] = ModelUsageStats()
+        return stats
+
+
+def record_use(patcher):
+    stats_for(patcher).record_use(time.monotonic())
+
+
+def record_load(patcher, seconds, nbytes, patch_seconds):
+    if nbytes <= 0:
+        return
+    stats = stats_for(patcher)
+    stats.load_seconds = seconds - patch_seconds
+    stats.loaded_bytes = nbytes
+    stats.patch_seconds = patch_seconds
+
+
+def set_upcoming_models(patchers):
+    """The models that the queued prompts will use."""
+    with stats_lock:
+        upcoming_models.clear()
+        for p in patchers:
+            upcoming_models.add(p.model)
+
+
+class EvictionPolicy:
+    """
+    Decides in which order free_memory unloads models. order() gets (index, LoadedModel) pairs for
+    the models on the device that can be unloaded and returns them in the order they should go.
+    """
+    name = "default"
+    # If the prompt worker should call set_upcoming_models with the models of the queued prompts.
+    uses_upcoming = False
+
+    def __init__(self):
+        self.evictions = 0
+        self.bytes_freed = 0
+
+    def order(self, candidates):
+        # Partially loaded models first, then the least referenced, then the smallest.
+        keys = [(-m.model_offloaded_memory(), sys.getrefcount(m.model), m.model_memory(), i) for i, m in candidates]
+        by_index = dict(candidates)
+        return [(k[-1], by_index[k[-1]]) for k in sorted(keys)]
+
+    def unloaded(self, loaded_model, freed):
+        self.evictions += 1
+        self.bytes_freed += freed
+
+    def get_stats(self):
+        return {"policy": self.name, "evictions": self.evictions, "bytes_freed": self.bytes_freed}
+
+
+class CostAwareEvictionPolicy(EvictionPolicy):
+    """
+    Unloads the models that are the cheapest to get back first: the measured time to load and patch
+    the memory they use, times how likely they are to be used again (recent uses decaying with a
+    half life of USE_HALF_LIFE, plus UPCOMING_REUSE if a queued prompt uses them), per byte freed.
+    """
+    name = "cost"
+    uses_upcoming = True
+
+    def __init__(self):
+        super().__init__()
+        self.estimated_reload_seconds = 0.0
+
+    def expected_cost(self, loaded_model, now):
+        patcher = loaded_model.model
+        stats = stats_for(patcher)
+        nbytes = patcher.loaded_size()
+        reuse = stats.decayed_uses(now)
+        if patcher.model in upcoming_models:
+            reuse += UPCOMING_REUSE
+        reload_seconds = stats.reload_seconds(nbytes)
+        return reload_seconds * reuse, reload_seconds, reuse, nbytes
+
+    def order(self, candidates):
+        now = time.monotonic()
+        scored = []
+        for i, m in candidates:
+            cost, reload_seconds, reuse, nbytes = self.expected_cost(m, now)
+            scored.append((cost / max(nbytes, 1), i, m, reload_seconds, reuse, nbytes))
+        scored.sort(key=lambda x: (x[0], x[1]))
+        for per_byte, i, m, reload_seconds, reuse, nbytes in scored:
+            logging.debug("Eviction candidate {}: {:.1f} MB, reload {:.2f}s, expected reuse {:.2f}".format(m.model.model.__class__.__name__, nbytes / MB, reload_seconds, reuse))
+        return [(x[1], x[2]) for x in scored]
+
+    def unloaded(self, loaded_model, freed):
+        super().unloaded(loaded_model, freed)
+        patcher = loaded_model.model
+        reload_seconds = stats_for(patcher).reload_seconds(freed)
+        reuse = stats_for(patcher).decayed_uses(time.monotonic())
+        self.estimated_reload_seconds += reload_seconds
+        logging.info("Unloaded {} ({:.1f} MB, reload {:.2f}s, expected reuse {:.2f})".format(loaded_model.model.model.__class__.__name__, freed / MB, reload_seconds, reuse))
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats["estimated_reload_seconds"] = self.estimated_reload_seconds
+        return stats
+
+
+EVICTION_POLICIES = {
+    "default": EvictionPolicy,
+    "cost": CostAwareEvictionPolicy,
+}
+
+eviction_policy = None
+
+def get_eviction_policy() -> EvictionPolicy:
+    global eviction_policy
+    if eviction_policy is None:
+        eviction_policy = EVICTION_POLICIES[args.eviction_policy]()
+    return eviction_policy
+
+def set_eviction_policy(policy: EvictionPolicy):
+    """Replaces the eviction policy, custom nodes can pass their own EvictionPolicy subclass."""
+    global eviction_policy
+    eviction_policy = policy
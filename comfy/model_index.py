@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import threading
+
+import comfy.model_detection
+import comfy.supported_models
+import comfy.utils
+import folder_paths
+
+INDEX_VERSION = 1
+
+
+def _dtype_name(dtype):
+    if dtype is None:
+        return None
+    return str(dtype).replace("torch.", "")
+
+
+def _detect_architecture(sd, metadata):
+    prefixes = [comfy.model_detection.unet_prefix_from_state_dict(sd)]
+    if "" not in prefixes:
+        prefixes.append("") # diffusion model only files
+    for prefix in prefixes:
+        try:
+            unet_config = comfy.model_detection.detect_unet_config(sd, prefix, metadata=metadata)
+        except Exception as e:
+            logging.debug("Header detection with prefix '{}' failed: {}".format(prefix, e))
+            continue
+        if unet_config is None:
+            continue
+        # Same lookup as model_config_from_unet_config without the error log, most files in models/ are not diffusion models.
+        for model_config in comfy.supported_models.models:
+            if model_config.matches(unet_config, sd):
+                return model_config.__name__, prefix
+    return None, None
+
+
+def describe_model_file(path):
+    """
+    Identifies a model file from its safetensors header alone, without reading any weights.
+    Returns a dict with the architecture (name of the matching comfy.supported_models class or None),
+    parameter count and main weight dtype, or None if the file isn't a readable safetensors file.
+    """
+    if not path.lower().endswith((".safetensors", ".sft")):
+        return None
+    try:
+        header = comfy.utils.safetensors_meta_state_dict(path)
+    except Exception as e:
+        logging.warning("Could not read the safetensors header of {}: {}".format(path, e))
+        return None
+    if header is None:
+        return None
+    sd, metadata = header
+    architecture, prefix = _detect_architecture(sd, metadata)
+    return {
+        "architecture": architecture,
+        "parameters": comfy.utils.calculate_parameters(sd),
+        "diffusion_model_parameters": comfy.utils.calculate_parameters(sd, prefix) if architecture is not None else None,
+        "dtype": _dtype_name(comfy.utils.weight_dtype(sd)),
+        "tensors": len(sd),
+        "size": os.path.getsize(path),
+    }
+
+
+class ModelIndex:
+    """
+    Persistent cache of describe_model_file results. Entries are keyed by absolute path and are
+    reused as long as the size and mtime of the file are unchanged.
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning("Ignoring unreadable model index {}: {}".format(self.index_path, e))
+            return
+        if data.get("version") == INDEX_VERSION:
+            self.entries = data.get("models", {})
+
+    def describe(self, path):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry["fingerprint"] == fingerprint:
+                return entry["info"]
+
+        info = describe_model_file(path)
+        with self.lock:
+            self.entries[path] = {"fingerprint": fingerprint, "info": info}
+            self.dirty = True
+        return info
+
+    def describe_folder(self, folder_name):
+        """Returns {filename: info} for every file of a models folder and saves the index if anything changed."""
+        out = {}
+        for filename in folder_paths.get_filename_list(folder_name):
+            full_path = folder_paths.get_full_path(folder_name, filename)
+            if full_path is not None:
+                out[filename] = self.describe(full_path)
+        self.save()
+        return out
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            for path in [p for p in self.entries if not os.path.exists(p)]:
+                del self.entries[path]
+            data = json.dumps({"version": INDEX_VERSION, "models": self.entries})
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logging.warning("Could not save the model index {}: {}".format(self.index_path, e))
+
+
+model_index = None
+model_index_lock = threading.Lock()
+
+def get_model_index():
+    global model_index
+    with model_index_lock:
+        if model_index is None:
+            model_index = ModelIndex(os.path.join(folder_paths.get_user_directory(), "model_index.json"))
+        return model_index
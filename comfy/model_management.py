@@ -18,10 +18,16 @@
 
 import psutil
 import logging
+import os
+import contextvars
+import threading
 from enum import Enum
 from comfy.cli_args import args, PerformanceFeature
+import comfy.model_eviction
+import comfy.host_memory
+import comfy.weight_dedup
 import torch
-import sys
+import time
 import platform
 import weakref
 import gc
@@ -151,9 +157,35 @@ def is_mlu():
         return True
     return False
 
+# Set by prompt workers that are pinned to a specific device, see set_torch_device_override()
+torch_device_override = contextvars.ContextVar("torch_device_override", default=None)
+
+def set_torch_device_override(device):
+    """Make get_torch_device() return this device for the current thread (and anything it dispatches work to)."""
+    torch_device_override.set(device)
+
+def get_all_torch_devices():
+    if directml_enabled:
+        return [directml_device]
+    if cpu_state == CPUState.MPS:
+        return [torch.device("mps")]
+    if cpu_state == CPUState.CPU:
+        return [torch.device("cpu")]
+    if is_intel_xpu():
+        return [torch.device("xpu", i) for i in range(torch.xpu.device_count())]
+    elif is_ascend_npu():
+        return [torch.device("npu", i) for i in range(torch.npu.device_count())]
+    elif is_mlu():
+        return [torch.device("mlu", i) for i in range(torch.mlu.device_count())]
+    else:
+        return [torch.device("cuda", i) for i in range(torch.cuda.device_count())]
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = torch_device_override.get()
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -395,6 +427,16 @@ except:
 
 
 current_loaded_models = []
+# Guards current_loaded_models when several prompt workers load and unload models at the same time
+model_management_lock = threading.RLock()
+# Number of load_models_gpu calls, lets the model prefetcher wait for the running prompt to load its models.
+models_load_count = 0
+# Notified when prompts unpin their models, prefetch_model_gpu() is done loading one and after load_models_gpu()
+models_changed = threading.Condition(model_management_lock)
+# Models prefetch_model_gpu() is loading outside of the lock
+models_prefetching = []
+# Prompt being executed in the current context, set by the prompt workers with start_processing()
+processing_prompt = contextvars.ContextVar("processing_prompt", default=None)
 
 def module_size(module):
     module_mem = 0
@@ -412,6 +454,8 @@ class LoadedModel:
         self.currently_used = True
         self.model_finalizer = None
         self._patcher_finalizer = None
+        # Prompts using the model, it isn't unloaded to make room for the models of the others.
+        self.pinned_by = set()
 
     def _set_model(self, model):
         self._model = weakref.ref(model)
@@ -474,13 +518,23 @@ class LoadedModel:
                 if freed >= memory_to_free:
                     return False
         self.model.detach(unpatch_weights)
+        host_memory_tier = comfy.host_memory.get_host_memory_tier()
+        if host_memory_tier is not None and unpatch_weights:
+            host_memory_tier.offloaded(self.model)
+        elif unpatch_weights:
+            # Moving the weights back to the cpu made new copies of the shared ones
+            comfy.weight_dedup.deduplicate(self.model)
         self.model_finalizer.detach()
         self.model_finalizer = None
         self.real_model = None
         return True
 
     def model_use_more_vram(self, extra_memory, force_patch_weights=False):
-        return self.model.partially_load(self.device, extra_memory, force_patch_weights=force_patch_weights)
+        loaded = self.model.partially_load(self.device, extra_memory, force_patch_weights=force_patch_weights)
+        host_memory_tier = comfy.host_memory.get_host_memory_tier()
+        if host_memory_tier is not None:
+            host_memory_tier.loaded(self.model)
+        return loaded
 
     def __eq__(self, other):
         return self.model is other.model
@@ -492,6 +546,9 @@ class LoadedModel:
     def is_dead(self):
         return self.real_model() is not None and self.model is None
 
+    def pinned_by_other_prompts(self):
+        return len(self.pinned_by - {processing_prompt.get()}) > 0
+
 
 def use_more_memory(extra_memory, loaded_models, device):
     for m in loaded_models:
@@ -524,120 +581,213 @@ def minimum_inference_memory():
     return (1024 * 1024 * 1024) * 0.8 + extra_reserved_memory()
 
 def free_memory(memory_required, device, keep_loaded=[]):
-    cleanup_models_gc()
-    unloaded_model = []
-    can_unload = []
-    unloaded_models = []
-
-    for i in range(len(current_loaded_models) -1, -1, -1):
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded and not shift_model.is_dead():
-                can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
-                shift_model.currently_used = False
-
-    for x in sorted(can_unload):
-        i = x[-1]
-        memory_to_free = None
-        if not DISABLE_SMART_MEMORY:
-            free_mem = get_free_memory(device)
-            if free_mem > memory_required:
-                break
-            memory_to_free = memory_required - free_mem
-        logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
-        if current_loaded_models[i].model_unload(memory_to_free):
-            unloaded_model.append(i)
-
-    for i in sorted(unloaded_model, reverse=True):
-        unloaded_models.append(current_loaded_models.pop(i))
-
-    if len(unloaded_model) > 0:
-        soft_empty_cache()
-    else:
-        if vram_state != VRAMState.HIGH_VRAM:
-            mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
-            if mem_free_torch > mem_free_total * 0.25:
-                soft_empty_cache()
-    return unloaded_models
+    with model_management_lock:
+        cleanup_models_gc()
+        unloaded_model = []
+        can_unload = []
+        unloaded_models = []
+
+        for i in range(len(current_loaded_models) -1, -1, -1):
+            shift_model = current_loaded_models[i]
+            if shift_model.device == device:
+                if shift_model not in keep_loaded and not shift_model.is_dead() and not shift_model.pinned_by_other_prompts():
+                    can_unload.append((i, shift_model))
+                    shift_model.currently_used = False
+
+        eviction_policy = comfy.model_eviction.get_eviction_policy()
+        for i, shift_model in eviction_policy.order(can_unload):
+            memory_to_free = None
+            if not DISABLE_SMART_MEMORY:
+                free_mem = get_free_memory(device)
+                if free_mem > memory_required:
+                    break
+                memory_to_free = memory_required - free_mem
+            logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
+            loaded_size = shift_model.model_loaded_memory()
+            unloaded = shift_model.model_unload(memory_to_free)
+            eviction_policy.unloaded(shift_model, loaded_size - shift_model.model_loaded_memory())
+            if unloaded:
+                unloaded_model.append(i)
+
+        for i in sorted(unloaded_model, reverse=True):
+            unloaded_models.append(current_loaded_models.pop(i))
+
+        if len(unloaded_model) > 0:
+            soft_empty_cache()
+        else:
+            if vram_state != VRAMState.HIGH_VRAM:
+                mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
+                if mem_free_torch > mem_free_total * 0.25:
+                    soft_empty_cache()
+        return unloaded_models
 
 def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimum_memory_required=None, force_full_load=False):
-    cleanup_models_gc()
-    global vram_state
-
-    inference_memory = minimum_inference_memory()
-    extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
-    if minimum_memory_required is None:
-        minimum_memory_required = extra_mem
-    else:
-        minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
+    with model_management_lock:
+        cleanup_models_gc()
+        global vram_state
+
+        inference_memory = minimum_inference_memory()
+        extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
+        if minimum_memory_required is None:
+            minimum_memory_required = extra_mem
+        else:
+            minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
 
-    models = set(models)
+        models = set(models)
 
-    models_to_load = []
+        # The models this prompt loaded before aren't in use anymore. Loading a clone of a model that another prompt
+        # worker is using, or that is being prefetched, would move or patch its weights under it: wait until it is done.
+        prompt_id = processing_prompt.get()
+        if prompt_id is not None:
+            unpin_models(prompt_id)
+        while any(x.is_clone(m) for m in models_prefetching for x in models) or any(m.model is not None and m.pinned_by_other_prompts() and any(x.is_clone(m.model) for x in models) for m in current_loaded_models):
+            logging.debug("Waiting for another prompt to be done with a model")
+            models_changed.wait(timeout=1.0)
+            throw_exception_if_processing_interrupted()
 
-    for x in models:
-        loaded_model = LoadedModel(x)
-        try:
-            loaded_model_index = current_loaded_models.index(loaded_model)
-        except:
-            loaded_model_index = None
+        models_to_load = []
 
-        if loaded_model_index is not None:
-            loaded = current_loaded_models[loaded_model_index]
-            loaded.currently_used = True
-            models_to_load.append(loaded)
-        else:
-            if hasattr(x, "model"):
-                logging.info(f"Requested to load {x.model.__class__.__name__}")
-            models_to_load.append(loaded_model)
+        for x in models:
+            loaded_model = LoadedModel(x)
+            try:
+                loaded_model_index = current_loaded_models.index(loaded_model)
+            except:
+                loaded_model_index = None
 
-    for loaded_model in models_to_load:
-        to_unload = []
-        for i in range(len(current_loaded_models)):
-            if loaded_model.model.is_clone(current_loaded_models[i].model):
-                to_unload = [i] + to_unload
-        for i in to_unload:
-            current_loaded_models.pop(i).model.detach(unpatch_all=False)
-
-    total_memory_required = {}
-    for loaded_model in models_to_load:
-        total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
-
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
-
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_mem = get_free_memory(device)
-            if free_mem < minimum_memory_required:
-                models_l = free_memory(minimum_memory_required, device)
-                logging.info("{} models unloaded.".format(len(models_l)))
-
-    for loaded_model in models_to_load:
-        model = loaded_model.model
-        torch_dev = model.load_device
-        if is_device_cpu(torch_dev):
-            vram_set_state = VRAMState.DISABLED
-        else:
-            vram_set_state = vram_state
-        lowvram_model_memory = 0
-        if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
-            loaded_memory = loaded_model.model_loaded_memory()
-            current_free_mem = get_free_memory(torch_dev) + loaded_memory
+            if loaded_model_index is not None:
+                loaded = current_loaded_models[loaded_model_index]
+                loaded.currently_used = True
+                models_to_load.append(loaded)
+            else:
+                if hasattr(x, "model"):
+                    logging.info(f"Requested to load {x.model.__class__.__name__}")
+                models_to_load.append(loaded_model)
+            comfy.model_eviction.record_use(x)
+
+        if prompt_id is not None:
+            for loaded_model in models_to_load:
+                loaded_model.pinned_by.add(prompt_id)
+
+        for loaded_model in models_to_load:
+            to_unload = []
+            for i in range(len(current_loaded_models)):
+                if loaded_model.model.is_clone(current_loaded_models[i].model):
+                    to_unload = [i] + to_unload
+            for i in to_unload:
+                current_loaded_models.pop(i).model.detach(unpatch_all=False)
+
+        total_memory_required = {}
+        for loaded_model in models_to_load:
+            total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_mem = get_free_memory(device)
+                if free_mem < minimum_memory_required:
+                    models_l = free_memory(minimum_memory_required, device)
+                    logging.info("{} models unloaded.".format(len(models_l)))
+
+        for loaded_model in models_to_load:
+            model = loaded_model.model
+            torch_dev = model.load_device
+            if is_device_cpu(torch_dev):
+                vram_set_state = VRAMState.DISABLED
+            else:
+                vram_set_state = vram_state
+            lowvram_model_memory = 0
+            if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
+                loaded_memory = loaded_model.model_loaded_memory()
+                current_free_mem = get_free_memory(torch_dev) + loaded_memory
+
+                lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
+                lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
+
+            if vram_set_state == VRAMState.NO_VRAM:
+                lowvram_model_memory = 0.1
+
+            load_start = time.perf_counter()
+            loaded_size = loaded_model.model_loaded_memory()
+            patch_seconds = getattr(model, "patch_seconds", 0.0)
+            loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
+            comfy.model_eviction.record_load(model, time.perf_counter() - load_start, loaded_model.model_loaded_memory() - loaded_size, getattr(model, "patch_seconds", 0.0) - patch_seconds)
+            current_loaded_models.insert(0, loaded_model)
+
+        global models_load_count
+        models_load_count += 1
+        models_changed.notify_all()
+        return
 
-            lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
-            lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
+def load_model_gpu(model):
+    return load_models_gpu([model])
 
-        if vram_set_state == VRAMState.NO_VRAM:
-            lowvram_model_memory = 0.1
+def unpin_models(prompt_id):
+    """Lets the models prompt_id loaded be unloaded for the other prompts."""
+    with model_management_lock:
+        for m in current_loaded_models:
+            m.pinned_by.discard(prompt_id)
+        models_changed.notify_all()
+
+# Models loaded from each file, so the models a queued prompt will use can be found before it runs.
+model_files = {}
+
+def register_model_file(model, path):
+    with model_management_lock:
+        model_files.setdefault(os.path.abspath(path), weakref.WeakSet()).add(model)
+
+def models_for_file(path):
+    with model_management_lock:
+        return list(model_files.get(os.path.abspath(path), ()))
+
+def wait_for_models_load(load_count, timeout=None):
+    """Waits until load_models_gpu() was called more than load_count times. Returns False on timeout."""
+    with models_changed:
+        return models_changed.wait_for(lambda: models_load_count > load_count, timeout)
+
+def prefetch_model_gpu(model, memory_reserved=0):
+    """
+    Loads a model to its device ahead of the prompt that uses it, only if it fits in the free memory
+    without unloading anything, using the memory reserved for inference or memory_reserved (what the
+    running prompt still needs). Returns True if it did.
+    """
+    with model_management_lock:
+        cleanup_models_gc()
+        device = model.load_device
+        if is_device_cpu(device) or vram_state == VRAMState.NO_VRAM:
+            return False
+        for loaded in current_loaded_models:
+            if loaded.model is not None and loaded.model.is_clone(model):
+                return False
+        if any(m.is_clone(model) for m in models_prefetching):
+            return False
 
-        loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
-        current_loaded_models.insert(0, loaded_model)
-    return
+        loaded_model = LoadedModel(model)
+        memory_required = loaded_model.model_memory_required(device)
+        free = get_free_memory(device) - minimum_inference_memory() - memory_reserved
+        if memory_required > free:
+            logging.debug("Not prefetching {}, it needs {:.1f} MB and {:.1f} MB are free".format(model.model.__class__.__name__, memory_required / (1024 * 1024), free / (1024 * 1024)))
+            return False
+        models_prefetching.append(model)
 
-def load_model_gpu(model):
-    return load_models_gpu([model])
+    # Loaded without holding the lock so the running prompt can load and unload its models meanwhile,
+    # load_models_gpu() waits for it if it needs this model or a clone of it.
+    logging.info("Prefetching {}".format(model.model.__class__.__name__))
+    loaded = False
+    try:
+        loaded_model.model_load()
+        loaded = True
+    finally:
+        with model_management_lock:
+            models_prefetching.remove(model)
+            if loaded:
+                # Not used by the running prompt, the eviction policy can unload it like any other such model.
+                loaded_model.currently_used = False
+                current_loaded_models.append(loaded_model)
+            models_changed.notify_all()
+    return True
 
 def loaded_models(only_currently_used=False):
     output = []
@@ -671,14 +821,15 @@ def cleanup_models_gc():
 
 
 def cleanup_models():
-    to_delete = []
-    for i in range(len(current_loaded_models)):
-        if current_loaded_models[i].real_model() is None:
-            to_delete = [i] + to_delete
+    with model_management_lock:
+        to_delete = []
+        for i in range(len(current_loaded_models)):
+            if current_loaded_models[i].real_model() is None:
+                to_delete = [i] + to_delete
 
-    for i in to_delete:
-        x = current_loaded_models.pop(i)
-        del x
+        for i in to_delete:
+            x = current_loaded_models.pop(i)
+            del x
 
 def dtype_size(dtype):
     dtype_size = 4
@@ -1324,22 +1475,64 @@ class InterruptProcessingException(Exception):
 interrupt_processing_mutex = threading.RLock()
 
 interrupt_processing = False
-def interrupt_current_processing(value=True):
+# Prompts being executed by the prompt workers and the ones of them that were interrupted
+processing_prompts = set()
+interrupted_prompts = set()
+
+def start_processing(prompt_id):
+    """Called by a prompt worker before executing prompt_id, in the context the prompt is executed in."""
+    global interrupt_processing
+    processing_prompt.set(prompt_id)
+    with interrupt_processing_mutex:
+        if len(processing_prompts) == 0:
+            interrupt_processing = False
+        processing_prompts.add(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+
+def finish_processing(prompt_id):
+    with interrupt_processing_mutex:
+        processing_prompts.discard(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+    unpin_models(prompt_id)
+
+def interrupt_current_processing(value=True, prompt_id=None):
+    """
+    Interrupts prompt_id, by default the prompt of the current context or when there is none every prompt being
+    executed. value=False clears the interrupt instead.
+    """
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        if prompt_id is None:
+            prompt_id = processing_prompt.get()
+        if prompt_id is None:
+            interrupt_processing = value
+            prompts = set(processing_prompts)
+        else:
+            prompts = {prompt_id} & processing_prompts
+        if value:
+            interrupted_prompts.update(prompts)
+        else:
+            interrupted_prompts.difference_update(prompts)
 
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        return interrupt_processing
+        prompt_id = processing_prompt.get()
+        if prompt_id is None:
+            return interrupt_processing
+        return prompt_id in interrupted_prompts
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        if interrupt_processing:
-            interrupt_processing = False
+        prompt_id = processing_prompt.get()
+        if prompt_id is None:
+            if interrupt_processing:
+                interrupt_processing = False
+                raise InterruptProcessingException()
+        elif prompt_id in interrupted_prompts:
+            interrupted_prompts.discard(prompt_id)
             raise InterruptProcessingException()
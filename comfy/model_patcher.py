@@ -23,6 +23,7 @@ import copy
 import inspect
 import logging
 import math
+import time
 import uuid
 from typing import Callable, Optional
 
@@ -34,6 +35,9 @@ import comfy.lora
 import comfy.model_management
 import comfy.patcher_extension
 import comfy.utils
+import comfy.weight_dedup
+import comfy.weight_patch_cache
+import comfy.weight_streaming
 from comfy.comfy_types import UnetWrapperFunction
 from comfy.patcher_extension import CallbacksMP, PatcherInjection, WrappersMP
 
@@ -106,6 +110,9 @@ def wipe_lowvram_weight(m):
     if hasattr(m, "bias_function"):
         m.bias_function = []
 
+    if hasattr(m, "comfy_weight_streamer"):
+        del m.comfy_weight_streamer
+
 def move_weight_functions(m, device):
     if device is None:
         return 0
@@ -224,6 +231,8 @@ class ModelPatcher:
         self.force_cast_weights = False
         self.patches_uuid = uuid.uuid4()
         self.parent = None
+        # Time spent applying weight patches, used to estimate the cost of reloading the model
+        self.patch_seconds = 0.0
 
         self.attachments: dict[str] = {}
         self.additional_models: dict[str, list[ModelPatcher]] = {}
@@ -379,6 +388,9 @@ class ModelPatcher:
     def set_model_sampler_pre_cfg_function(self, pre_cfg_function, disable_cfg1_optimization=False):
         self.model_options = set_model_options_pre_cfg_function(self.model_options, pre_cfg_function, disable_cfg1_optimization)
 
+    def set_model_uncond_cache(self, interval, sigma_start=float("inf"), sigma_end=0.0, extrapolate=False):
+        self.model_options["uncond_cache_options"] = {"interval": interval, "sigma_start": sigma_start, "sigma_end": sigma_end, "extrapolate": extrapolate}
+
     def set_model_sampler_calc_cond_batch_function(self, sampler_calc_cond_batch_function):
         self.model_options["sampler_calc_cond_batch_function"] = sampler_calc_cond_batch_function
 
@@ -551,28 +563,46 @@ class ModelPatcher:
         if key not in self.patches:
             return
 
+        patch_start = time.perf_counter()
         weight, set_func, convert_func = get_key_weight(self.model, key)
         inplace_update = self.weight_inplace_update or inplace_update
+        if inplace_update and comfy.weight_dedup.is_shared(weight):
+            # Other models use the same storage
+            comfy.utils.set_attr_param(self.model, key, weight.clone())
+            weight, set_func, convert_func = get_key_weight(self.model, key)
 
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-        else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        if convert_func is not None:
-            temp_weight = convert_func(temp_weight, inplace=True)
+        patched_weight_cache = comfy.weight_patch_cache.get_patched_weight_cache() if set_func is None else None
+        cache_key = None
+        out_weight = None
+        if patched_weight_cache is not None:
+            cache_key = patched_weight_cache.cache_key(self.model, key, self.patches[key], weight)
+            out_weight = patched_weight_cache.get(cache_key, device_to if device_to is not None else weight.device)
+
+        if out_weight is None:
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            if convert_func is not None:
+                temp_weight = convert_func(temp_weight, inplace=True)
+
+            out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+            if set_func is None:
+                out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+                if patched_weight_cache is not None:
+                    patched_weight_cache.put(cache_key, out_weight)
 
-        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
         if set_func is None:
-            out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
             if inplace_update:
                 comfy.utils.copy_to_param(self.model, key, out_weight)
             else:
                 comfy.utils.set_attr_param(self.model, key, out_weight)
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
+        self.patch_seconds += time.perf_counter() - patch_start
 
     def _load_list(self):
         loading = []
@@ -597,6 +627,13 @@ class ModelPatcher:
             lowvram_counter = 0
             loading = self._load_list()
 
+            if not full_load and sum(x[0] for x in loading) > lowvram_model_memory:
+                # The weights streamed ahead of the lowvram module running need room on the device too
+                lookahead = comfy.weight_streaming.streaming_lookahead(device_to)
+                if lookahead > 0:
+                    largest = max((x[0] for x in loading if hasattr(x[2], "comfy_cast_weights")), default=0)
+                    lowvram_model_memory = max(0.1, lowvram_model_memory - lookahead * largest)
+
             load_completely = []
             loading.sort(reverse=True)
             for x in loading:
@@ -648,6 +685,10 @@ class ModelPatcher:
                 if cast_weight and hasattr(m, "comfy_cast_weights"):
                     m.prev_comfy_cast_weights = m.comfy_cast_weights
                     m.comfy_cast_weights = True
+                    if lowvram_weight:
+                        weight_streamer = self._weight_streamer(device_to)
+                        if weight_streamer is not None:
+                            m.comfy_weight_streamer = weight_streamer
 
                 if weight_key in self.weight_wrapper_patches:
                     m.weight_function.extend(self.weight_wrapper_patches[weight_key])
@@ -723,6 +764,7 @@ class ModelPatcher:
 
                 self.model.model_lowvram = False
                 self.model.lowvram_patch_counter = 0
+                self._close_weight_streamer()
 
             keys = list(self.backup.keys())
 
@@ -751,6 +793,20 @@ class ModelPatcher:
 
         self.object_patches_backup.clear()
 
+    def _weight_streamer(self, device):
+        weight_streamer = getattr(self.model, "weight_streamer", None)
+        if weight_streamer is None or weight_streamer.device != device:
+            self._close_weight_streamer()
+            weight_streamer = self.model.weight_streamer = comfy.weight_streaming.create_weight_streamer(device)
+        return weight_streamer
+
+    def _close_weight_streamer(self):
+        weight_streamer = getattr(self.model, "weight_streamer", None)
+        if weight_streamer is not None:
+            weight_streamer.close()
+            logging.info("Weight streaming: {hits} prefetched, {misses} waited for, {overlap:.0%} of the transfer time overlapped with compute".format(**weight_streamer.get_stats()))
+            self.model.weight_streamer = None
+
     def partially_unload(self, device_to, memory_to_free=0):
         with self.use_ejected():
             hooks_unpatched = False
@@ -805,6 +861,9 @@ class ModelPatcher:
                         if cast_weight:
                             m.prev_comfy_cast_weights = m.comfy_cast_weights
                             m.comfy_cast_weights = True
+                            weight_streamer = self._weight_streamer(self.model.device)
+                            if weight_streamer is not None:
+                                m.comfy_weight_streamer = weight_streamer
                         m.comfy_patched_weights = False
                         memory_freed += module_mem
                         logging.debug("freed {}".format(n))
@@ -857,6 +916,10 @@ class ModelPatcher:
 
     def cleanup(self):
         self.clean_hooks()
+        weight_streamer = getattr(self.model, "weight_streamer", None)
+        if weight_streamer is not None:
+            # The copies prefetched for the next step would stay on the device until the model runs again
+            weight_streamer.drop_pending()
         if hasattr(self.model, "current_patcher"):
             self.model.current_patcher = None
         for callback in self.get_all_callbacks(CallbacksMP.ON_CLEANUP):
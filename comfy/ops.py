@@ -38,6 +38,17 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
         if device is None:
             device = input.device
 
+    weight_streamer = getattr(s, "comfy_weight_streamer", None)
+    if weight_streamer is not None and weight_streamer.device == device:
+        # Prefetched copies, the weight functions can modify them
+        weight, bias = weight_streamer.get(s, dtype, bias_dtype)
+        if bias is not None:
+            for f in s.bias_function:
+                bias = f(bias)
+        for f in s.weight_function:
+            weight = f(weight)
+        return weight, bias
+
     offload_stream = comfy.model_management.get_offload_stream(device)
     if offload_stream is not None:
         wf_context = offload_stream
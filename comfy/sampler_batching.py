@@ -0,0 +1,225 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import Optional
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+# How long the first model call of a batch waits for the calls of the other prompts.
+BATCH_WINDOW = 0.05
+# transformer_options that are per call and are concatenated when calls are merged, the others must be equal.
+MERGED_OPTIONS = ("cond_or_uncond", "uuids", "sigmas")
+# Tensors in transformer_options up to this number of elements (sigma schedules) are compared by value.
+MAX_OPTION_TENSOR_SIZE = 1024
+
+
+class _Call:
+    def __init__(self, x, t, c):
+        self.x = x
+        self.t = t
+        self.c = c
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class _Batch:
+    def __init__(self):
+        self.calls = []
+
+
+def _option_key(v):
+    """A hashable key of a transformer_options value, equal for the values model calls can share."""
+    if isinstance(v, torch.Tensor):
+        if v.numel() <= MAX_OPTION_TENSOR_SIZE:
+            return (tuple(v.shape), v.dtype, v.device, tuple(v.reshape(-1).tolist()))
+        return id(v)
+    if isinstance(v, dict):
+        return tuple((k, _option_key(o)) for k, o in v.items())
+    if isinstance(v, (list, tuple)):
+        return tuple(_option_key(o) for o in v)
+    try:
+        hash(v)
+    except TypeError:
+        return id(v)
+    return v
+
+
+def batch_key(model, x, t, c):
+    """What model calls must have in common to be run as one batch, or None if this one can't be."""
+    if c.get("control", None) is not None or t.shape[0] != x.shape[0]:
+        return None
+    transformer_options = c.get("transformer_options", {})
+    for k in ("patches", "patches_replace", "wrappers"):
+        if len(transformer_options.get(k, {})) > 0:
+            return None
+    key = [id(model), getattr(model, "current_weight_patches_uuid", None), tuple(x.shape[1:]), x.dtype, x.device]
+    # The merged call gets the transformer_options of the first one
+    key.append(tuple((k, _option_key(v)) for k, v in transformer_options.items() if k not in MERGED_OPTIONS))
+    for k in sorted(c.keys()):
+        v = c[k]
+        if k == "transformer_options":
+            continue
+        if isinstance(v, torch.Tensor):
+            if v.ndim == 0 or v.shape[0] != x.shape[0]:
+                return None
+            key.append((k, tuple(v.shape[1:]), v.dtype, v.device))
+        else:
+            try:
+                hash(v)
+            except TypeError:
+                return None
+            key.append((k, v))
+    return tuple(key)
+
+
+def _merge(calls):
+    x = torch.cat([call.x for call in calls])
+    t = torch.cat([call.t for call in calls])
+    c = {}
+    for k, v in calls[0].c.items():
+        if isinstance(v, torch.Tensor):
+            c[k] = torch.cat([call.c[k] for call in calls])
+        elif k == "transformer_options":
+            transformer_options = v.copy()
+            transformer_options["cond_or_uncond"] = [i for call in calls for i in call.c[k].get("cond_or_uncond", [])]
+            transformer_options["uuids"] = [u for call in calls for u in call.c[k].get("uuids", [])]
+            if "sigmas" in v:
+                transformer_options["sigmas"] = torch.cat([call.c[k]["sigmas"] for call in calls])
+            c[k] = transformer_options
+        else:
+            c[k] = v
+    return x, t, c
+
+
+class ModelCallBatcher:
+    """
+    Merges the model calls of prompts that are sampled at the same time by different prompt workers.
+
+    Each prompt keeps its own sampling loop, seed and conds; only the calls to the diffusion model
+    are batched. A call waits up to BATCH_WINDOW for the calls with the same model, latent shape,
+    cond shapes and transformer_options (so the same sigma schedule) of the other threads that are
+    sampling with this model, the merged batch is run by the thread that started it and the output
+    is split back.
+    """
+    def __init__(self, max_batch, window=BATCH_WINDOW):
+        self.max_batch = max_batch
+        self.window = window
+        self.lock = threading.Condition()
+        # thread -> [model, key of its last call]
+        self.active = {}
+        self.open = {}
+        self.calls = 0
+        self.batched_calls = 0
+
+    @contextlib.contextmanager
+    def sampling(self, model):
+        thread = threading.get_ident()
+        with self.lock:
+            self.active[thread] = [id(model), None]
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.pop(thread, None)
+                self.lock.notify_all()
+
+    def _expected(self, model, key):
+        """Threads that could join a batch for key."""
+        return sum(1 for m, k in self.active.values() if m == id(model) and (k is None or k == key)) - 1
+
+    def apply_model(self, model, x, t, c):
+        thread = threading.get_ident()
+        key = batch_key(model, x, t, c)
+        if key is None or thread not in self.active:
+            return model.apply_model(x, t, **c)
+
+        call = _Call(x, t, c)
+        with self.lock:
+            self.calls += 1
+            self.active[thread][1] = key
+            batch = self.open.get(key, None)
+            if batch is not None and len(batch.calls) < self.max_batch:
+                batch.calls.append(call)
+                self.lock.notify_all()
+                while not call.done:
+                    self.lock.wait()
+                if call.error is not None:
+                    raise call.error
+                return call.result
+
+            batch = self.open[key] = _Batch()
+            batch.calls.append(call)
+            deadline = time.perf_counter() + self.window
+            while len(batch.calls) < self.max_batch and len(batch.calls) - 1 < self._expected(model, key):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            if self.open.get(key, None) is batch:
+                del self.open[key]
+
+        try:
+            self._run(model, batch.calls)
+        finally:
+            with self.lock:
+                self.lock.notify_all()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, model, calls):
+        try:
+            if len(calls) > 1:
+                x, t, c = _merge(calls)
+                cond_shapes = {k: [v.shape] for k, v in c.items() if isinstance(v, torch.Tensor)}
+                if model.memory_required(x.shape, cond_shapes=cond_shapes) * 1.5 < comfy.model_management.get_free_memory(x.device):
+                    logging.debug("Running the model calls of {} prompts as one batch of {}".format(len(calls), x.shape[0]))
+                    out = model.apply_model(x, t, **c)
+                    self.batched_calls += len(calls)
+                    for call, o in zip(calls, out.split([call.x.shape[0] for call in calls])):
+                        call.result = o
+                        call.done = True
+                    return
+            for call in calls:
+                call.result = model.apply_model(call.x, call.t, **call.c)
+                call.done = True
+        except Exception as e:
+            for call in calls:
+                if not call.done:
+                    call.error = e
+                    call.done = True
+
+    def get_stats(self):
+        with self.lock:
+            return {"calls": self.calls, "batched_calls": self.batched_calls}
+
+
+model_call_batcher: Optional[ModelCallBatcher] = None
+model_call_batcher_lock = threading.Lock()
+
+def get_model_call_batcher() -> Optional[ModelCallBatcher]:
+    global model_call_batcher
+    if args.batch_prompts <= 1:
+        return None
+    with model_call_batcher_lock:
+        if model_call_batcher is None:
+            model_call_batcher = ModelCallBatcher(args.batch_prompts)
+        return model_call_batcher
+
+def sampling(model):
+    """Context for a sampling run with model, its model calls can be batched with those of other threads."""
+    batcher = get_model_call_batcher()
+    if batcher is None:
+        return contextlib.nullcontext()
+    return batcher.sampling(model)
+
+def apply_model(model, x, t, c):
+    batcher = get_model_call_batcher()
+    if batcher is None:
+        return model.apply_model(x, t, **c)
+    return batcher.apply_model(model, x, t, c)
@@ -9,9 +9,12 @@ if TYPE_CHECKING:
 import torch
 from functools import partial
 import collections
+import contextlib
+import weakref
 from comfy import model_management
 import math
 import logging
+import comfy.sampler_batching
 import comfy.sampler_helpers
 import comfy.model_patcher
 import comfy.patcher_extension
@@ -198,6 +201,155 @@ def finalize_default_conds(model: 'BaseModel', hooked_to_run: dict[comfy.hooks.H
             hooked_to_run.setdefault(p.hooks, list())
             hooked_to_run[p.hooks] += [(p, i)]
 
+class CondBatchPlanner:
+    """
+    Decides which conds are concatenated into each model call of _calc_cond_batch. The partition
+    only depends on the conds that apply (hooks, areas, controls, shapes) and the memory, so it is
+    computed once per sampling run and only recomputed when those change instead of at every step.
+
+    The memory a batch needs is estimated with model.memory_required times a safety factor. Until
+    the real peak memory use of the model was measured (on the first step of a plan, CUDA only) the
+    factor is MEMORY_SAFETY_FACTOR, after that it is the highest observed ratio plus a margin.
+    """
+    MEMORY_SAFETY_FACTOR = 1.5
+    CALIBRATION_MARGIN = 1.1
+    # Guiders calling calc_cond_batch with different sets of conds each get their plan
+    MAX_PLANS = 16
+    # Highest ratio of the measured peak memory use to memory_required for each model
+    memory_ratios = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        self.plans = {}
+        self.calibrate = False
+
+    @staticmethod
+    def signature(to_run, x_in):
+        sig = [tuple(x_in.shape), x_in.dtype]
+        for p, i in to_run:
+            area = tuple(p.area) if p.area is not None else None
+            cond_shapes = tuple((k, tuple(v.size())) for k, v in p.conditioning.items())
+            sig.append((i, tuple(p.input_x.shape), area, id(p.control), id(p.patches), cond_shapes))
+        return tuple(sig)
+
+    def memory_factor(self, model):
+        ratio = self.memory_ratios.get(model, None)
+        if ratio is None:
+            return self.MEMORY_SAFETY_FACTOR
+        return ratio * self.CALIBRATION_MARGIN
+
+    @staticmethod
+    def memory_required(model, to_run, batch):
+        first_shape = to_run[batch[0]][0].input_x.shape
+        input_shape = [len(batch) * first_shape[0]] + list(first_shape)[1:]
+        cond_shapes = collections.defaultdict(list)
+        for tt in batch:
+            for k, v in to_run[tt][0].conditioning.items():
+                cond_shapes[k].append(v.size())
+        return model.memory_required(input_shape, cond_shapes=cond_shapes)
+
+    def plan(self, model, hooks, to_run, x_in):
+        """Batches of indices in to_run, in the order they are run."""
+        key = (hooks, self.signature(to_run, x_in))
+        batches = self.plans.get(key, None)
+        if batches is not None:
+            return batches
+
+        free_memory = model_management.get_free_memory(x_in.device)
+        factor = self.memory_factor(model)
+        batches = []
+        remaining = list(range(len(to_run)))
+        while len(remaining) > 0:
+            first = to_run[remaining[0]][0]
+            to_batch_temp = [x for x in remaining if can_concat_cond(to_run[x][0], first)]
+            to_batch_temp.reverse()
+            to_batch = to_batch_temp[:1]
+            for i in range(1, len(to_batch_temp) + 1):
+                batch_amount = to_batch_temp[:len(to_batch_temp)//i]
+                if self.memory_required(model, to_run, batch_amount) * factor < free_memory:
+                    to_batch = batch_amount
+                    break
+            for x in to_batch:
+                remaining.remove(x)
+            batches.append(to_batch)
+
+        if len(self.plans) >= self.MAX_PLANS:
+            self.plans.clear()
+        self.plans[key] = batches
+        self.calibrate = True
+        logging.debug("Cond batch plan: {} conds in {} model calls of {} (memory factor {:.2f}, {:.1f} MB free)".format(len(to_run), len(batches), [len(b) for b in batches], factor, free_memory / (1024 * 1024)))
+        return batches
+
+    @contextlib.contextmanager
+    def measure(self, model, to_run, batch, device):
+        """Updates the memory ratio of the model with the peak memory use of a model call."""
+        if not self.calibrate or not model_management.is_device_cuda(device):
+            yield
+            return
+        torch.cuda.reset_peak_memory_stats(device)
+        allocated = torch.cuda.memory_allocated(device)
+        yield
+        required = self.memory_required(model, to_run, batch)
+        if required > 0:
+            ratio = (torch.cuda.max_memory_allocated(device) - allocated) / required
+            if ratio > self.memory_ratios.get(model, 0.0):
+                self.memory_ratios[model] = ratio
+
+    def out_of_memory(self, model):
+        """A batch didn't fit: be more conservative and plan again."""
+        self.memory_ratios[model] = self.memory_factor(model) * 1.5
+        self.plans.clear()
+
+    def step_done(self):
+        self.calibrate = False
+
+
+class UncondCache:
+    """
+    Skips the uncond model evaluations of sampling_function when the guidance changes slowly.
+
+    The difference between the cond and the uncond prediction of an evaluation is kept, and for up
+    to interval - 1 of the following evaluations with a sigma between sigma_end and sigma_start the
+    uncond is left out of the model call and predicted from the cond instead: with the last
+    difference, or if extrapolate is set, with the difference extrapolated linearly in sigma from
+    the last two evaluations that ran it.
+    """
+    def __init__(self, interval=2, sigma_start=float("inf"), sigma_end=0.0, extrapolate=False):
+        self.interval = max(int(interval), 1)
+        self.sigma_start = sigma_start
+        self.sigma_end = sigma_end
+        self.extrapolate = extrapolate
+        # (sigma, cond_pred - uncond_pred) of the last evaluations that ran the uncond
+        self.history = []
+        self.skipped_since = 0
+        self.computed = 0
+        self.skipped = 0
+
+    def can_skip(self, x, sigma):
+        if self.skipped_since + 1 >= self.interval or len(self.history) == 0:
+            return False
+        if self.history[-1][1].shape != x.shape:
+            return False
+        return self.sigma_end <= sigma <= self.sigma_start
+
+    def predict_uncond(self, sigma, cond_pred):
+        s1, delta = self.history[-1]
+        if self.extrapolate and len(self.history) > 1:
+            s0, delta0 = self.history[-2]
+            if s0 != s1:
+                delta = delta + (delta - delta0) * ((sigma - s1) / (s1 - s0))
+        self.skipped_since += 1
+        self.skipped += 1
+        return cond_pred - delta
+
+    def update(self, sigma, cond_pred, uncond_pred):
+        self.history = self.history[-1:] + [(sigma, cond_pred - uncond_pred)]
+        self.skipped_since = 0
+        self.computed += 1
+
+    def get_stats(self):
+        return {"computed": self.computed, "skipped": self.skipped}
+
+
 def calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Tensor, timestep, model_options):
     executor = comfy.patcher_extension.WrapperExecutor.new_executor(
         _calc_cond_batch,
@@ -239,33 +391,16 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
 
     model.current_patcher.prepare_state(timestep)
 
+    # Reused for the whole sampling run when the sampler sets it, see CFGGuider.inner_sample
+    planner = model_options.get("cond_batch_planner", None)
+    if planner is None:
+        planner = CondBatchPlanner()
+
     # run every hooked_to_run separately
     for hooks, to_run in hooked_to_run.items():
-        while len(to_run) > 0:
-            first = to_run[0]
-            first_shape = first[0][0].shape
-            to_batch_temp = []
-            for x in range(len(to_run)):
-                if can_concat_cond(to_run[x][0], first[0]):
-                    to_batch_temp += [x]
-
-            to_batch_temp.reverse()
-            to_batch = to_batch_temp[:1]
-
-            free_memory = model_management.get_free_memory(x_in.device)
-            for i in range(1, len(to_batch_temp) + 1):
-                batch_amount = to_batch_temp[:len(to_batch_temp)//i]
-                input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
-                cond_shapes = collections.defaultdict(list)
-                for tt in batch_amount:
-                    cond = {k: v.size() for k, v in to_run[tt][0].conditioning.items()}
-                    for k, v in to_run[tt][0].conditioning.items():
-                        cond_shapes[k].append(v.size())
-
-                if model.memory_required(input_shape, cond_shapes=cond_shapes) * 1.5 < free_memory:
-                    to_batch = batch_amount
-                    break
-
+        batches = list(planner.plan(model, hooks, to_run, x_in))
+        while len(batches) > 0:
+            to_batch = batches.pop(0)
             input_x = []
             mult = []
             c = []
@@ -275,7 +410,7 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
             control = None
             patches = None
             for x in to_batch:
-                o = to_run.pop(x)
+                o = to_run[x]
                 p = o[0]
                 input_x.append(p.input_x)
                 mult.append(p.mult)
@@ -319,10 +454,21 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
             if control is not None:
                 c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
 
-            if 'model_function_wrapper' in model_options:
-                output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
-            else:
-                output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
+            try:
+                with planner.measure(model, to_run, to_batch, x_in.device):
+                    if 'model_function_wrapper' in model_options:
+                        output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
+                    else:
+                        output = comfy.sampler_batching.apply_model(model, input_x, timestep_, c).chunk(batch_chunks)
+            except model_management.OOM_EXCEPTION:
+                if len(to_batch) == 1 or model_management.OOM_EXCEPTION is Exception:
+                    raise
+                logging.warning("Ran out of memory running {} conds at once, splitting the batch.".format(len(to_batch)))
+                planner.out_of_memory(model)
+                model_management.soft_empty_cache()
+                half = len(to_batch) // 2
+                batches = [to_batch[:half], to_batch[half:]] + batches
+                continue
 
             for o in range(batch_chunks):
                 cond_index = cond_or_uncond[o]
@@ -340,6 +486,7 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
                     out_c += output[o] * mult[o]
                     out_cts += mult[o]
 
+    planner.step_done()
     for i in range(len(out_conds)):
         out_conds[i] /= out_counts[i]
 
@@ -372,12 +519,25 @@ def sampling_function(model, x, timestep, uncond, cond, cond_scale, model_option
     else:
         uncond_ = uncond
 
+    uncond_cache = model_options.get("uncond_cache", None) if uncond_ is not None else None
+    sigma = None
+    skip_uncond = False
+    if uncond_cache is not None:
+        sigma = float(timestep[0])
+        skip_uncond = uncond_cache.can_skip(x, sigma)
+
     conds = [cond, uncond_]
+    run_conds = [cond, None] if skip_uncond else conds
     if "sampler_calc_cond_batch_function" in model_options:
-        args = {"conds": conds, "input": x, "sigma": timestep, "model": model, "model_options": model_options}
+        args = {"conds": run_conds, "input": x, "sigma": timestep, "model": model, "model_options": model_options}
         out = model_options["sampler_calc_cond_batch_function"](args)
     else:
-        out = calc_cond_batch(model, conds, x, timestep, model_options)
+        out = calc_cond_batch(model, run_conds, x, timestep, model_options)
+
+    if skip_uncond:
+        out = [out[0], uncond_cache.predict_uncond(sigma, out[0])]
+    elif uncond_cache is not None:
+        uncond_cache.update(sigma, out[0], out[1])
 
     for fn in model_options.get("sampler_pre_cfg_function", []):
         args = {"conds":conds, "conds_out": out, "cond_scale": cond_scale, "timestep": timestep,
@@ -934,6 +1094,7 @@ class CFGGuider:
         self.model_options = model_patcher.model_options
         self.original_conds = {}
         self.cfg = 1.0
+        self.uncond_cache = None
 
     def set_conds(self, positive, negative):
         self.inner_set_conds({"positive": positive, "negative": negative})
@@ -941,6 +1102,10 @@ class CFGGuider:
     def set_cfg(self, cfg):
         self.cfg = cfg
 
+    def set_uncond_cache(self, interval, sigma_start=float("inf"), sigma_end=0.0, extrapolate=False):
+        """Reuse the uncond prediction for interval - 1 of every interval model evaluations with a sigma in the range, see UncondCache."""
+        self.uncond_cache = {"interval": interval, "sigma_start": sigma_start, "sigma_end": sigma_end, "extrapolate": extrapolate}
+
     def inner_set_conds(self, conds):
         for k in conds:
             self.original_conds[k] = comfy.sampler_helpers.convert_cond(conds[k])
@@ -959,6 +1124,11 @@ class CFGGuider:
 
         extra_model_options = comfy.model_patcher.create_model_options_clone(self.model_options)
         extra_model_options.setdefault("transformer_options", {})["sample_sigmas"] = sigmas
+        extra_model_options["cond_batch_planner"] = CondBatchPlanner()
+        uncond_cache = None
+        uncond_cache_options = self.uncond_cache if self.uncond_cache is not None else self.model_options.get("uncond_cache_options", None)
+        if uncond_cache_options is not None:
+            uncond_cache = extra_model_options["uncond_cache"] = UncondCache(**uncond_cache_options)
         extra_args = {"model_options": extra_model_options, "seed": seed}
 
         executor = comfy.patcher_extension.WrapperExecutor.new_class_executor(
@@ -967,6 +1137,8 @@ class CFGGuider:
             comfy.patcher_extension.get_all_wrappers(comfy.patcher_extension.WrappersMP.SAMPLER_SAMPLE, extra_args["model_options"], is_model_options=True)
         )
         samples = executor.execute(self, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
+        if uncond_cache is not None:
+            logging.info("Uncond cache: skipped {} of {} uncond model evaluations".format(uncond_cache.skipped, uncond_cache.skipped + uncond_cache.computed))
         return self.inner_model.process_latent_out(samples.to(torch.float32))
 
     def outer_sample(self, noise, latent_image, sampler, sigmas, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
@@ -983,7 +1155,8 @@ class CFGGuider:
 
         try:
             self.model_patcher.pre_run()
-            output = self.inner_sample(noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed)
+            with comfy.sampler_batching.sampling(self.inner_model):
+                output = self.inner_sample(noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed)
         finally:
             self.model_patcher.cleanup()
 
@@ -21,6 +21,8 @@ import math
 import os
 
 import comfy.utils
+import comfy.weight_dedup
+import comfy.weight_loader
 
 from . import clip_vision
 from . import gligen
@@ -247,7 +249,7 @@ class CLIP:
 
     def load_sd(self, sd, full_model=False):
         if full_model:
-            return self.cond_stage_model.load_state_dict(sd, strict=False)
+            return comfy.weight_loader.load_state_dict(self.cond_stage_model, sd)
         else:
             return self.cond_stage_model.load_sd(sd)
 
@@ -464,7 +466,7 @@ class VAE:
             self.first_stage_model = AutoencoderKL(**(config['params']))
         self.first_stage_model = self.first_stage_model.eval()
 
-        m, u = self.first_stage_model.load_state_dict(sd, strict=False)
+        m, u = comfy.weight_loader.load_state_dict(self.first_stage_model, sd)
         if len(m) > 0:
             logging.warning("Missing VAE keys {}".format(m))
 
@@ -482,6 +484,7 @@ class VAE:
         self.output_device = model_management.intermediate_device()
 
         self.patcher = comfy.model_patcher.ModelPatcher(self.first_stage_model, load_device=self.device, offload_device=offload_device)
+        comfy.weight_dedup.deduplicate(self.patcher)
         logging.info("VAE load device: {}, offload device: {}, dtype: {}".format(self.device, offload_device, self.vae_dtype))
 
     def throw_exception_if_invalid(self):
@@ -763,7 +766,11 @@ def load_clip(ckpt_paths, embedding_directory=None, clip_type=CLIPType.STABLE_DI
     clip_data = []
     for p in ckpt_paths:
         clip_data.append(comfy.utils.load_torch_file(p, safe_load=True))
-    return load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    clip = load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    for p in ckpt_paths:
+        model_management.register_model_file(clip.patcher, p)
+    comfy.weight_dedup.deduplicate(clip.patcher)
+    return clip
 
 
 class TEModel(Enum):
@@ -1013,6 +1020,11 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options, metadata=metadata)
     if out is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}\n{}".format(ckpt_path, model_detection_error_hint(ckpt_path, sd)))
+    model_patcher, clip, vae, _ = out
+    for m in (model_patcher, getattr(clip, "patcher", None), getattr(vae, "patcher", None)):
+        if m is not None:
+            model_management.register_model_file(m, ckpt_path)
+            comfy.weight_dedup.deduplicate(m)
     return out
 
 def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}, metadata=None):
@@ -1185,6 +1197,8 @@ def load_diffusion_model(unet_path, model_options={}):
     if model is None:
         logging.error("ERROR UNSUPPORTED DIFFUSION MODEL {}".format(unet_path))
         raise RuntimeError("ERROR: Could not detect model type of: {}\n{}".format(unet_path, model_detection_error_hint(unet_path, sd)))
+    model_management.register_model_file(model, unet_path)
+    comfy.weight_dedup.deduplicate(model)
     return model
 
 def load_unet(unet_path, dtype=None):
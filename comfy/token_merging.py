@@ -0,0 +1,237 @@
+import logging
+import threading
+
+import torch
+
+# Every stride-th token is a destination the other tokens can be merged into.
+DST_STRIDE = 4
+# Largest number of similarity scores computed at once when matching tokens.
+MAX_SCORES = 32 * 1024 * 1024
+
+
+def _expand_index(index, t):
+    return index.reshape(index.shape + (1,) * (t.ndim - index.ndim)).expand(index.shape + t.shape[index.ndim:])
+
+
+class TokenMerge:
+    """
+    Bipartite soft matching (ToMe) of the tokens of a batch of sequences [B, N, C].
+
+    The tokens are split into destinations (one every stride tokens) and sources, each source is
+    matched with its most similar destination and the r most similar sources are merged (averaged)
+    into their destination. merge() gives [B, N - r, C]: the unmerged sources then the
+    destinations, unmerge() puts the tokens back at their place, the merged sources getting the
+    value of their destination. Everything is batched, each sequence has its own matching.
+    """
+    def __init__(self, x, r, stride=DST_STRIDE):
+        B, N, C = x.shape
+        self.N = N
+        positions = torch.arange(N, device=x.device)
+        is_dst = positions % stride == 0
+        self.dst_pos = positions[is_dst]
+        self.src_pos = positions[~is_dst]
+        r = max(min(r, self.src_pos.shape[0]), 0)
+
+        metric = x / x.norm(dim=-1, keepdim=True).clamp(min=1e-6)
+        a = metric[:, self.src_pos]
+        b = metric[:, self.dst_pos].transpose(1, 2)
+        chunk = max(MAX_SCORES // max(B * b.shape[-1], 1), 1)
+        node_max = []
+        node_idx = []
+        for i in range(0, a.shape[1], chunk):
+            m, idx = (a[:, i:i + chunk] @ b).max(dim=-1)
+            node_max.append(m)
+            node_idx.append(idx)
+        node_max = torch.cat(node_max, dim=1)
+        node_idx = torch.cat(node_idx, dim=1)
+
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        self.unm_idx = edge_idx[:, r:]
+        self.src_idx = edge_idx[:, :r]
+        self.dst_idx = node_idx.gather(1, self.src_idx)
+        self.r = r
+
+    def merged_tokens(self):
+        return self.N - self.r
+
+    def kept_positions(self):
+        """[B, N - r] positions in the original sequence of the tokens of a merged sequence."""
+        unm = self.src_pos[self.unm_idx]
+        return torch.cat((unm, self.dst_pos.expand(unm.shape[0], -1)), dim=1)
+
+    def merge(self, x):
+        a = x[:, self.src_pos]
+        b = x[:, self.dst_pos]
+        unm = a.gather(1, _expand_index(self.unm_idx, a))
+        src = a.gather(1, _expand_index(self.src_idx, a))
+        dst = b.scatter_reduce(1, _expand_index(self.dst_idx, src), src, reduce="mean", include_self=True)
+        return torch.cat((unm, dst), dim=1)
+
+    def unmerge(self, x):
+        unm_len = self.unm_idx.shape[1]
+        unm = x[:, :unm_len]
+        dst = x[:, unm_len:]
+        src = dst.gather(1, _expand_index(self.dst_idx, dst))
+        out = x.new_empty((x.shape[0], self.N) + x.shape[2:])
+        out[:, self.dst_pos] = dst
+        out.scatter_(1, _expand_index(self.src_pos[self.unm_idx], unm), unm)
+        out.scatter_(1, _expand_index(self.src_pos[self.src_idx], src), src)
+        return out
+
+    def gather_sequence(self, t, dim, start=0):
+        """
+        Keeps the entries of t (positional embeddings, attention masks) along dim for the tokens of
+        the merged sequence, the N tokens being at start in that dimension.
+        """
+        dim = dim % t.ndim
+        t = t.movedim(dim, 1)
+        kept = self.kept_positions() + start
+        B = kept.shape[0]
+        device = kept.device
+        index = torch.cat((torch.arange(start, device=device).expand(B, -1), kept,
+                           torch.arange(start + self.N, t.shape[1], device=device).expand(B, -1)), dim=1)
+        t = t.expand((B,) + t.shape[1:])
+        return t.gather(1, _expand_index(index, t)).movedim(1, dim)
+
+
+class TokenLayout:
+    """
+    Where the image tokens are in the arguments of the "dit" patches_replace of a kind of block.
+
+    The image tokens are args["img"], or for joint blocks a part of it, the text tokens being
+    before (txt_first) or after them. pe is the dimension of the tokens in args["pe"] if there is
+    one, which also has the text tokens if txt_in_pe.
+    """
+    def __init__(self, blocks, pe=None, txt_first=True, txt_in_pe=True, joint=False, mask="attn_mask", modulation_dims=()):
+        self.blocks = blocks
+        self.pe = pe
+        self.txt_first = txt_first
+        self.txt_in_pe = txt_in_pe
+        self.joint = joint
+        self.mask = mask
+        self.modulation_dims = modulation_dims
+
+
+# Diffusion model class (or base class) name -> {block kind: TokenLayout}
+TOKEN_LAYOUTS = {
+    "Flux": {"double_block": TokenLayout("double_blocks", pe=2),
+             "single_block": TokenLayout("single_blocks", pe=2, joint=True)},
+    "HunyuanVideo": {"double_block": TokenLayout("double_blocks", pe=2, txt_first=False, mask="attention_mask", modulation_dims=("modulation_dims_img",)),
+                     "single_block": TokenLayout("single_blocks", pe=2, txt_first=False, joint=True, mask="attention_mask", modulation_dims=("modulation_dims",))},
+    "WanModel": {"double_block": TokenLayout("blocks", pe=1, txt_in_pe=False)},
+    "MMDiT": {"double_block": TokenLayout("joint_blocks")},
+}
+
+
+def token_layouts(diffusion_model):
+    for c in type(diffusion_model).__mro__:
+        layouts = TOKEN_LAYOUTS.get(c.__name__, None)
+        if layouts is not None:
+            return layouts
+    return None
+
+
+class _TokenMergePatch:
+    def __init__(self, merging, layout, ratio, previous):
+        self.merging = merging
+        self.layout = layout
+        self.ratio = ratio
+        self.previous = previous
+
+    def __call__(self, args, extra_args):
+        if self.previous is not None:
+            run = lambda a: self.previous(a, extra_args)
+        else:
+            run = extra_args["original_block"]
+        return self.merging.block(self.layout, self.ratio, args, run)
+
+
+class TokenMerging:
+    """
+    Merges the most similar image tokens before the blocks of DiT models and unmerges the residual
+    the blocks add to them, so attention and MLPs run on fewer tokens. Each block has its ratio of
+    the image tokens merged.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def _mergeable(self, layout, args):
+        if any(args.get(k, None) is not None for k in layout.modulation_dims):
+            return False
+        vec = args.get("vec", None)
+        if isinstance(vec, torch.Tensor) and vec.ndim > 3:
+            # Per token modulation
+            return False
+        mask = args.get(layout.mask, None)
+        if mask is not None and mask.shape[-2] != 1:
+            return False
+        if layout.joint:
+            txt_len = getattr(self.local, "txt_len", None)
+            img_len = getattr(self.local, "img_len", None)
+            return txt_len is not None and img_len is not None and args["img"].shape[1] == txt_len + img_len
+        return True
+
+    def block(self, layout, ratio, args, run):
+        if not layout.joint:
+            txt = args.get("txt", None)
+            self.local.img_len = args["img"].shape[1]
+            self.local.txt_len = txt.shape[1] if txt is not None and txt.ndim == 3 else 0
+        if ratio <= 0 or not self._mergeable(layout, args):
+            return run(args)
+
+        tokens = args["img"]
+        txt_len = self.local.txt_len
+        img_len = self.local.img_len
+        start = txt_len if layout.joint and layout.txt_first else 0
+        x = tokens[:, start:start + img_len]
+        tm = TokenMerge(x, int(img_len * ratio))
+        merged = torch.cat((tokens[:, :start], tm.merge(x), tokens[:, start + img_len:]), dim=1)
+
+        new_args = dict(args)
+        # The sequence the positional embeddings and masks are for
+        seq_start = start if layout.joint else (txt_len if layout.txt_first and layout.txt_in_pe else 0)
+        if layout.pe is not None and args.get("pe", None) is not None:
+            new_args["pe"] = tm.gather_sequence(args["pe"], layout.pe, seq_start)
+        if args.get(layout.mask, None) is not None:
+            new_args[layout.mask] = tm.gather_sequence(args[layout.mask], -1, seq_start)
+
+        # Blocks can update their input in place
+        new_args["img"] = merged.clone()
+        out = dict(run(new_args))
+        delta = out["img"] - merged
+        m = tm.merged_tokens()
+        delta = torch.cat((delta[:, :start], tm.unmerge(delta[:, start:start + m]), delta[:, start + m:]), dim=1)
+        out["img"] = tokens + delta
+        return out
+
+
+def apply_token_merging(model_patcher, ratios):
+    """
+    A clone of model_patcher with token merging in the blocks of its diffusion model. ratios is a
+    list of (first block, last block, ratio), the blocks being numbered in the order they run
+    (double then single blocks) and -1 meaning the last one.
+    """
+    diffusion_model = model_patcher.get_model_object("diffusion_model")
+    layouts = token_layouts(diffusion_model)
+    if layouts is None:
+        logging.warning("Token merging is not supported for {}".format(diffusion_model.__class__.__name__))
+        return model_patcher.clone()
+
+    merging = TokenMerging()
+    m = model_patcher.clone()
+    blocks_replace = m.model_options["transformer_options"].get("patches_replace", {}).get("dit", {})
+    total = sum(len(getattr(diffusion_model, layout.blocks)) for layout in layouts.values())
+    index = 0
+    for kind, layout in layouts.items():
+        for i in range(len(getattr(diffusion_model, layout.blocks))):
+            previous = blocks_replace.get((kind, i), None)
+            ratio = 0.0
+            if isinstance(previous, _TokenMergePatch):
+                ratio = previous.ratio
+                previous = previous.previous
+            for first, last, r in ratios:
+                if first <= index <= (last if last >= 0 else total + last):
+                    ratio = r
+            m.set_model_patch_replace(_TokenMergePatch(merging, layout, ratio, previous), "dit", kind, i)
+            index += 1
+    return m
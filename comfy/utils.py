@@ -18,8 +18,12 @@
 
 
 import torch
+import hashlib
+import json
 import math
+import mmap
 import struct
+import sys
 import comfy.checkpoint_pickle
 import safetensors.torch
 import numpy as np
@@ -31,6 +35,7 @@ from einops import rearrange
 from comfy.cli_args import args
 
 MMAP_TORCH_FILES = args.mmap_torch_files
+MMAP_SAFETENSORS = not args.disable_mmap_safetensors and sys.byteorder == "little"
 
 ALWAYS_SAFE_LOAD = False
 if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in pytorch 2.4, the unsafe path should be removed once earlier versions are deprecated
@@ -49,11 +54,68 @@ if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in
 else:
     logging.info("Warning, you are using an old pytorch version and some ckpt/pt files might be loaded unsafely. Upgrading to 2.4 or above is recommended.")
 
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+    "F8_E4M3": getattr(torch, "float8_e4m3fn", None),
+    "F8_E5M2": getattr(torch, "float8_e5m2", None),
+    "U16": getattr(torch, "uint16", None),
+    "U32": getattr(torch, "uint32", None),
+    "U64": getattr(torch, "uint64", None),
+}
+
+def load_safetensors_mmap(ckpt):
+    """
+    Returns the state dict of a safetensors file as tensors that are views of a copy on write memory
+    map of the file: nothing is read until the data of a tensor is used, reading the keys, shapes and
+    dtypes is free and the pages can be dropped by the OS at any time. Writing to the tensors doesn't
+    modify the file.
+    """
+    with open(ckpt, "rb") as f:
+        length_of_header = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length_of_header))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + length_of_header
+    metadata = header.pop("__metadata__", None)
+    sd = {}
+    for k in sorted(header.keys()):
+        info = header[k]
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        if dtype is None:
+            raise ValueError("Unsupported dtype {}".format(info["dtype"]))
+        start, end = info["data_offsets"]
+        if start > end or data_start + end > len(data):
+            raise ValueError("Invalid data offsets for {}".format(k))
+        if start == end:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        # One storage per tensor, like when the file is read normally
+        t = torch.frombuffer(data, dtype=torch.uint8, count=end - start, offset=data_start + start)
+        if (data_start + start) % dtype.itemsize != 0:
+            t = t.clone()  # Unaligned
+        sd[k] = t.view(dtype).reshape(info["shape"])
+    return sd, metadata
+
 def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
     if device is None:
         device = torch.device("cpu")
     metadata = None
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
+        if MMAP_SAFETENSORS and device.type == "cpu":
+            try:
+                sd, metadata = load_safetensors_mmap(ckpt)
+                return (sd, metadata) if return_metadata else sd
+            except Exception as e:
+                # Let safetensors report what is wrong with the file
+                logging.debug("Could not memory map {}: {}".format(ckpt, e))
         try:
             with safetensors.safe_open(ckpt, framework="pt", device=device.type) as f:
                 sd = {}
@@ -97,6 +159,49 @@ def save_torch_file(sd, ckpt, metadata=None):
     else:
         safetensors.torch.save_file(sd, ckpt)
 
+def tensor_digest(tensor: torch.Tensor) -> bytes:
+    """
+    Returns a digest of the shape, dtype and every element of a tensor. The digest is cached on the
+    tensor and recomputed if it is modified in place. Inference tensors don't track their
+    modifications so their digest is always computed again.
+    """
+    inference = tensor.is_inference()
+    if not inference:
+        cached = getattr(tensor, "_comfy_digest", None)
+        if cached is not None and cached[0] == tensor._version and cached[1] == tensor.data_ptr():
+            return cached[2]
+
+    h = hashlib.sha256()
+    h.update("{}:{}:".format(tuple(tensor.shape), tensor.dtype).encode())
+    h.update(tensor.detach().reshape(-1).to("cpu").contiguous().view(torch.uint8).numpy().tobytes())
+    digest = h.digest()
+    if not inference:
+        try:
+            setattr(tensor, "_comfy_digest", (tensor._version, tensor.data_ptr(), digest))
+        except (AttributeError, RuntimeError):
+            pass
+    return digest
+
+def module_tensors(model):
+    """(module, name, is_parameter, tensor) of the parameters and buffers of model, each tensor once."""
+    tensors = []
+    seen = set()
+    for m in model.modules():
+        for is_param, items in ((True, m._parameters), (False, m._buffers)):
+            for name, t in items.items():
+                if t is None or id(t) in seen:
+                    continue
+                seen.add(id(t))
+                tensors.append((m, name, is_param, t))
+    return tensors
+
+def set_module_tensor(m, name, is_param, t):
+    """Replaces the data of a tensor returned by module_tensors, parameters stay the same objects."""
+    if is_param:
+        m._parameters[name].data = t
+    else:
+        m._buffers[name] = t
+
 def calculate_parameters(sd, prefix=""):
     params = 0
     for k in sd.keys():
@@ -708,6 +813,25 @@ def safetensors_header(safetensors_path, max_size=100*1024*1024):
             return None
         return f.read(length_of_header)
 
+def safetensors_meta_state_dict(safetensors_path, max_size=100*1024*1024):
+    """
+    Returns (state_dict, metadata) for a safetensors file using only its header: the tensors are on the
+    meta device so they have the right keys, shapes and dtypes but no data. Enough for model detection,
+    parameter counts and weight_dtype. Returns None if the header can't be read.
+    """
+    header = safetensors_header(safetensors_path, max_size=max_size)
+    if header is None:
+        return None
+    header = json.loads(header)
+    metadata = header.pop("__metadata__", None)
+    sd = {}
+    for k in sorted(header.keys()):
+        dtype = SAFETENSORS_DTYPES.get(header[k]["dtype"], None)
+        if dtype is None:
+            dtype = torch.uint8
+        sd[k] = torch.empty(header[k]["shape"], dtype=dtype, device="meta")
+    return sd, metadata
+
 def set_attr(obj, attr, value):
     attrs = attr.split(".")
     for name in attrs[:-1]:
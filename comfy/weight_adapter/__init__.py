@@ -1,5 +1,5 @@
 from .base import WeightAdapterBase, WeightAdapterTrainBase
-from .lora import LoRAAdapter
+from .lora import LoRAAdapter, StackedLoRAAdapter
 from .loha import LoHaAdapter
 from .lokr import LoKrAdapter
 from .glora import GLoRAAdapter
@@ -19,5 +19,6 @@ adapters: list[type[WeightAdapterBase]] = [
 __all__ = [
     "WeightAdapterBase",
     "WeightAdapterTrainBase",
+    "StackedLoRAAdapter",
     "adapters"
 ] + [a.__name__ for a in adapters]
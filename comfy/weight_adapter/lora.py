@@ -204,3 +204,58 @@ class LoRAAdapter(WeightAdapterBase):
         except Exception as e:
             logging.error("ERROR {} {} {}".format(self.name, key, e))
         return weight
+
+
+class StackedLoRAAdapter(WeightAdapterBase):
+    """
+    Several plain LoRA patches of the same weight applied with a single matrix multiplication: the
+    low rank factors are concatenated along the rank dimension so the deltas are summed inside the
+    mm instead of being added to the full weight one after the other.
+    """
+    name = "stacked_lora"
+
+    def __init__(self, patches):
+        self.loaded_keys = set()
+        # list of (strength, LoRAAdapter)
+        self.weights = patches
+
+    @staticmethod
+    def stackable(adapter):
+        v = adapter.weights
+        # No locon mid weights, dora or reshape: the delta is just mat1 @ mat2
+        return type(adapter) is LoRAAdapter and v[3] is None and v[4] is None and v[5] is None
+
+    def calculate_weight(
+        self,
+        weight,
+        key,
+        strength,
+        strength_model,
+        offset,
+        function,
+        intermediate_dtype=torch.float32,
+        original_weight=None,
+    ):
+        ups = []
+        downs = []
+        for patch_strength, adapter in self.weights:
+            v = adapter.weights
+            mat1 = comfy.model_management.cast_to_device(v[0], weight.device, intermediate_dtype)
+            mat2 = comfy.model_management.cast_to_device(v[1], weight.device, intermediate_dtype)
+            if v[2] is not None:
+                alpha = v[2] / mat2.shape[0]
+            else:
+                alpha = 1.0
+            # Scale the smaller factor
+            ups.append(mat1.flatten(start_dim=1) * (strength * patch_strength * alpha))
+            downs.append(mat2.flatten(start_dim=1))
+
+        try:
+            lora_diff = torch.mm(torch.cat(ups, dim=1), torch.cat(downs, dim=0)).reshape(weight.shape)
+        except Exception:
+            # Shapes that don't line up, apply them one at a time so each gets the usual error.
+            for patch_strength, adapter in self.weights:
+                weight = adapter.calculate_weight(weight, key, strength * patch_strength, 1.0, None, function, intermediate_dtype, original_weight)
+            return weight
+        weight += function(lora_diff.type(weight.dtype))
+        return weight
@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import threading
+import weakref
+from typing import Optional
+
+import torch
+
+import comfy.host_memory
+import comfy.utils
+from comfy.cli_args import args
+
+# Elements of a tensor hashed to find the tensors it could be a duplicate of.
+SAMPLE_SIZE = 4096
+# Smaller tensors aren't worth looking up.
+MIN_BYTES = 64 * 1024
+
+MB = 1024 * 1024
+
+
+def _content_key(t: torch.Tensor):
+    h = hashlib.sha256()
+    flat = t.detach().reshape(-1)
+    if flat.numel() > SAMPLE_SIZE:
+        flat = torch.cat((flat[::flat.numel() // SAMPLE_SIZE], flat[-1:]))
+    h.update(flat.contiguous().view(torch.uint8).numpy().tobytes())
+    return (t.dtype, tuple(t.shape), h.digest())
+
+
+def is_shared(weight) -> bool:
+    """If the weight uses the same storage as the weight of another model, it must not be modified in place."""
+    return getattr(weight, "comfy_shared_weight", False) and weight.device.type == "cpu"
+
+
+class WeightDeduplicator:
+    """
+    Makes identical weights of different models (checkpoints that share a text encoder or a VAE,
+    finetunes that left some layers untouched) share one storage in RAM. Tensors are looked up by
+    dtype, shape and a hash of a sample of their content, and only shared if they are equal.
+    """
+    def __init__(self, min_bytes=MIN_BYTES):
+        self.min_bytes = min_bytes
+        self.lock = threading.Lock()
+        self.tensors = {}
+        self.tensors_shared = 0
+        self.bytes_saved = 0
+
+    def _find(self, key, t, host_memory_tier):
+        refs = self.tensors.get(key, None)
+        if refs is None:
+            return None
+        refs[:] = [r for r in refs if r() is not None]
+        for r in refs:
+            other = r()
+            if other is None or other.device != t.device or other.dtype != t.dtype or other.shape != t.shape:
+                continue
+            if host_memory_tier is not None and host_memory_tier.in_buffer(other):
+                # The buffer is given to another model once the one offloaded in it is loaded
+                continue
+            if other.data_ptr() == t.data_ptr() or torch.equal(other, t):
+                return other
+        return None
+
+    def deduplicate(self, model):
+        """Shares the cpu weights of the torch model with identical weights of the models seen before."""
+        shared = 0
+        saved = 0
+        host_memory_tier = comfy.host_memory.get_host_memory_tier()
+        with self.lock:
+            for m, name, is_param, t in comfy.utils.module_tensors(model):
+                if t.device.type != "cpu" or t.nbytes < self.min_bytes or t.is_sparse:
+                    continue
+                key = _content_key(t)
+                other = self._find(key, t, host_memory_tier)
+                if other is None:
+                    self.tensors.setdefault(key, []).append(weakref.ref(t))
+                    continue
+                if other.data_ptr() == t.data_ptr():
+                    continue
+                comfy.utils.set_module_tensor(m, name, is_param, other.detach())
+                t = m._parameters[name] if is_param else m._buffers[name]
+                t.comfy_shared_weight = True
+                other.comfy_shared_weight = True
+                self.tensors[key].append(weakref.ref(t))
+                shared += 1
+                saved += t.nbytes
+            self.tensors_shared += shared
+            self.bytes_saved += saved
+        if shared > 0:
+            logging.info("{} shares {} weights ({:.1f} MB) with models already in memory".format(model.__class__.__name__, shared, saved / MB))
+        return shared, saved
+
+    def get_stats(self):
+        with self.lock:
+            return {"tensors_shared": self.tensors_shared, "bytes_saved": self.bytes_saved}
+
+
+weight_deduplicator: Optional[WeightDeduplicator] = None
+weight_deduplicator_lock = threading.Lock()
+
+def get_weight_deduplicator() -> Optional[WeightDeduplicator]:
+    """Returns the shared WeightDeduplicator, or None if weights aren't deduplicated."""
+    global weight_deduplicator
+    if not args.deduplicate_weights:
+        return None
+    with weight_deduplicator_lock:
+        if weight_deduplicator is None:
+            weight_deduplicator = WeightDeduplicator()
+        return weight_deduplicator
+
+def deduplicate(patcher):
+    """Deduplicates the weights of the model of a ModelPatcher, if enabled."""
+    weight_deduplicator = get_weight_deduplicator()
+    if weight_deduplicator is not None and patcher is not None:
+        weight_deduplicator.deduplicate(patcher.model)
@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+# Large tensors are split in chunks of this many bytes so the work spreads evenly over the threads
+# and a pinned staging buffer of this size is enough for any of them.
+CHUNK_SIZE = 64 * 1024 * 1024
+PINNED_BUFFERS_PER_THREAD = 2
+
+MB = 1024 * 1024
+
+
+class LoadStats:
+    """
+    Bytes and busy time of each stage of a weight load, summed over the threads:
+    "read/cast" is the copy of the source tensors into the model dtype on the host (with a memory
+    mapped file this is where the disk is read), "transfer" is the host to device copy.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.threads = 0
+        self.total_bytes = 0
+        self.seconds = 0.0
+
+    def add(self, stage, nbytes, seconds):
+        with self.lock:
+            b, s = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (b + nbytes, s + seconds)
+
+    def throughput(self, stage=None):
+        """MB/s of the whole load, or of one stage if all the threads only did that."""
+        if stage is None:
+            return self.total_bytes / MB / max(self.seconds, 1e-9)
+        nbytes, seconds = self.stages.get(stage, (0, 0.0))
+        return nbytes / MB / max(seconds, 1e-9) * max(self.threads, 1)
+
+    def summary(self):
+        stages = ", ".join("{} {:.0f} MB/s".format(stage, self.throughput(stage)) for stage in self.stages)
+        return "{:.1f} MB of weights on {} threads in {:.2f}s ({:.0f} MB/s): {}".format(self.total_bytes / MB, self.threads, self.seconds, self.throughput(), stages)
+
+
+def _direct_copy_targets(module):
+    """
+    The parameters and persistent buffers that module.load_state_dict would simply copy_ into,
+    keyed by their state dict key. Modules with their own loading logic or hooks are left out.
+    """
+    targets = {}
+    for prefix, m in module.named_modules(remove_duplicate=False):
+        if type(m)._load_from_state_dict is not torch.nn.Module._load_from_state_dict:
+            continue
+        if len(m._load_state_dict_pre_hooks) > 0 or len(m._load_state_dict_post_hooks) > 0:
+            continue
+        if prefix != "":
+            prefix += "."
+        for name, param in m._parameters.items():
+            if param is not None:
+                targets[prefix + name] = param
+        for name, buf in m._buffers.items():
+            if buf is not None and name not in m._non_persistent_buffers_set:
+                targets[prefix + name] = buf
+    return targets
+
+
+def _chunks(dest, src):
+    if not (dest.is_contiguous() and src.is_contiguous()) or dest.numel() == 0:
+        return [(dest, src)]
+    step = max(1, CHUNK_SIZE // max(dest.element_size(), src.element_size()))
+    dest_flat = dest.view(-1)
+    src_flat = src.reshape(-1)
+    return [(dest_flat[i:i + step], src_flat[i:i + step]) for i in range(0, dest.numel(), step)]
+
+
+class _ThreadState:
+    """Pinned staging buffers and copy stream of one loader thread for host to cuda transfers."""
+    def __init__(self, device):
+        self.stream = torch.cuda.Stream(device=device)
+        self.buffers = [torch.empty(CHUNK_SIZE, dtype=torch.uint8, pin_memory=True) for _ in range(PINNED_BUFFERS_PER_THREAD)]
+        self.pending = [None] * PINNED_BUFFERS_PER_THREAD
+        self.timings = []
+        self.next = 0
+
+    def next_buffer(self):
+        i = self.next
+        self.next = (i + 1) % len(self.buffers)
+        if self.pending[i] is not None:
+            # The transfer out of this buffer has to be done before it's written again.
+            self.pending[i].synchronize()
+            self.pending[i] = None
+        return i
+
+    def finish(self, stats):
+        self.stream.synchronize()
+        for nbytes, start, end in self.timings:
+            stats.add("transfer", nbytes, start.elapsed_time(end) / 1000)
+
+
+class _Copier:
+    def __init__(self, stats):
+        self.stats = stats
+        self.inference = torch.is_inference_mode_enabled()
+        self.local = threading.local()
+        self.states = []
+        self.states_lock = threading.Lock()
+
+    def _thread_state(self, device):
+        states = getattr(self.local, "states", None)
+        if states is None:
+            states = self.local.states = {}
+        if device not in states:
+            states[device] = _ThreadState(device)
+            with self.states_lock:
+                self.states.append(states[device])
+        return states[device]
+
+    def copy(self, dest, src):
+        # Inference and grad mode are thread local.
+        with torch.no_grad(), torch.inference_mode(self.inference):
+            if src.device.type == "cpu" and comfy.model_management.is_device_cuda(dest.device) and dest.nbytes <= CHUNK_SIZE:
+                self._copy_pinned(dest, src)
+                return
+
+            start = time.perf_counter()
+            dest.copy_(src)
+            stage = "read/cast" if dest.device.type == "cpu" else "transfer"
+            self.stats.add(stage, dest.nbytes, time.perf_counter() - start)
+
+    def _copy_pinned(self, dest, src):
+        state = self._thread_state(dest.device)
+        i = state.next_buffer()
+
+        start = time.perf_counter()
+        staging = state.buffers[i][:dest.nbytes].view(dest.dtype).view(dest.shape)
+        staging.copy_(src)
+        self.stats.add("read/cast", dest.nbytes, time.perf_counter() - start)
+
+        with torch.cuda.stream(state.stream):
+            begin = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            begin.record(state.stream)
+            dest.copy_(staging, non_blocking=True)
+            end.record(state.stream)
+        state.pending[i] = end
+        state.timings.append((dest.nbytes, begin, end))
+
+    def finish(self):
+        for state in self.states:
+            state.finish(self.stats)
+
+
+def load_state_dict(module, sd, threads=None, stats=None):
+    """
+    Same as module.load_state_dict(sd, strict=False) but the tensors that only need to be copied into
+    the existing parameters are copied in chunks on a thread pool. A thread reading a memory mapped
+    file, another casting to the model dtype and another copying to the GPU through a pinned buffer
+    all make progress at the same time instead of one tensor after the other.
+    """
+    if threads is None:
+        threads = args.weight_load_threads
+    if threads <= 0:
+        return module.load_state_dict(sd, strict=False)
+    if stats is None:
+        stats = LoadStats()
+
+    targets = _direct_copy_targets(module)
+    direct = {}
+    rest = {}
+    for k, v in sd.items():
+        dest = targets.get(k, None)
+        if dest is not None and isinstance(v, torch.Tensor) and not v.is_meta and not dest.is_meta and v.shape == dest.shape:
+            direct[k] = v
+        else:
+            rest[k] = v
+
+    start = time.perf_counter()
+    work = []
+    for k, v in direct.items():
+        work.extend(_chunks(targets[k], v))
+        stats.total_bytes += targets[k].nbytes
+
+    copier = _Copier(stats)
+    stats.threads = max(1, min(threads, len(work)))
+    if stats.threads == 1:
+        for dest, src in work:
+            copier.copy(dest, src)
+    else:
+        with ThreadPoolExecutor(max_workers=stats.threads, thread_name_prefix="comfy_weight_loader") as pool:
+            for _ in pool.map(lambda w: copier.copy(*w), work):
+                pass
+    copier.finish()
+    stats.seconds = time.perf_counter() - start
+
+    result = module.load_state_dict(rest, strict=False)
+    # The weights copied on the thread pool weren't in the state dict load_state_dict got
+    result.missing_keys[:] = [k for k in result.missing_keys if k not in direct]
+
+    if stats.total_bytes >= CHUNK_SIZE:
+        logging.info("Loaded {}".format(stats.summary()))
+    elif stats.total_bytes > 0:
+        logging.debug("Loaded {}".format(stats.summary()))
+    return result
@@ -0,0 +1,158 @@
+import collections
+import hashlib
+import logging
+import threading
+import uuid
+from typing import Optional
+
+import torch
+
+import comfy.model_management
+import comfy.utils
+import comfy.weight_adapter
+from comfy.cli_args import args
+
+
+# Patch tensors up to this size (LoRA factors) are identified by their content. Larger ones (the
+# weights of another model in model merging) are identified by the tensor object and its version,
+# hashing them would take longer than applying them.
+MAX_HASHED_PATCH_BYTES = 16 * 1024 * 1024
+
+
+class UnhashablePatch(Exception):
+    pass
+
+
+def _tensor_identity(t):
+    token = getattr(t, "_comfy_patch_token", None)
+    if token is None:
+        token = uuid.uuid4().hex
+        try:
+            t._comfy_patch_token = token
+        except (AttributeError, RuntimeError):
+            raise UnhashablePatch("tensor")
+    # Inference tensors don't track their modifications
+    version = None if t.is_inference() else t._version
+    return "{}:{}".format(token, version)
+
+
+def _update_digest(h, obj):
+    if obj is None:
+        h.update(b"N")
+    elif isinstance(obj, (bool, int, float, str)):
+        h.update("{}:{!r};".format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, torch.Tensor):
+        if obj.nbytes > MAX_HASHED_PATCH_BYTES:
+            h.update("I{};".format(_tensor_identity(obj)).encode())
+        else:
+            h.update(b"T" + comfy.utils.tensor_digest(obj))
+    elif isinstance(obj, (list, tuple)):
+        h.update("({};".format(len(obj)).encode())
+        for x in obj:
+            _update_digest(h, x)
+    elif isinstance(obj, dict):
+        h.update("<{};".format(len(obj)).encode())
+        for k in sorted(obj.keys(), key=repr):
+            _update_digest(h, k)
+            _update_digest(h, obj[k])
+    elif isinstance(obj, comfy.weight_adapter.WeightAdapterBase):
+        h.update("A{};".format(type(obj).__qualname__).encode())
+        _update_digest(h, obj.weights)
+    else:
+        # Functions and anything else we can't tell apart by value
+        raise UnhashablePatch(type(obj).__name__)
+
+
+def patch_digest(patches) -> Optional[bytes]:
+    """
+    Digest of the list of patches of a weight from ModelPatcher.patches, or None if the result of
+    applying them can't be identified by value (custom functions, patches that read other weights).
+    """
+    h = hashlib.sha256()
+    try:
+        for strength_patch, patch, strength_model, offset, function in patches:
+            if function is not None:
+                return None
+            if isinstance(patch, tuple) and len(patch) == 2 and patch[0] == "model_as_lora":
+                return None
+            _update_digest(h, (strength_patch, patch, strength_model, offset))
+    except (UnhashablePatch, ValueError):
+        return None
+    return h.digest()
+
+
+class PatchedWeightCache:
+    """
+    Host RAM cache of patched weights so that loading a model again with a combination of patches
+    (LoRAs) that was used recently is a copy instead of a new calculate_weight. Entries are keyed by
+    the base model, the weight key, shape and dtype and the digest of the patches, and evicted least
+    recently used first when they use more than ram_budget bytes.
+    """
+    def __init__(self, ram_budget):
+        self.ram_budget = ram_budget
+        self.ram_used = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, model, key, patches, weight):
+        digest = patch_digest(patches)
+        if digest is None:
+            return None
+        # The weights of a base model are only ever changed through patches, which are undone before
+        # new ones are applied, so the model object identifies the unpatched weights.
+        model_token = getattr(model, "patched_weight_cache_token", None)
+        if model_token is None:
+            model_token = model.patched_weight_cache_token = uuid.uuid4().hex
+        return (model_token, key, tuple(weight.shape), weight.dtype, digest)
+
+    def get(self, cache_key, device):
+        if cache_key is None:
+            return None
+        with self.lock:
+            weight = self.entries.get(cache_key, None)
+            if weight is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+        return comfy.model_management.cast_to_device(weight, device, None, copy=True)
+
+    def put(self, cache_key, weight):
+        if cache_key is None or weight.nbytes > self.ram_budget:
+            return
+        weight = weight.to("cpu", copy=True)
+        with self.lock:
+            old = self.entries.pop(cache_key, None)
+            if old is not None:
+                self.ram_used -= old.nbytes
+            self.entries[cache_key] = weight
+            self.ram_used += weight.nbytes
+            while self.ram_used > self.ram_budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.ram_used -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ram_used = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "ram_used": self.ram_used, "ram_budget": self.ram_budget, "hits": self.hits, "misses": self.misses}
+
+
+patched_weight_cache: Optional[PatchedWeightCache] = None
+patched_weight_cache_lock = threading.Lock()
+
+def get_patched_weight_cache() -> Optional[PatchedWeightCache]:
+    """Returns the shared PatchedWeightCache, or None if patched weights shouldn't be cached."""
+    global patched_weight_cache
+    if args.lora_cache_ram <= 0:
+        return None
+    with patched_weight_cache_lock:
+        if patched_weight_cache is None:
+            patched_weight_cache = PatchedWeightCache(int(args.lora_cache_ram * 1024 * 1024 * 1024))
+            logging.info("Caching up to {} GB of patched weights in RAM".format(args.lora_cache_ram))
+        return patched_weight_cache
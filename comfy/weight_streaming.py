@@ -0,0 +1,163 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfy_weight_stream")
+        return _executor
+
+
+def _default_transfer(tensor, dtype, device, stream):
+    return comfy.model_management.cast_to(tensor, dtype, device, non_blocking=comfy.model_management.device_supports_non_blocking(device), copy=True, stream=stream)
+
+
+class _Prefetch:
+    def __init__(self, dtype, bias_dtype, future):
+        self.dtype = dtype
+        self.bias_dtype = bias_dtype
+        self.future = future
+
+
+class WeightStreamer:
+    """
+    Streams the weights of the lowvram modules of a model to the device ahead of their use.
+
+    The modules that go through cast_bias_weight are recorded in the order they run during the first
+    step. From then on, when a module runs the weights of the next lookahead modules are copied on a
+    background thread (and a separate stream on CUDA) so the copies overlap with the compute of the
+    current module instead of each layer waiting for its own copy. At most lookahead copies are
+    pending, plus the one in use: with a lookahead of 1 the device memory used is a double buffer.
+
+    transfer(tensor, dtype, device, stream) makes the device copy of a weight, it can be replaced to
+    simulate a slow device.
+    """
+    def __init__(self, device, lookahead=2, transfer: Optional[Callable] = None):
+        self.device = device
+        self.lookahead = lookahead
+        self.transfer = transfer if transfer is not None else _default_transfer
+        self.stream = None
+        if comfy.model_management.is_device_cuda(device):
+            self.stream = torch.cuda.Stream(device=device)
+        self.order = []
+        self.index = {}
+        self.recorded = False
+        self.pending = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+        self.transfer_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _copy(self, module, dtype, bias_dtype):
+        start = time.perf_counter()
+        if self.stream is not None:
+            # The weights may have been written on the main stream (patches applied in place)
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        bias = None
+        if module.bias is not None:
+            bias = self.transfer(module.bias, bias_dtype, self.device, self.stream)
+        weight = self.transfer(module.weight, dtype, self.device, self.stream)
+        event = None
+        if self.stream is not None:
+            event = self.stream.record_event()
+            event.synchronize()
+        with self.stats_lock:
+            self.transfer_seconds += time.perf_counter() - start
+        return weight, bias, event
+
+    def _record(self, module, dtype, bias_dtype):
+        if module in self.index:
+            if not self.recorded:
+                self.recorded = True
+                logging.debug("Weight streaming: recorded the order of {} modules".format(len(self.order)))
+            return
+        # Modules that only run in later steps are added at the end
+        self.index[module] = len(self.order)
+        self.order.append((module, dtype, bias_dtype))
+
+    def _prefetch(self, module):
+        i = self.index[module]
+        executor = _get_executor()
+        for j in range(1, min(self.lookahead, len(self.order) - 1) + 1):
+            m, dtype, bias_dtype = self.order[(i + j) % len(self.order)]
+            if m in self.pending or getattr(m, "comfy_weight_streamer", None) is not self:
+                # Already on its way, or it has been loaded on the device since
+                continue
+            self.pending[m] = _Prefetch(dtype, bias_dtype, executor.submit(self._copy, m, dtype, bias_dtype))
+        # Prefetches of modules that didn't run (conditional branches) are dropped
+        while len(self.pending) > self.lookahead:
+            self.pending.popitem(last=False)
+
+    def get(self, module, dtype, bias_dtype):
+        """The weight and bias of module on the device, in the requested dtypes."""
+        self._record(module, dtype, bias_dtype)
+        start = time.perf_counter()
+        prefetch = self.pending.pop(module, None)
+        if prefetch is not None:
+            weight, bias, event = prefetch.future.result()
+            if prefetch.dtype != dtype or prefetch.bias_dtype != bias_dtype:
+                prefetch = None
+        if prefetch is None:
+            self.misses += 1
+            weight, bias, event = self._copy(module, dtype, bias_dtype)
+        else:
+            self.hits += 1
+        self.wait_seconds += time.perf_counter() - start
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t in (weight, bias):
+                if t is not None:
+                    t.record_stream(current_stream)
+
+        if self.recorded:
+            self._prefetch(module)
+        return weight, bias
+
+    def overlap(self):
+        """Fraction of the transfer time that was hidden behind compute."""
+        if self.transfer_seconds <= 0:
+            return 0.0
+        return min(max(1.0 - self.wait_seconds / self.transfer_seconds, 0.0), 1.0)
+
+    def drop_pending(self):
+        """Drops the copies prefetched for modules that haven't run yet, the recorded order is kept."""
+        for prefetch in self.pending.values():
+            prefetch.future.cancel()
+        self.pending.clear()
+
+    def close(self):
+        self.drop_pending()
+
+    def get_stats(self):
+        return {"modules": len(self.order), "hits": self.hits, "misses": self.misses, "transfer_seconds": self.transfer_seconds,
+                "wait_seconds": self.wait_seconds, "overlap": self.overlap()}
+
+
+def streaming_lookahead(device) -> int:
+    """How many modules ahead the weights are streamed to device, 0 if weight streaming is disabled."""
+    if args.weight_streaming <= 0 or comfy.model_management.is_device_cpu(device):
+        return 0
+    return args.weight_streaming
+
+
+def create_weight_streamer(device) -> Optional[WeightStreamer]:
+    """A WeightStreamer for a model partially loaded on device, or None if weight streaming is disabled."""
+    lookahead = streaming_lookahead(device)
+    if lookahead == 0:
+        return None
+    return WeightStreamer(device, lookahead=lookahead)
@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+from comfy.cli_args import args
+from comfy_execution.utils import get_executing_context
+
+
+class BackgroundWriter:
+    """
+    Encodes and writes output files on background threads so the prompt worker can move on to the
+    next prompt. Writes are tracked per prompt so the history entry of a prompt is only added once
+    all of its files exist, and per path so that requests for a file still being written can wait
+    for it.
+    """
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="comfy_file_writer")
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pending_paths = {}
+
+    def submit(self, path, func, *args, **kwargs):
+        """
+        Calls func(path, *args, **kwargs) on a writer thread. The write belongs to the prompt that is
+        currently executing.
+        """
+        context = get_executing_context()
+        prompt_id = context.prompt_id if context is not None else None
+        path = os.path.abspath(path)
+        # Take the file name right away, the next save picks its counter from the files that exist.
+        open(path, "wb").close()
+        with self.lock:
+            future = self.pool.submit(func, path, *args, **kwargs)
+            self.pending.setdefault(prompt_id, []).append(future)
+            self.pending_paths[path] = future
+        future.add_done_callback(lambda f: self._write_done(path, f))
+        return future
+
+    def _write_done(self, path, future):
+        with self.lock:
+            if self.pending_paths.get(path) is future:
+                del self.pending_paths[path]
+        ex = future.exception()
+        if ex is not None:
+            logging.error("Failed to write {}: {}".format(path, ex))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def wait_for_path(self, path, timeout=None):
+        with self.lock:
+            future = self.pending_paths.get(os.path.abspath(path))
+        if future is not None:
+            wait([future], timeout=timeout)
+
+    def when_done(self, prompt_id, callback: Callable[[list], None]):
+        """
+        Calls callback(errors) once all the writes of the prompt are done, with the exceptions raised
+        by the ones that failed. If there are none left it's called right away on this thread,
+        otherwise on a writer thread.
+        """
+        with self.lock:
+            futures = self.pending.pop(prompt_id, [])
+        if len(futures) == 0:
+            callback([])
+            return
+
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+        def write_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            callback([f.exception() for f in futures if f.exception() is not None])
+        for future in futures:
+            future.add_done_callback(write_done)
+
+    def wait(self, prompt_id) -> list:
+        with self.lock:
+            futures = self.pending.pop(prompt_id, [])
+        wait(futures)
+        return [f.exception() for f in futures if f.exception() is not None]
+
+
+background_writer: Optional[BackgroundWriter] = None
+background_writer_lock = threading.Lock()
+
+def get_background_writer() -> Optional[BackgroundWriter]:
+    """Returns the shared BackgroundWriter, or None if files should be written by the nodes themselves."""
+    global background_writer
+    if args.save_image_workers <= 0:
+        return None
+    with background_writer_lock:
+        if background_writer is None:
+            background_writer = BackgroundWriter(args.save_image_workers)
+        return background_writer
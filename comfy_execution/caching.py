@@ -1,9 +1,22 @@
+import collections
+import hashlib
 import itertools
-from typing import Sequence, Mapping, Dict
+import json
+import logging
+import math
+import os
+import threading
+from typing import Callable, Sequence, Mapping, Dict
 from comfy_execution.graph import DynamicPrompt
 from abc import ABC, abstractmethod
 
+import safetensors
+import safetensors.torch
+import torch
+
+import folder_paths
 import nodes
+from comfy.utils import tensor_digest
 
 from comfy_execution.graph_utils import is_link
 
@@ -45,6 +58,28 @@ class Unhashable:
     def __init__(self):
         self.value = float("NaN")
 
+HASH_FUNCTIONS: Dict[type, Callable] = {}
+
+def register_hash_function(cls, func):
+    """
+    Makes inputs of type cls usable in cache keys. func(obj) must return something made of primitives,
+    bytes, lists, tuples and dicts that is equal for objects that would produce the same node outputs.
+    Classes you control can implement __comfy_hash__(self) with the same contract instead.
+    """
+    HASH_FUNCTIONS[cls] = func
+
+def _custom_hash_value(obj):
+    # Returns (name, value) for objects supporting the hashing protocol, or None
+    try:
+        if hasattr(obj, "__comfy_hash__"):
+            return (type(obj).__qualname__, obj.__comfy_hash__())
+        for cls, func in HASH_FUNCTIONS.items():
+            if isinstance(obj, cls):
+                return (cls.__qualname__, func(obj))
+    except Exception as e:
+        logging.warning("Failed to hash {} for the cache: {}".format(type(obj).__name__, e))
+    return None
+
 def to_hashable(obj):
     # So that we don't infinitely recurse since frozenset and tuples
     # are Sequences.
@@ -54,9 +89,139 @@ def to_hashable(obj):
         return frozenset([(to_hashable(k), to_hashable(v)) for k, v in sorted(obj.items())])
     elif isinstance(obj, Sequence):
         return frozenset(zip(itertools.count(), [to_hashable(i) for i in obj]))
+    elif isinstance(obj, torch.Tensor):
+        return ("TENSOR", tensor_digest(obj))
+    custom = _custom_hash_value(obj)
+    if custom is not None:
+        return ("CUSTOM", custom[0], to_hashable(custom[1]))
+    return Unhashable()
+
+class UnpersistableError(Exception):
+    pass
+
+def _update_stable_digest(h, obj):
+    if obj is None:
+        h.update(b"N")
+    elif isinstance(obj, bool):
+        h.update(b"T" if obj else b"F")
+    elif isinstance(obj, int):
+        h.update(b"I%d;" % obj)
+    elif isinstance(obj, float):
+        if math.isnan(obj):
+            raise UnpersistableError("NaN")
+        h.update(b"D" + float.hex(obj).encode() + b";")
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        h.update(b"S%d:" % len(data) + data)
+    elif isinstance(obj, bytes):
+        h.update(b"B%d:" % len(obj) + obj)
+    elif isinstance(obj, (tuple, list)):
+        # Same as to_hashable, lists and tuples with the same items are equal
+        h.update(b"(%d:" % len(obj))
+        for x in obj:
+            _update_stable_digest(h, x)
+    elif isinstance(obj, dict):
+        h.update(b"<%d:" % len(obj))
+        for k, v in sorted(obj.items()):
+            _update_stable_digest(h, k)
+            _update_stable_digest(h, v)
+    elif isinstance(obj, frozenset):
+        # Elements are sorted by their own digest so the result doesn't depend on hash randomization
+        h.update(b"{%d:" % len(obj))
+        for d in sorted(stable_digest(x) for x in obj):
+            h.update(d)
+    elif isinstance(obj, torch.Tensor):
+        h.update(b"X" + tensor_digest(obj))
     else:
-        # TODO - Support other objects like tensors?
-        return Unhashable()
+        custom = _custom_hash_value(obj)
+        if custom is None:
+            raise UnpersistableError(type(obj).__name__)
+        h.update(b"H")
+        _update_stable_digest(h, custom[0])
+        _update_stable_digest(h, custom[1])
+
+def stable_digest(obj) -> bytes:
+    """
+    Returns a digest of a value that is the same across processes (unlike hash()). Accepts primitives,
+    bytes, lists, tuples, dicts, tensors, objects supporting __comfy_hash__ or register_hash_function
+    and the frozensets produced by to_hashable.
+    Raises UnpersistableError if the value contains something that can't be compared across runs.
+    """
+    h = hashlib.sha256()
+    _update_stable_digest(h, obj)
+    return h.digest()
+
+# Number of immediate node signatures whose digest is remembered across prompts
+SIGNATURE_DIGEST_CACHE_SIZE = 8192
+
+def _digest_key(obj):
+    # Equal keys have the same stable_digest: unlike to_hashable, 1, 1.0 and True are different keys.
+    if isinstance(obj, (bool, int, float)):
+        return (type(obj), obj)
+    elif isinstance(obj, (str, bytes, type(None))):
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_digest_key(x) for x in obj)
+    elif type(obj) is dict:
+        return frozenset((_digest_key(k), _digest_key(v)) for k, v in obj.items())
+    elif isinstance(obj, frozenset):
+        return frozenset(_digest_key(x) for x in obj)
+    elif isinstance(obj, torch.Tensor):
+        return (torch.Tensor, tensor_digest(obj))
+    return (object, to_hashable(obj))
+
+class SignatureDigestCache:
+    """
+    Bounded LRU of the digests of immediate node signatures. The signature of a node includes the digests of
+    its ancestors, so a node whose inputs and upstream subgraph didn't change since an earlier prompt gets
+    its digest back without hashing its inputs again.
+    """
+    def __init__(self, max_size=SIGNATURE_DIGEST_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.digests = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, signature):
+        key = _digest_key(signature)
+        try:
+            with self.lock:
+                digest = self.digests.get(key, None)
+                if digest is not None:
+                    self.digests.move_to_end(key)
+                    self.hits += 1
+                    return digest
+                self.misses += 1
+        except TypeError:
+            # Something in the signature can't be used as a dict key
+            key = None
+        digest = stable_digest(signature)
+        if key is not None:
+            with self.lock:
+                self.digests[key] = digest
+                while len(self.digests) > self.max_size:
+                    self.digests.popitem(last=False)
+        return digest
+
+signature_digests = SignatureDigestCache()
+
+def model_file_fingerprint(value):
+    """
+    The size and mtime of the model file a widget value names, or None. Part of the signature of the
+    nodes loading it so that replacing a model under the same name doesn't serve the old outputs.
+    """
+    if not isinstance(value, str) or os.path.splitext(value)[1].lower() not in folder_paths.supported_pt_extensions:
+        return None
+    for folder_name in folder_paths.folder_names_and_paths:
+        path = folder_paths.get_full_path(folder_name, value)
+        if path is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            return ("FILE", st.st_size, st.st_mtime_ns)
+    return None
 
 class CacheKeySetID(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
@@ -78,6 +243,7 @@ class CacheKeySetInputSignature(CacheKeySet):
         super().__init__(dynprompt, node_ids, is_changed_cache)
         self.dynprompt = dynprompt
         self.is_changed_cache = is_changed_cache
+        self.signatures = {}
 
     def include_node_id_in_input(self) -> bool:
         return False
@@ -93,17 +259,43 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
     async def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(await self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(await self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    async def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
-        if not dynprompt.has_node(node_id):
-            # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+        """
+        Returns a digest of the node and everything upstream of it. Each node's digest covers its own
+        inputs and the digests of the nodes it is linked to, so shared ancestors are only hashed once
+        per prompt and identical upstream subgraphs always end up with the same key. The digests of
+        unchanged nodes are reused across prompts through signature_digests. Returns an
+        Unhashable if anything upstream can't be compared (NaN from IS_CHANGED, missing nodes...).
+        """
+        # Iterative post-order walk so long chains of nodes don't hit the recursion limit.
+        stack = [(node_id, False)]
+        visiting = set()
+        while len(stack) > 0:
+            current_id, expanded = stack.pop()
+            if current_id in self.signatures:
+                continue
+            if not dynprompt.has_node(current_id):
+                # This node doesn't exist -- we can't cache it.
+                self.signatures[current_id] = Unhashable()
+                continue
+            if not expanded:
+                if current_id in visiting:
+                    # Cycle, this is reported when the graph is executed
+                    continue
+                visiting.add(current_id)
+                stack.append((current_id, True))
+                inputs = dynprompt.get_node(current_id)["inputs"]
+                for key in sorted(inputs.keys(), reverse=True):
+                    if is_link(inputs[key]) and inputs[key][0] not in self.signatures:
+                        stack.append((inputs[key][0], False))
+                continue
+            signature = await self.get_immediate_node_signature(dynprompt, current_id, self.signatures)
+            try:
+                self.signatures[current_id] = signature_digests.digest(signature)
+            except UnpersistableError:
+                self.signatures[current_id] = Unhashable()
+        return self.signatures[node_id]
+
+    async def get_immediate_node_signature(self, dynprompt, node_id, ancestor_signatures):
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
@@ -114,36 +306,163 @@ class CacheKeySetInputSignature(CacheKeySet):
         for key in sorted(inputs.keys()):
             if is_link(inputs[key]):
                 (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
+                signature.append((key, ("ANCESTOR", ancestor_signatures.get(ancestor_id, Unhashable()), ancestor_socket)))
             else:
-                signature.append((key, inputs[key]))
+                fingerprint = model_file_fingerprint(inputs[key])
+                if fingerprint is not None:
+                    signature.append((key, inputs[key], fingerprint))
+                else:
+                    signature.append((key, inputs[key]))
         return signature
 
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
+class DiskCache:
+    """
+    A persistent tier below the in-memory output caches. Outputs of the node classes it is enabled for are
+    written to safetensors files named after a stable digest of their input signature, so identical
+    inputs don't have to be recomputed after a restart or on another worker sharing the directory.
+    Only outputs made of tensors, primitives, lists, tuples and dicts can be stored (IMAGE, MASK, LATENT,
+    most CONDITIONING); anything else is silently kept in memory only.
+    """
+    VERSION = 2
+
+    def __init__(self, directory, max_size, node_classes=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.node_classes = set(node_classes) if node_classes else None
+        self.lock = threading.RLock()
+        self.total_size = 0
+        self.files = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(".safetensors"):
+                    path = os.path.join(root, f)
+                    st = os.stat(path)
+                    self.files[path] = (st.st_size, st.st_mtime)
+                    self.total_size += st.st_size
+        logging.info("Using disk cache in {} ({:.1f} of {:.1f} GB used)".format(self.directory, self.total_size / (1024 ** 3), self.max_size / (1024 ** 3)))
+
+    def is_enabled_for(self, class_type):
+        if self.node_classes is not None:
+            return class_type in self.node_classes
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+        return getattr(class_def, "PERSISTENT_CACHE", False)
+
+    def _path(self, class_type, cache_key):
+        try:
+            digest = stable_digest((self.VERSION, class_type, cache_key)).hex()
+        except UnpersistableError:
+            return None
+        return os.path.join(self.directory, digest[:2], digest + ".safetensors")
+
+    def get(self, class_type, cache_key):
+        if not self.is_enabled_for(class_type):
+            return None
+        path = self._path(class_type, cache_key)
+        if path is None:
+            return None
+        with self.lock:
+            if path not in self.files:
+                # Could have been written by another process sharing the directory since the last time
+                if not os.path.exists(path):
+                    return None
+                st = os.stat(path)
+                self.files[path] = (st.st_size, st.st_mtime)
+                self.total_size += st.st_size
+            try:
+                with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                    tensors = {k: f.get_tensor(k) for k in f.keys()}
+                    structure = json.loads(f.metadata()["structure"])
+                value = _unflatten_output(structure, tensors)
+            except Exception as e:
+                logging.warning("Failed to read disk cache entry {}: {}".format(path, e))
+                self._remove(path)
+                return None
+            os.utime(path)
+            self.files[path] = (self.files[path][0], os.path.getmtime(path))
+        return value
 
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
+    def set(self, class_type, cache_key, value):
+        if not self.is_enabled_for(class_type):
             return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+        path = self._path(class_type, cache_key)
+        if path is None:
+            return
+        tensors = {}
+        try:
+            structure = _flatten_output(value, tensors)
+        except UnpersistableError as e:
+            logging.debug("Not writing {} output to the disk cache, it contains {}".format(class_type, e))
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + ".tmp"
+            try:
+                safetensors.torch.save_file(tensors, temp_path, metadata={"structure": json.dumps(structure)})
+            except RuntimeError:
+                # Tensors sharing memory can't be saved as they are
+                safetensors.torch.save_file({k: v.clone() for k, v in tensors.items()}, temp_path, metadata={"structure": json.dumps(structure)})
+            os.replace(temp_path, path)
+            if path in self.files:
+                self.total_size -= self.files[path][0]
+            st = os.stat(path)
+            self.files[path] = (st.st_size, st.st_mtime)
+            self.total_size += st.st_size
+            self._evict()
+
+    def _remove(self, path):
+        size, _ = self.files.pop(path, (0, 0))
+        self.total_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        if self.total_size <= self.max_size:
+            return
+        for path in sorted(self.files, key=lambda p: self.files[p][1]):
+            if self.total_size <= self.max_size:
+                break
+            self._remove(path)
+
+def _flatten_output(obj, tensors):
+    if isinstance(obj, torch.Tensor):
+        key = str(len(tensors))
+        tensors[key] = obj.detach().to("cpu").contiguous()
+        return {"tensor": key}
+    elif isinstance(obj, (bool, int, str, type(None))):
+        return obj
+    elif isinstance(obj, float):
+        return {"float": float.hex(obj)}
+    elif isinstance(obj, list):
+        return {"list": [_flatten_output(x, tensors) for x in obj]}
+    elif isinstance(obj, tuple):
+        return {"tuple": [_flatten_output(x, tensors) for x in obj]}
+    elif type(obj) is dict:
+        for k in obj:
+            if not isinstance(k, str):
+                raise UnpersistableError("dict key {}".format(type(k).__name__))
+        return {"dict": {k: _flatten_output(v, tensors) for k, v in obj.items()}}
+    raise UnpersistableError(type(obj).__name__)
+
+def _unflatten_output(structure, tensors):
+    if not isinstance(structure, dict):
+        return structure
+    if "tensor" in structure:
+        return tensors[structure["tensor"]]
+    elif "float" in structure:
+        return float.fromhex(structure["float"])
+    elif "list" in structure:
+        return [_unflatten_output(x, tensors) for x in structure["list"]]
+    elif "tuple" in structure:
+        return tuple(_unflatten_output(x, tensors) for x in structure["tuple"])
+    return {k: _unflatten_output(v, tensors) for k, v in structure["dict"].items()}
 
 class BasicCache:
-    def __init__(self, key_class):
+    def __init__(self, key_class, disk_cache=None):
         self.key_class = key_class
+        self.disk_cache = disk_cache
         self.initialized = False
         self.dynprompt: DynamicPrompt
         self.cache_key_set: CacheKeySet
@@ -192,6 +511,12 @@ class BasicCache:
         assert self.initialized
         cache_key = self.cache_key_set.get_data_key(node_id)
         self.cache[cache_key] = value
+        if self.disk_cache is not None and cache_key is not None:
+            self.disk_cache.set(self.dynprompt.get_node(node_id)["class_type"], cache_key, value)
+
+    def record_execution_time(self, node_id, seconds):
+        # Only used by caches that weigh entries by how long they take to recompute.
+        pass
 
     def _get_immediate(self, node_id):
         if not self.initialized:
@@ -199,6 +524,11 @@ class BasicCache:
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key in self.cache:
             return self.cache[cache_key]
+        elif self.disk_cache is not None and cache_key is not None:
+            value = self.disk_cache.get(self.dynprompt.get_node(node_id)["class_type"], cache_key)
+            if value is not None:
+                self.cache[cache_key] = value
+            return value
         else:
             return None
 
@@ -206,7 +536,7 @@ class BasicCache:
         subcache_key = self.cache_key_set.get_subcache_key(node_id)
         subcache = self.subcaches.get(subcache_key, None)
         if subcache is None:
-            subcache = BasicCache(self.key_class)
+            subcache = BasicCache(self.key_class, disk_cache=self.disk_cache)
             self.subcaches[subcache_key] = subcache
         await subcache.set_prompt(self.dynprompt, children_ids, self.is_changed_cache)
         return subcache
@@ -228,8 +558,8 @@ class BasicCache:
         return result
 
 class HierarchicalCache(BasicCache):
-    def __init__(self, key_class):
-        super().__init__(key_class)
+    def __init__(self, key_class, disk_cache=None):
+        super().__init__(key_class, disk_cache=disk_cache)
 
     def _get_cache_for(self, node_id):
         assert self.dynprompt is not None
@@ -266,8 +596,8 @@ class HierarchicalCache(BasicCache):
         return await cache._ensure_subcache(node_id, children_ids)
 
 class LRUCache(BasicCache):
-    def __init__(self, key_class, max_size=100):
-        super().__init__(key_class)
+    def __init__(self, key_class, max_size=100, disk_cache=None):
+        super().__init__(key_class, disk_cache=disk_cache)
         self.max_size = max_size
         self.min_generation = 0
         self.generation = 0
@@ -318,6 +648,187 @@ class LRUCache(BasicCache):
         return self
 
 
+def _collect_storages(obj, storages):
+    if isinstance(obj, torch.Tensor):
+        storage = obj.untyped_storage()
+        key = (str(obj.device), storage.data_ptr())
+        if key not in storages:
+            storages[key] = (storage.nbytes(), obj.device.type != "cpu")
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            _collect_storages(x, storages)
+    elif isinstance(obj, dict):
+        for x in obj.values():
+            _collect_storages(x, storages)
+    elif hasattr(obj, "model_size") and hasattr(obj, "model"):
+        # ModelPatcher. The weights are owned by comfy.model_management while loaded so they are
+        # counted against the RAM budget (where they end up once offloaded).
+        key = ("model", id(obj.model))
+        if key not in storages:
+            storages[key] = (obj.model_size(), False)
+    elif hasattr(obj, "patcher"):
+        # CLIP, VAE...
+        _collect_storages(obj.patcher, storages)
+
+def get_output_storages(value):
+    """
+    Returns {storage_key: (nbytes, is_vram)} for the memory held by a cached output. Tensors that
+    are views of the same storage are only counted once.
+    """
+    storages = {}
+    _collect_storages(value, storages)
+    return storages
+
+def _move_tensors_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.to("cpu") if obj.device.type != "cpu" else obj
+    elif isinstance(obj, list):
+        return [_move_tensors_to_cpu(x) for x in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_move_tensors_to_cpu(x) for x in obj)
+    elif isinstance(obj, dict):
+        return {k: _move_tensors_to_cpu(v) for k, v in obj.items()}
+    return obj
+
+class MemoryBudgetCache(LRUCache):
+    """
+    An LRU cache bounded by the RAM and VRAM used by the cached outputs instead of the number of
+    entries.
+
+    When over budget, entries that are not used by the current prompt are evicted starting with
+    the ones that free the most memory per second of recompute time. When over the VRAM budget,
+    tensors are first moved to the CPU instead of being dropped. Memory shared between entries
+    (a model and its clones, outputs that pass an input through...) is counted once and only
+    considered freed when the last entry holding it is evicted.
+    """
+    def __init__(self, key_class, ram_budget, vram_budget=None, disk_cache=None, linked_caches=()):
+        super().__init__(key_class, max_size=0, disk_cache=disk_cache)
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        # LRUCaches whose entries are dropped along with ours (the UI cache uses the same keys).
+        self.linked_caches = list(linked_caches)
+        self.execution_time = {}
+        self.entry_storages = {}
+        self.storage_refs = {}
+        self.ram_used = 0
+        self.vram_used = 0
+
+    def _add_storages(self, cache_key, storages):
+        self.entry_storages[cache_key] = storages
+        for key, (nbytes, is_vram) in storages.items():
+            refs = self.storage_refs.get(key, 0)
+            if refs == 0:
+                if is_vram:
+                    self.vram_used += nbytes
+                else:
+                    self.ram_used += nbytes
+            self.storage_refs[key] = refs + 1
+
+    def _release_storages(self, cache_key):
+        storages = self.entry_storages.pop(cache_key, {})
+        for key, (nbytes, is_vram) in storages.items():
+            refs = self.storage_refs[key] - 1
+            if refs == 0:
+                del self.storage_refs[key]
+                if is_vram:
+                    self.vram_used -= nbytes
+                else:
+                    self.ram_used -= nbytes
+            else:
+                self.storage_refs[key] = refs
+
+    def _sync_accounting(self):
+        # Entries can also be added by reading through the disk cache so measure lazily.
+        for cache_key in [k for k in self.entry_storages if k not in self.cache]:
+            self._release_storages(cache_key)
+        for cache_key, value in self.cache.items():
+            if cache_key not in self.entry_storages:
+                self._add_storages(cache_key, get_output_storages(value))
+
+    def _eviction_order(self, vram):
+        # Cheapest to recompute per byte freed first, least recently used first on ties. Entries that
+        # only hold memory shared with other entries come last.
+        candidates = []
+        for cache_key in self.cache:
+            if self.used_generation.get(cache_key, 0) >= self.generation:
+                continue
+            held = [key for key, (nbytes, is_vram) in self.entry_storages[cache_key].items() if is_vram == vram]
+            if len(held) == 0:
+                continue
+            freed = sum(self.entry_storages[cache_key][key][0] for key in held if self.storage_refs[key] == 1)
+            if freed > 0:
+                score = self.execution_time.get(cache_key, 0.0) / freed
+            else:
+                score = math.inf
+            candidates.append((score, self.used_generation.get(cache_key, 0), cache_key))
+        candidates.sort(key=lambda x: (x[0], x[1]))
+        return [x[2] for x in candidates]
+
+    def _evict(self, cache_key):
+        self._release_storages(cache_key)
+        del self.cache[cache_key]
+        self.used_generation.pop(cache_key, None)
+        self.execution_time.pop(cache_key, None)
+        self.children.pop(cache_key, None)
+        for cache in self.linked_caches:
+            cache.cache.pop(cache_key, None)
+            cache.used_generation.pop(cache_key, None)
+            cache.children.pop(cache_key, None)
+
+    def _forget_unused_keys(self):
+        # LRUCache remembers when every key it saw was last used. Only the keys of the cached entries
+        # and of the current prompt are kept, or a long running server would accumulate all of them.
+        for cache in [self] + self.linked_caches:
+            for cache_key in [k for k, g in cache.used_generation.items() if g < cache.generation and k not in cache.cache]:
+                del cache.used_generation[cache_key]
+                cache.children.pop(cache_key, None)
+
+    def _enforce_budget(self):
+        self._sync_accounting()
+        if self.vram_budget is not None and self.vram_used > self.vram_budget:
+            for cache_key in self._eviction_order(vram=True):
+                if self.vram_used <= self.vram_budget:
+                    break
+                self._release_storages(cache_key)
+                self.cache[cache_key] = _move_tensors_to_cpu(self.cache[cache_key])
+                self._add_storages(cache_key, get_output_storages(self.cache[cache_key]))
+        if self.ram_used > self.ram_budget:
+            for cache_key in self._eviction_order(vram=False):
+                if self.ram_used <= self.ram_budget:
+                    break
+                self._evict(cache_key)
+            if self.ram_used > self.ram_budget:
+                logging.debug("Output cache is using {:.2f} GB of RAM, over its budget but in use by the current prompt.".format(self.ram_used / (1024 ** 3)))
+
+    def clean_unused(self):
+        self._enforce_budget()
+        self._forget_unused_keys()
+        self._clean_subcaches()
+
+    def set(self, node_id, value):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key in self.entry_storages:
+            self._release_storages(cache_key)
+        result = super().set(node_id, value)
+        self._enforce_budget()
+        return result
+
+    def record_execution_time(self, node_id, seconds):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key in self.cache:
+            self.execution_time[cache_key] = seconds
+
+    def get_stats(self):
+        self._sync_accounting()
+        return {
+            "entries": len(self.cache),
+            "ram_used": self.ram_used,
+            "ram_budget": self.ram_budget,
+            "vram_used": self.vram_used,
+            "vram_budget": self.vram_budget,
+        }
+
+
 class DependencyAwareCache(BasicCache):
     """
     A cache implementation that tracks dependencies between nodes and manages
@@ -326,14 +837,15 @@ class DependencyAwareCache(BasicCache):
     executed.
     """
 
-    def __init__(self, key_class):
+    def __init__(self, key_class, disk_cache=None):
         """
         Initialize the DependencyAwareCache.
 
         Args:
             key_class: The class used for generating cache keys.
+            disk_cache: Optional DiskCache to read and write outputs through.
         """
-        super().__init__(key_class)
+        super().__init__(key_class, disk_cache=disk_cache)
         self.descendants = {}  # Maps node_id -> set of descendant node_ids
         self.ancestors = {}    # Maps node_id -> set of ancestor node_ids
         self.executed_nodes = set()  # Tracks nodes that have been executed
@@ -191,6 +191,8 @@ class ExecutionList(TopologicalSort):
         super().__init__(dynprompt)
         self.output_cache = output_cache
         self.staged_node_id = None
+        # Used instead of staged_node_id when several nodes are executed at once
+        self.staged_node_ids = set()
 
     def is_cached(self, node_id):
         return self.output_cache.get(node_id) is not None
@@ -206,28 +208,57 @@ class ExecutionList(TopologicalSort):
             self.unblockedEvent.clear()
             available = self.get_ready_nodes()
         if len(available) == 0:
-            cycled_nodes = self.get_nodes_in_cycle()
-            # Because cycles composed entirely of static nodes are caught during initial validation,
-            # we will 'blame' the first node in the cycle that is not a static node.
-            blamed_node = cycled_nodes[0]
-            for node_id in cycled_nodes:
-                display_node_id = self.dynprompt.get_display_node_id(node_id)
-                if display_node_id != node_id:
-                    blamed_node = display_node_id
-                    break
-            ex = DependencyCycleError("Dependency cycle detected")
-            error_details = {
-                "node_id": blamed_node,
-                "exception_message": str(ex),
-                "exception_type": "graph.DependencyCycleError",
-                "traceback": [],
-                "current_inputs": []
-            }
+            error_details, ex = self.get_cycle_error()
             return None, error_details, ex
 
         self.staged_node_id = self.ux_friendly_pick_node(available)
         return self.staged_node_id, None, None
 
+    async def stage_ready_nodes(self):
+        """
+        Stages every node that is ready to run and not already staged. Returns (node_ids, error, ex).
+        An empty list means nothing new is ready until one of the staged nodes finishes.
+        """
+        if self.is_empty():
+            return [], None, None
+        available = [x for x in self.get_ready_nodes() if x not in self.staged_node_ids]
+        if len(available) == 0 and len(self.staged_node_ids) == 0:
+            while len(available) == 0 and self.externalBlocks > 0:
+                await self.unblockedEvent.wait()
+                self.unblockedEvent.clear()
+                available = self.get_ready_nodes()
+            if len(available) == 0:
+                error_details, ex = self.get_cycle_error()
+                return [], error_details, ex
+
+        # Keep the ux friendly node first so it is dispatched before the others
+        if len(available) > 1:
+            first = self.ux_friendly_pick_node(available)
+            available.remove(first)
+            available.insert(0, first)
+        self.staged_node_ids.update(available)
+        return available, None, None
+
+    def get_cycle_error(self):
+        cycled_nodes = self.get_nodes_in_cycle()
+        # Because cycles composed entirely of static nodes are caught during initial validation,
+        # we will 'blame' the first node in the cycle that is not a static node.
+        blamed_node = cycled_nodes[0]
+        for node_id in cycled_nodes:
+            display_node_id = self.dynprompt.get_display_node_id(node_id)
+            if display_node_id != node_id:
+                blamed_node = display_node_id
+                break
+        ex = DependencyCycleError("Dependency cycle detected")
+        error_details = {
+            "node_id": blamed_node,
+            "exception_message": str(ex),
+            "exception_type": "graph.DependencyCycleError",
+            "traceback": [],
+            "current_inputs": []
+        }
+        return error_details, ex
+
     def ux_friendly_pick_node(self, node_list):
         # If an output node is available, do that first.
         # Technically this has no effect on the overall length of execution, but it feels better as a user
@@ -276,6 +307,13 @@ class ExecutionList(TopologicalSort):
         self.pop_node(node_id)
         self.staged_node_id = None
 
+    def unstage_node(self, node_id):
+        self.staged_node_ids.discard(node_id)
+
+    def complete_node(self, node_id):
+        self.staged_node_ids.discard(node_id)
+        self.pop_node(node_id)
+
     def get_nodes_in_cycle(self):
         # We'll dissolve the graph in reverse topological order to leave only the nodes in the cycle.
         # We're skipping some of the performance optimizations from the original TopologicalSort to keep
@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def node_uses_device(class_def) -> bool:
+    """
+    Returns True if nodes of this class should be run on the device lane.
+
+    Nodes whose inputs and outputs are only images or masks can still do their work on the torch
+    device, so every node is assumed to unless its class sets DEVICE_NODE = False.
+    """
+    return bool(getattr(class_def, "DEVICE_NODE", True))
+
+
+class NodeDispatcher:
+    """
+    Runs the synchronous part of node execution on worker threads so that independent branches of a
+    graph can make progress at the same time.
+
+    Nodes that declare DEVICE_NODE = False (image loading, text, API calls...) share a pool of
+    cpu_workers threads. All the other nodes are admitted one at a time on a dedicated thread so they
+    never compete for VRAM or race each other inside comfy.model_management. Output nodes also get
+    their own thread since most of them pick output filenames by looking at what is already in the
+    output directory.
+    """
+    def __init__(self, cpu_workers):
+        self.cpu_workers = max(1, cpu_workers)
+        self.cpu_pool = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="comfy_cpu_node")
+        self.device_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfy_device_node")
+        self.output_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfy_output_node")
+        logging.info("Using parallel node execution with {} CPU workers".format(self.cpu_workers))
+
+    def pool_for(self, class_def):
+        if node_uses_device(class_def):
+            return self.device_pool
+        if getattr(class_def, "OUTPUT_NODE", False) == True:
+            return self.output_pool
+        return self.cpu_pool
+
+    async def run(self, class_def, func, *args, **kwargs):
+        ctx = contextvars.copy_context()
+
+        def call():
+            # inference_mode is thread local so it has to be entered again on the worker thread.
+            with torch.inference_mode():
+                return ctx.run(func, *args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool_for(class_def), call)
+
+    def shutdown(self):
+        self.cpu_pool.shutdown(wait=True)
+        self.device_pool.shutdown(wait=True)
+        self.output_pool.shutdown(wait=True)
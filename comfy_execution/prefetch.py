@@ -0,0 +1,190 @@
+import collections
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+
+import torch
+
+import comfy.model_management
+import folder_paths
+from comfy.cli_args import args
+
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+# Files read recently are assumed to still be in the page cache.
+WARM_FILES = 64
+
+
+def find_model_file(filename):
+    for folder_name in folder_paths.folder_names_and_paths:
+        path = folder_paths.get_full_path(folder_name, filename)
+        if path is not None:
+            return path
+    return None
+
+
+def prompt_model_paths(prompt):
+    """Full paths of the model files loaded by the loader nodes of a prompt, in prompt order."""
+    # Same detection as get_prompt_model_files in execution.py, kept in order.
+    paths = []
+    for node in prompt.values():
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, str) and os.path.splitext(value)[1].lower() in folder_paths.supported_pt_extensions:
+                path = find_model_file(value)
+                if path is not None and path not in paths:
+                    paths.append(path)
+    return paths
+
+
+def prompt_memory_required(prompt):
+    """
+    Estimate of the device memory the models of a prompt still need: the part of the models in
+    memory that isn't loaded and the file size of the others.
+    """
+    total = 0
+    for path in prompt_model_paths(prompt):
+        models = comfy.model_management.models_for_file(path)
+        if len(models) > 0:
+            total += max(m.model_size() - m.loaded_size() for m in models)
+        else:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+    return total
+
+
+class ModelPrefetcher:
+    """
+    Gets the models of the next queued prompts ready while the current prompt runs. The files of
+    models that aren't in memory yet are read into the page cache (they are memory mapped when
+    loaded) as long as they fit in half of the available RAM. Models that are already in memory (the
+    loader node outputs are cached) are loaded to the device once the running prompt has started
+    loading its own models, if they fit in the free VRAM without unloading anything and without
+    using the memory the rest of the running prompt's models need.
+    """
+    def __init__(self, free_ram: Optional[Callable[[], int]] = None, load_model: Optional[Callable] = None):
+        if free_ram is None:
+            free_ram = lambda: comfy.model_management.get_free_memory(torch.device("cpu"))
+        if load_model is None:
+            load_model = comfy.model_management.prefetch_model_gpu
+        self.free_ram = free_ram
+        self.load_model = load_model
+        self.lock = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.warm = collections.OrderedDict()
+        self.bytes_read = 0
+        self.thread = None
+
+    def prefetch(self, prompts, running=None):
+        """
+        Replaces whatever is left to prefetch with the models of these prompts, in order. running is
+        the prompt being executed, the memory its models need is kept free.
+        """
+        with self.lock:
+            self.pending = (list(prompts), running, comfy.model_management.models_load_count)
+            self.generation += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name="comfy_model_prefetch", daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while self.pending is None:
+                    self.lock.wait()
+                prompts, running, load_count = self.pending
+                generation = self.generation
+                self.pending = None
+            try:
+                self.run(prompts, generation, load_count, running)
+            except Exception as e:
+                logging.warning("Model prefetch failed: {}".format(e))
+
+    def _cancelled(self, generation):
+        return generation is not None and generation != self.generation
+
+    def run(self, prompts, generation=None, load_count=None, running=None):
+        """
+        Prefetches the models of the prompts. If load_count is given, models are only loaded to the
+        device after models_load_count went past it.
+        """
+        ram_budget = self.free_ram() // 2
+        in_memory = []
+        for prompt in prompts:
+            for path in prompt_model_paths(prompt):
+                if self._cancelled(generation):
+                    return
+                models = comfy.model_management.models_for_file(path)
+                if len(models) > 0:
+                    in_memory.extend(weakref.ref(m) for m in models if weakref.ref(m) not in in_memory)
+                    continue
+                size = self._read_size(path)
+                if size is None:
+                    continue
+                if size > ram_budget:
+                    logging.debug("Not prefetching {}, {} bytes left in the RAM budget".format(path, ram_budget))
+                    continue
+                if self._read(path, generation):
+                    ram_budget -= size
+
+        if len(in_memory) == 0:
+            return
+        # Loading models while the running prompt loads its first ones would slow it down.
+        while load_count is not None and not comfy.model_management.wait_for_models_load(load_count, timeout=1.0):
+            if self._cancelled(generation):
+                return
+        for model_ref in in_memory:
+            model = model_ref()
+            if self._cancelled(generation):
+                return
+            if model is not None:
+                reserved = prompt_memory_required(running) if running is not None else 0
+                self.load_model(model, reserved)
+
+    def _read_size(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = (st.st_size, st.st_mtime_ns)
+        if self.warm.get(path) == fingerprint:
+            self.warm.move_to_end(path)
+            return None
+        return st.st_size
+
+    def _read(self, path, generation):
+        start = time.perf_counter()
+        buf = bytearray(READ_CHUNK_SIZE)
+        total = 0
+        with open(path, "rb") as f:
+            fingerprint = (os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_mtime_ns)
+            while True:
+                if self._cancelled(generation):
+                    return False
+                n = f.readinto(buf)
+                if not n:
+                    break
+                total += n
+        self.bytes_read += total
+        self.warm[path] = fingerprint
+        while len(self.warm) > WARM_FILES:
+            self.warm.popitem(last=False)
+        elapsed = time.perf_counter() - start
+        logging.info("Prefetched {} ({:.1f} MB in {:.2f}s)".format(os.path.basename(path), total / (1024 * 1024), elapsed))
+        return True
+
+
+model_prefetcher: Optional[ModelPrefetcher] = None
+
+def get_model_prefetcher() -> Optional[ModelPrefetcher]:
+    global model_prefetcher
+    if args.prefetch_models <= 0:
+        return None
+    if model_prefetcher is None:
+        model_prefetcher = ModelPrefetcher()
+    return model_prefetcher
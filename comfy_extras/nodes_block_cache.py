@@ -0,0 +1,27 @@
+import comfy.block_cache
+
+
+class BlockCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "threshold": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 1.0, "step": 0.001, "tooltip": "The blocks are skipped while the change of the first block output is estimated to change their output by less than this. Higher is faster, 0 disables the cache."}),
+                             "start_percent": ("FLOAT", {"default": 0.15, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+
+    CATEGORY = "model_patches"
+    DESCRIPTION = "Reuses the output of the transformer blocks of DiT models (flux, wan, hunyuan video, sd3, ...) between steps where the output of the first block barely changes."
+
+    def patch(self, model, threshold, start_percent, end_percent):
+        model_sampling = model.get_model_object("model_sampling")
+        m, _ = comfy.block_cache.apply_block_cache(model, threshold, sigma_start=model_sampling.percent_to_sigma(start_percent),
+                                                   sigma_end=model_sampling.percent_to_sigma(end_percent))
+        return (m, )
+
+
+NODE_CLASS_MAPPINGS = {
+    "BlockCache": BlockCache,
+}
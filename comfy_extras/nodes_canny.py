@@ -12,6 +12,7 @@ class Canny:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "detect_edge"
+    PERSISTENT_CACHE = True
 
     CATEGORY = "image/preprocessors"
 
@@ -3,6 +3,7 @@
 import torch
 from typing import Tuple, Callable
 import math
+import comfy.token_merging
 
 def do_nothing(x: torch.Tensor, mode:str=None):
     return x
@@ -171,6 +172,25 @@ class TomePatchModel:
         return (m, )
 
 
+class TomePatchModelDiT:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": { "model": ("MODEL",),
+                              "ratio": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 0.75, "step": 0.01}),
+                              "start_block": ("INT", {"default": 0, "min": 0, "max": 1000, "tooltip": "The blocks are numbered in the order they run, double blocks then single blocks."}),
+                              "end_block": ("INT", {"default": -1, "min": -1000, "max": 1000, "tooltip": "Last block merged, negative values count from the last block."}),
+                              }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+
+    CATEGORY = "model_patches/dit"
+    DESCRIPTION = "Token merging for the blocks of flux, sd3, wan and hunyuan video models. Chain it to use different ratios for different blocks."
+
+    def patch(self, model, ratio, start_block, end_block):
+        return (comfy.token_merging.apply_token_merging(model, [(start_block, end_block, ratio)]), )
+
+
 NODE_CLASS_MAPPINGS = {
     "TomePatchModel": TomePatchModel,
+    "TomePatchModelDiT": TomePatchModelDiT,
 }
@@ -0,0 +1,26 @@
+class UncondCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "interval": ("INT", {"default": 2, "min": 1, "max": 16, "tooltip": "The uncond is evaluated once every this many model evaluations, the others reuse its difference to the cond."}),
+                             "start_percent": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "mode": (["reuse", "extrapolate"],),
+                             }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+
+    CATEGORY = "model_patches"
+    DESCRIPTION = "Skips uncond model evaluations between start_percent and end_percent of the sampling, where the guidance changes slowly."
+
+    def patch(self, model, interval, start_percent, end_percent, mode):
+        model_sampling = model.get_model_object("model_sampling")
+        m = model.clone()
+        m.set_model_uncond_cache(interval, sigma_start=model_sampling.percent_to_sigma(start_percent),
+                                 sigma_end=model_sampling.percent_to_sigma(end_percent), extrapolate=mode == "extrapolate")
+        return (m, )
+
+
+NODE_CLASS_MAPPINGS = {
+    "UncondCache": UncondCache,
+}
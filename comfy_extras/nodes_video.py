@@ -213,10 +213,7 @@ class LoadVideo(ComfyNodeABC):
     @classmethod
     def IS_CHANGED(cls, file):
         video_path = folder_paths.get_annotated_filepath(file)
-        mod_time = os.path.getmtime(video_path)
-        # Instead of hashing the file, we can just use the modification time to avoid
-        # rehashing large files.
-        return mod_time
+        return folder_paths.get_file_fingerprint(video_path)
 
     @classmethod
     def VALIDATE_INPUTS(cls, file):
@@ -2,6 +2,7 @@ import copy
 import heapq
 import inspect
 import logging
+import os
 import sys
 import threading
 import time
@@ -13,6 +14,7 @@ import asyncio
 import torch
 
 import comfy.model_management
+import folder_paths
 import nodes
 from comfy_execution.caching import (
     BasicCache,
@@ -21,6 +23,7 @@ from comfy_execution.caching import (
     DependencyAwareCache,
     HierarchicalCache,
     LRUCache,
+    MemoryBudgetCache,
 )
 from comfy_execution.graph import (
     DynamicPrompt,
@@ -29,6 +32,7 @@ from comfy_execution.graph import (
     get_input_info,
 )
 from comfy_execution.graph_utils import GraphBuilder, is_link
+from comfy_execution.parallel import NodeDispatcher
 from comfy_execution.validation import validate_node_input
 from comfy_execution.progress import get_progress_state, reset_progress_state, add_progress_handler, WebUIProgressHandler
 from comfy_execution.utils import CurrentNodeContext
@@ -82,10 +86,12 @@ class CacheType(Enum):
     CLASSIC = 0
     LRU = 1
     DEPENDENCY_AWARE = 2
+    MEMORY_BUDGET = 3
 
 
 class CacheSet:
-    def __init__(self, cache_type=None, cache_size=None):
+    def __init__(self, cache_type=None, cache_size=None, disk_cache=None, vram_cache_size=None):
+        self.disk_cache = disk_cache
         if cache_type == CacheType.DEPENDENCY_AWARE:
             self.init_dependency_aware_cache()
             logging.info("Disabling intermediate node cache.")
@@ -94,6 +100,9 @@ class CacheSet:
                 cache_size = 0
             self.init_lru_cache(cache_size)
             logging.info("Using LRU cache")
+        elif cache_type == CacheType.MEMORY_BUDGET:
+            self.init_memory_budget_cache(cache_size, vram_cache_size)
+            logging.info("Using memory budgeted cache")
         else:
             self.init_classic_cache()
 
@@ -101,18 +110,25 @@ class CacheSet:
 
     # Performs like the old cache -- dump data ASAP
     def init_classic_cache(self):
-        self.outputs = HierarchicalCache(CacheKeySetInputSignature)
+        self.outputs = HierarchicalCache(CacheKeySetInputSignature, disk_cache=self.disk_cache)
         self.ui = HierarchicalCache(CacheKeySetInputSignature)
         self.objects = HierarchicalCache(CacheKeySetID)
 
     def init_lru_cache(self, cache_size):
-        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, disk_cache=self.disk_cache)
         self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
         self.objects = HierarchicalCache(CacheKeySetID)
 
+    # cache_size and vram_cache_size are in bytes
+    def init_memory_budget_cache(self, cache_size, vram_cache_size):
+        # UI entries are tiny, they are dropped along with the outputs they belong to.
+        self.ui = LRUCache(CacheKeySetInputSignature, max_size=sys.maxsize)
+        self.outputs = MemoryBudgetCache(CacheKeySetInputSignature, ram_budget=cache_size, vram_budget=vram_cache_size, disk_cache=self.disk_cache, linked_caches=[self.ui])
+        self.objects = HierarchicalCache(CacheKeySetID)
+
     # only hold cached items while the decendents have not executed
     def init_dependency_aware_cache(self):
-        self.outputs = DependencyAwareCache(CacheKeySetInputSignature)
+        self.outputs = DependencyAwareCache(CacheKeySetInputSignature, disk_cache=self.disk_cache)
         self.ui = DependencyAwareCache(CacheKeySetInputSignature)
         self.objects = DependencyAwareCache(CacheKeySetID)
 
@@ -184,7 +200,7 @@ async def resolve_map_node_over_list_results(results):
                 raise exc
         return [x.result() if isinstance(x, asyncio.Task) else x for x in results]
 
-async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None):
+async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None, dispatcher=None):
     # check if node wants the lists
     input_is_list = getattr(obj, "INPUT_IS_LIST", False)
 
@@ -212,9 +228,20 @@ async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, f
                 execution_block = execution_block_cb(v) if execution_block_cb else v
                 break
         if execution_block is None:
+            f = getattr(obj, func)
+            if dispatcher is not None and not inspect.iscoroutinefunction(f):
+                # Run on a worker thread. The prefix callback has to run on that same thread since the
+                # GraphBuilder default prefix is thread local.
+                def run_node(f, prompt_id, unique_id, list_index, args):
+                    if pre_execute_cb is not None and list_index is not None:
+                        pre_execute_cb(list_index)
+                    with CurrentNodeContext(prompt_id, unique_id, list_index):
+                        return f(**args)
+                result = await dispatcher.run(type(obj), run_node, f, prompt_id, unique_id, index, inputs)
+                results.append(result)
+                return
             if pre_execute_cb is not None and index is not None:
                 pre_execute_cb(index)
-            f = getattr(obj, func)
             if inspect.iscoroutinefunction(f):
                 async def async_wrapper(f, prompt_id, unique_id, list_index, args):
                     with CurrentNodeContext(prompt_id, unique_id, list_index):
@@ -266,8 +293,8 @@ def merge_result_data(results, obj):
             output.append([o[i] for o in results])
     return output
 
-async def get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=None, pre_execute_cb=None):
-    return_values = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+async def get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=None, pre_execute_cb=None, dispatcher=None):
+    return_values = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, dispatcher=dispatcher)
     has_pending_task = any(isinstance(r, asyncio.Task) and not r.done() for r in return_values)
     if has_pending_task:
         return return_values, {}, False, has_pending_task
@@ -327,7 +354,7 @@ def format_value(x):
     else:
         return str(x)
 
-async def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes):
+async def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, dispatcher=None):
     unique_id = current_item
     real_node_id = dynprompt.get_real_node_id(unique_id)
     display_node_id = dynprompt.get_display_node_id(unique_id)
@@ -343,6 +370,7 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
         return (ExecutionResult.SUCCESS, None, None)
 
     input_data_all = None
+    execution_time = None
     try:
         if unique_id in pending_async_nodes:
             results = []
@@ -424,7 +452,9 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
             def pre_execute_cb(call_index):
                 # TODO - How to handle this with async functions without contextvars (which requires Python 3.12)?
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
-            output_data, output_ui, has_subgraph, has_pending_tasks = await get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+            start_time = time.perf_counter()
+            output_data, output_ui, has_subgraph, has_pending_tasks = await get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, dispatcher=dispatcher)
+            execution_time = time.perf_counter() - start_time
             if has_pending_tasks:
                 pending_async_nodes[unique_id] = output_data
                 unblock = execution_list.add_external_block(unique_id)
@@ -485,6 +515,8 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
             pending_subgraph_results[unique_id] = cached_outputs
             return (ExecutionResult.PENDING, None, None)
         caches.outputs.set(unique_id, output_data)
+        if execution_time is not None:
+            caches.outputs.record_execution_time(unique_id, execution_time)
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -528,14 +560,19 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
     return (ExecutionResult.SUCCESS, None, None)
 
 class PromptExecutor:
-    def __init__(self, server, cache_type=False, cache_size=None):
+    def __init__(self, server, cache_type=False, cache_size=None, parallel_workers=0, disk_cache=None, vram_cache_size=None):
         self.cache_size = cache_size
+        self.vram_cache_size = vram_cache_size
         self.cache_type = cache_type
+        self.disk_cache = disk_cache
         self.server = server
+        self.dispatcher = None
+        if parallel_workers > 0:
+            self.dispatcher = NodeDispatcher(parallel_workers)
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size)
+        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size, disk_cache=self.disk_cache, vram_cache_size=self.vram_cache_size)
         self.status_messages = []
         self.success = True
 
@@ -582,7 +619,14 @@ class PromptExecutor:
         asyncio.run(self.execute_async(prompt, prompt_id, extra_data, execute_outputs))
 
     async def execute_async(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
-        nodes.interrupt_processing(False)
+        # Interrupts and the models it is using are tracked per prompt since several prompt workers can run at once.
+        comfy.model_management.start_processing(prompt_id)
+        try:
+            await self._execute_async(prompt, prompt_id, extra_data, execute_outputs)
+        finally:
+            comfy.model_management.finish_processing(prompt_id)
+
+    async def _execute_async(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
@@ -618,24 +662,11 @@ class PromptExecutor:
             for node_id in list(execute_outputs):
                 execution_list.add_node(node_id)
 
-            while not execution_list.is_empty():
-                node_id, error, ex = await execution_list.stage_node_execution()
-                if error is not None:
-                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-
-                assert node_id is not None, "Node ID should not be None at this point"
-                result, error, ex = await execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes)
-                self.success = result != ExecutionResult.FAILURE
-                if result == ExecutionResult.FAILURE:
-                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-                elif result == ExecutionResult.PENDING:
-                    execution_list.unstage_node_execution()
-                else: # result == ExecutionResult.SUCCESS:
-                    execution_list.complete_node_execution()
+            if self.dispatcher is not None:
+                completed = await self.execute_parallel(dynamic_prompt, prompt_id, extra_data, executed, execution_list, current_outputs, pending_subgraph_results, pending_async_nodes)
             else:
-                # Only execute when the while-loop ends without break
+                completed = await self.execute_sequential(dynamic_prompt, prompt_id, extra_data, executed, execution_list, current_outputs, pending_subgraph_results, pending_async_nodes)
+            if completed:
                 self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
 
             ui_outputs = {}
@@ -654,6 +685,71 @@ class PromptExecutor:
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
+    async def execute_sequential(self, dynamic_prompt, prompt_id, extra_data, executed, execution_list, current_outputs, pending_subgraph_results, pending_async_nodes):
+        while not execution_list.is_empty():
+            node_id, error, ex = await execution_list.stage_node_execution()
+            if error is not None:
+                self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                return False
+
+            assert node_id is not None, "Node ID should not be None at this point"
+            result, error, ex = await execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes)
+            self.success = result != ExecutionResult.FAILURE
+            if result == ExecutionResult.FAILURE:
+                self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                return False
+            elif result == ExecutionResult.PENDING:
+                execution_list.unstage_node_execution()
+            else: # result == ExecutionResult.SUCCESS:
+                execution_list.complete_node_execution()
+        return True
+
+    async def execute_parallel(self, dynamic_prompt, prompt_id, extra_data, executed, execution_list, current_outputs, pending_subgraph_results, pending_async_nodes):
+        # Every ready node is dispatched at once. The node functions themselves run on the dispatcher
+        # threads while the bookkeeping (caches, execution list) stays on this event loop.
+        running = {}
+        failure = None
+        while not execution_list.is_empty() or len(running) > 0:
+            if failure is None:
+                node_ids, error, ex = await execution_list.stage_ready_nodes()
+                if error is not None:
+                    failure = (error, ex)
+                for node_id in node_ids:
+                    task = asyncio.create_task(execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, dispatcher=self.dispatcher))
+                    running[task] = node_id
+            if len(running) == 0:
+                break
+
+            unblocked = asyncio.create_task(execution_list.unblockedEvent.wait())
+            done, _ = await asyncio.wait(list(running.keys()) + [unblocked], return_when=asyncio.FIRST_COMPLETED)
+            if unblocked in done:
+                execution_list.unblockedEvent.clear()
+            else:
+                unblocked.cancel()
+
+            for task in done:
+                if task is unblocked:
+                    continue
+                node_id = running.pop(task)
+                result, error, ex = task.result()
+                if result == ExecutionResult.FAILURE:
+                    execution_list.unstage_node(node_id)
+                    if failure is None:
+                        failure = (error, ex)
+                elif result == ExecutionResult.PENDING:
+                    execution_list.unstage_node(node_id)
+                else: # result == ExecutionResult.SUCCESS:
+                    execution_list.complete_node(node_id)
+
+        if failure is not None:
+            # Nodes that were already running have been allowed to finish so nothing writes into the
+            # caches after the error is reported.
+            self.success = False
+            self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, failure[0], failure[1])
+            return False
+        self.success = True
+        return True
+
 
 async def validate_inputs(prompt_id, prompt, item, validated):
     unique_id = item
@@ -999,10 +1095,90 @@ async def validate_prompt(prompt_id, prompt):
 
     return (True, None, list(good_outputs), node_errors)
 
+def get_prompt_model_files(prompt):
+    """
+    Returns the model files a prompt loads as a set of (input_name, filename) pairs, found from the
+    constant inputs of its loader nodes (ckpt_name, unet_name, lora_name...).
+    """
+    models = set()
+    for node in prompt.values():
+        for input_name, value in node.get("inputs", {}).items():
+            if isinstance(value, str) and os.path.splitext(value)[1].lower() in folder_paths.supported_pt_extensions:
+                models.add((input_name, value))
+    return frozenset(models)
+
+def same_priority(candidates):
+    """
+    The candidates queued with the same priority as the first one. Prompts queued at the front (with
+    a negative number) always run before the others, affinity only reorders prompts of one priority.
+    """
+    front = candidates[0][0] < 0
+    return [x for x in candidates if (x[0] < 0) == front]
+
+class ModelAffinityScheduler:
+    """
+    Picks the next prompt so that prompts using the same model files run back to back, which avoids
+    unloading and reloading models between them. Only the `window` oldest prompts are considered and
+    a prompt can't be passed over more than `window` times, so nothing waits forever.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.last_models = frozenset()
+        self.skipped = {}
+        self.model_swaps = 0
+        self.model_swaps_avoided = 0
+
+    def pop(self, queue, affinity=None):
+        if affinity is None:
+            last_models = self.last_models
+            def affinity(item):
+                return len(get_prompt_model_files(item[2]) & last_models)
+
+        candidates = same_priority(heapq.nsmallest(self.window, queue))
+        scores = [affinity(x) for x in candidates]
+        best = 0
+        if self.skipped.get(candidates[0][1], 0) < self.window:
+            best = scores.index(max(scores))
+            if scores[best] <= scores[0]:
+                best = 0
+
+        item = candidates[best]
+        for skipped_item in candidates[:best]:
+            self.skipped[skipped_item[1]] = self.skipped.get(skipped_item[1], 0) + 1
+        self.skipped.pop(item[1], None)
+        if best > 0:
+            self.model_swaps_avoided += 1
+            logging.debug("Running prompt {} before {} to avoid swapping models".format(item[1], candidates[0][1]))
+
+        models = get_prompt_model_files(item[2])
+        if len(self.last_models) > 0 and len(models) > 0 and scores[best] == 0:
+            self.model_swaps += 1
+        if len(models) > 0:
+            self.last_models = models
+
+        queue.remove(item)
+        heapq.heapify(queue)
+        return item
+
+    def removed(self, items):
+        """Called with the items that leave the queue without being run (deleted or cleared)."""
+        for item in items:
+            self.skipped.pop(item[1], None)
+
+    def get_stats(self):
+        return {
+            "window": self.window,
+            "model_swaps": self.model_swaps,
+            "model_swaps_avoided": self.model_swaps_avoided,
+        }
+
 MAXIMUM_HISTORY_SIZE = 10000
 
+# How many of the oldest queued prompts a worker may pick from when it has an affinity function
+AFFINITY_WINDOW = 8
+
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, model_affinity_window=0):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
@@ -1011,6 +1187,10 @@ class PromptQueue:
         self.currently_running = {}
         self.history = {}
         self.flags = {}
+        self.worker_flags = {}
+        self.scheduler = None
+        if model_affinity_window > 0:
+            self.scheduler = ModelAffinityScheduler(model_affinity_window)
 
     def put(self, item):
         with self.mutex:
@@ -1018,13 +1198,38 @@ class PromptQueue:
             self.server.queue_updated()
             self.not_empty.notify()
 
-    def get(self, timeout=None):
+    def peek(self, count):
+        """Returns up to count of the queued items, the ones that would run first first."""
+        with self.mutex:
+            return heapq.nsmallest(count, self.queue)
+
+    def register_worker(self, worker_id):
+        with self.mutex:
+            self.worker_flags[worker_id] = {}
+
+    def _pop_item(self, affinity=None):
+        if self.scheduler is not None:
+            return self.scheduler.pop(self.queue, affinity)
+        if affinity is None or len(self.queue) == 1:
+            return heapq.heappop(self.queue)
+        # Prefer one of the oldest prompts that this worker can run without swapping models.
+        candidates = same_priority(heapq.nsmallest(AFFINITY_WINDOW, self.queue))
+        scores = [affinity(x) for x in candidates]
+        best = scores.index(max(scores))
+        if scores[best] <= scores[0]:
+            return heapq.heappop(self.queue)
+        item = candidates[best]
+        self.queue.remove(item)
+        heapq.heapify(self.queue)
+        return item
+
+    def get(self, timeout=None, affinity=None):
         with self.not_empty:
             while len(self.queue) == 0:
                 self.not_empty.wait(timeout=timeout)
                 if timeout is not None and len(self.queue) == 0:
                     return None
-            item = heapq.heappop(self.queue)
+            item = self._pop_item(affinity)
             i = self.task_counter
             self.currently_running[i] = copy.deepcopy(item)
             self.task_counter += 1
@@ -1075,12 +1280,20 @@ class PromptQueue:
             queued = copy.copy(self.queue)
             return (running, queued)
 
+    def get_scheduler_stats(self):
+        with self.mutex:
+            if self.scheduler is None:
+                return None
+            return self.scheduler.get_stats()
+
     def get_tasks_remaining(self):
         with self.mutex:
             return len(self.queue) + len(self.currently_running)
 
     def wipe_queue(self):
         with self.mutex:
+            if self.scheduler is not None:
+                self.scheduler.removed(self.queue)
             self.queue = []
             self.server.queue_updated()
 
@@ -1088,6 +1301,8 @@ class PromptQueue:
         with self.mutex:
             for x in range(len(self.queue)):
                 if function(self.queue[x]):
+                    if self.scheduler is not None:
+                        self.scheduler.removed([self.queue[x]])
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
@@ -1127,13 +1342,17 @@ class PromptQueue:
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            for flags in self.worker_flags.values():
+                flags[name] = data
+            self.not_empty.notify_all()
 
-    def get_flags(self, reset=True):
+    def get_flags(self, reset=True, worker_id=None):
         with self.mutex:
-            if reset:
-                ret = self.flags
-                self.flags = {}
-                return ret
+            if worker_id is not None:
+                flags = self.worker_flags[worker_id]
             else:
-                return self.flags.copy()
+                flags = self.flags
+            ret = flags.copy()
+            if reset:
+                flags.clear()
+            return ret
@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import collections
+import hashlib
 import os
+import threading
 import time
 import mimetypes
 import logging
@@ -207,6 +210,32 @@ def exists_annotated_filepath(name) -> bool:
     return os.path.exists(filepath)
 
 
+file_fingerprint_cache: dict[str, tuple[tuple[int, int, int], str]] = {}
+file_fingerprint_lock = threading.Lock()
+
+def get_file_fingerprint(path: str) -> str:
+    """
+    Returns the sha256 hex digest of a file. Digests are cached by (size, mtime_ns, inode) so the file is
+    only read again when it changes. Meant for the IS_CHANGED of nodes that load input files.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    with file_fingerprint_lock:
+        cached = file_fingerprint_cache.get(path)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            m.update(chunk)
+    digest = m.digest().hex()
+    with file_fingerprint_lock:
+        file_fingerprint_cache[path] = (stat_key, digest)
+    return digest
+
+
 def add_model_folder_path(folder_name: str, full_folder_path: str, is_default: bool = False) -> None:
     global folder_names_and_paths
     folder_name = map_legacy(folder_name)
@@ -354,15 +383,87 @@ def get_filename_list(folder_name: str) -> list[str]:
     cache_helper.set(folder_name, out)
     return list(out[0])
 
+class SaveCounter:
+    """
+    Next free counters for the filename prefixes used in a folder, seeded by scanning the folder once
+    for all of them.
+
+    The folder is only scanned again when it was modified by something other than the files saved
+    with the counters handed out: those are found by probing for the names the previous files with
+    their prefix had (ComfyUI_00012_.png -> "_.png") and the folder must not have been modified well
+    after the newest of them.
+    """
+    MTIME_SLACK_NS = 2 * 10 ** 9
+    # Reservations probed to tell whether the files added to the folder were saved with them
+    RECENT_RESERVATIONS = 16
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.recent = collections.deque(maxlen=self.RECENT_RESERVATIONS)
+        self.scan()
+
+    def scan(self) -> None:
+        # normcase(prefix) -> next counter, file name suffixes
+        self.next = {}
+        self.suffixes = {}
+        for f in os.listdir(self.folder):
+            name = os.path.normcase(f)
+            # Any _ can be the end of the prefix: ComfyUI_temp_00001_.png is ComfyUI_temp counter 1
+            i = -1
+            while True:
+                i = name.find("_", i + 1)
+                if i < 0:
+                    break
+                digits = f[i + 1:].split('_')[0]
+                try:
+                    value = int(digits)
+                except:
+                    continue
+                prefix = name[:i]
+                self.next[prefix] = max(self.next.get(prefix, 1), value + 1)
+                suffixes = self.suffixes.setdefault(prefix, set())
+                if len(suffixes) < 8 and f"{value:05}" == digits:
+                    suffixes.add(f[i + 1 + len(digits):])
+        self.mtime = os.stat(self.folder).st_mtime_ns
+
+    def probe(self, filename: str, counter: int) -> int | None:
+        # Returns the mtime of the newest file saved with this prefix and counter
+        newest = None
+        for suffix in self.suffixes.get(os.path.normcase(filename), ()):
+            try:
+                mtime = os.stat(os.path.join(self.folder, f"{filename}_{counter:05}{suffix}")).st_mtime_ns
+            except OSError:
+                continue
+            newest = mtime if newest is None else max(newest, mtime)
+        return newest
+
+    def reserve(self, filename: str) -> int:
+        mtime = os.stat(self.folder).st_mtime_ns
+        if mtime != self.mtime:
+            newest = None
+            for name, counter in self.recent:
+                while True:
+                    saved = self.probe(name, counter)
+                    if saved is None:
+                        break
+                    newest = saved if newest is None else max(newest, saved)
+                    counter += 1
+            if newest is None or mtime > newest + self.MTIME_SLACK_NS:
+                self.scan()
+        prefix = os.path.normcase(filename)
+        counter = self.next.get(prefix, 1)
+        # Files saved in a batch use the following counters
+        while self.probe(filename, counter) is not None:
+            counter += 1
+        self.next[prefix] = counter + 1
+        self.recent.append((filename, counter))
+        self.mtime = mtime
+        return counter
+
+save_counters: dict[str, SaveCounter] = {}
+save_counters_lock = threading.Lock()
+
 def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, image_height=0) -> tuple[str, str, int, str, str]:
-    def map_filename(filename: str) -> tuple[int, str]:
-        prefix_len = len(os.path.basename(filename_prefix))
-        prefix = filename[:prefix_len + 1]
-        try:
-            digits = int(filename[prefix_len + 1:].split('_')[0])
-        except:
-            digits = 0
-        return digits, prefix
 
     def compute_vars(input: str, image_width: int, image_height: int) -> str:
         input = input.replace("%width%", str(image_width))
@@ -392,13 +493,16 @@ def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, im
         logging.error(err)
         raise Exception(err)
 
-    try:
-        counter = max(filter(lambda a: os.path.normcase(a[1][:-1]) == os.path.normcase(filename) and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
-    except ValueError:
-        counter = 1
-    except FileNotFoundError:
+    if not os.path.isdir(full_output_folder):
         os.makedirs(full_output_folder, exist_ok=True)
-        counter = 1
+
+    key = os.path.normcase(os.path.abspath(full_output_folder))
+    with save_counters_lock:
+        save_counter = save_counters.get(key)
+        if save_counter is None:
+            save_counter = SaveCounter(full_output_folder)
+            save_counters[key] = save_counter
+        counter = save_counter.reserve(filename)
     return full_output_folder, filename, counter, subfolder, filename_prefix
 
 def get_input_subfolders() -> list[str]:
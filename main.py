@@ -136,10 +136,14 @@ if 'torch' in sys.modules:
 import comfy.utils
 
 import execution
+import comfy_execution.background_writer
+import comfy_execution.caching
+import comfy_execution.prefetch
 import server
 from protocol import BinaryEventTypes
 import nodes
 import comfy.model_management
+import comfy.model_eviction
 import comfyui_version
 import app.logger
 import hook_breaker_ac10a0
@@ -156,41 +160,80 @@ def cuda_malloc_warning():
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
 
-def prompt_worker(q, server_instance):
+def prompt_worker(q, server_instance, worker_id=None, device=None, disk_cache=None):
     current_time: float = 0.0
     cache_type = execution.CacheType.CLASSIC
+    cache_size = args.cache_lru
+    vram_cache_size = None
+    if args.cache_vram is not None:
+        vram_cache_size = int(args.cache_vram * 1024 * 1024 * 1024)
     if args.cache_lru > 0:
         cache_type = execution.CacheType.LRU
+    elif args.cache_ram > 0:
+        cache_type = execution.CacheType.MEMORY_BUDGET
+        cache_size = int(args.cache_ram * 1024 * 1024 * 1024)
     elif args.cache_none:
         cache_type = execution.CacheType.DEPENDENCY_AWARE
 
-    e = execution.PromptExecutor(server_instance, cache_type=cache_type, cache_size=args.cache_lru)
+    if device is not None:
+        comfy.model_management.set_torch_device_override(device)
+
+    e = execution.PromptExecutor(server_instance, cache_type=cache_type, cache_size=cache_size, parallel_workers=args.parallel_execution, disk_cache=disk_cache, vram_cache_size=vram_cache_size)
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
 
+    # When there are several workers, prefer prompts that use the models loaded by the last prompt this worker ran.
+    affinity = None
+    worker_models = frozenset()
+    if worker_id is not None:
+        def affinity(item):
+            return len(execution.get_prompt_model_files(item[2]) & worker_models)
+
     while True:
         timeout = 1000.0
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
+        queue_item = q.get(timeout=timeout, affinity=affinity)
         if queue_item is not None:
             item, item_id = queue_item
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server_instance.last_prompt_id = prompt_id
+            server_instance.client_id = item[3].get("client_id", None)
+
+            if comfy.model_eviction.get_eviction_policy().uses_upcoming:
+                upcoming_files = [path for x in q.peek(comfy.model_eviction.UPCOMING_PROMPTS) for path in comfy_execution.prefetch.prompt_model_paths(x[2])]
+                comfy.model_eviction.set_upcoming_models([m for path in upcoming_files for m in comfy.model_management.models_for_file(path)])
+
+            prefetcher = comfy_execution.prefetch.get_model_prefetcher()
+            if prefetcher is not None:
+                prefetcher.prefetch([x[2] for x in q.peek(args.prefetch_models)], running=item[2])
 
             e.execute(item[2], prompt_id, item[3], item[4])
+            if worker_id is not None:
+                worker_models = execution.get_prompt_model_files(item[2])
             need_gc = True
-            q.task_done(item_id,
-                        e.history_result,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server_instance.client_id is not None:
-                server_instance.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server_instance.client_id)
+
+            def prompt_done(write_errors, item_id=item_id, prompt_id=prompt_id, history_result=e.history_result, success=e.success, messages=e.status_messages, client_id=server_instance.client_id):
+                if len(write_errors) > 0:
+                    success = False
+                    messages = messages + [("execution_error", {"prompt_id": prompt_id, "exception_message": "Failed to write output files: {}".format(write_errors[0]), "timestamp": int(time.time() * 1000)})]
+                q.task_done(item_id,
+                            history_result,
+                            status=execution.PromptQueue.ExecutionStatus(
+                                status_str='success' if success else 'error',
+                                completed=success,
+                                messages=messages))
+                if client_id is not None:
+                    server_instance.send_sync("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+
+            writer = comfy_execution.background_writer.get_background_writer()
+            if writer is not None:
+                writer.when_done(prompt_id, prompt_done)
+            else:
+                prompt_done([])
 
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
@@ -202,7 +245,7 @@ def prompt_worker(q, server_instance):
             else:
                 logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
 
-        flags = q.get_flags()
+        flags = q.get_flags(worker_id=worker_id)
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
@@ -225,6 +268,32 @@ def prompt_worker(q, server_instance):
                 hook_breaker_ac10a0.restore_functions()
 
 
+def start_prompt_workers(server_instance):
+    q = server_instance.prompt_queue
+    disk_cache = None
+    if args.disk_cache_size > 0:
+        disk_cache_directory = args.disk_cache_directory
+        if disk_cache_directory is None:
+            disk_cache_directory = os.path.join(folder_paths.get_user_directory(), "node_cache")
+        disk_cache = comfy_execution.caching.DiskCache(disk_cache_directory, int(args.disk_cache_size * 1024 * 1024 * 1024), node_classes=args.disk_cache_nodes)
+
+    if args.prompt_workers <= 1:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server_instance,), kwargs={"disk_cache": disk_cache}).start()
+        return
+
+    devices = comfy.model_management.get_all_torch_devices()
+    if len(devices) == 0:
+        devices = [comfy.model_management.get_torch_device()]
+    if args.prompt_workers > len(devices) and not comfy.model_management.is_device_cpu(devices[0]):
+        logging.warning("WARNING: {} prompt workers but only {} devices, workers on the same device will compete for its memory.".format(args.prompt_workers, len(devices)))
+
+    for worker_id in range(args.prompt_workers):
+        device = devices[worker_id % len(devices)]
+        logging.info("Starting prompt worker {} on device {}".format(worker_id, device))
+        q.register_worker(worker_id)
+        threading.Thread(target=prompt_worker, daemon=True, name="prompt_worker_{}".format(worker_id), args=(q, server_instance, worker_id, device, disk_cache)).start()
+
+
 async def run(server_instance, address='', port=8188, verbose=True, call_on_start=None):
     addresses = []
     for addr in address.split(","):
@@ -316,7 +385,7 @@ def start_comfyui(asyncio_loop=None):
     prompt_server.add_routes()
     hijack_progress(prompt_server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(prompt_server.prompt_queue, prompt_server,)).start()
+    start_prompt_workers(prompt_server)
 
     if args.quick_test_for_ci:
         exit(0)
@@ -4,7 +4,6 @@ import torch
 import os
 import sys
 import json
-import hashlib
 import traceback
 import math
 import time
@@ -34,6 +33,7 @@ from comfy.cli_args import args
 
 import importlib
 
+import comfy_execution.background_writer
 import folder_paths
 import latent_preview
 import node_helpers
@@ -41,8 +41,8 @@ import node_helpers
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
 
-def interrupt_processing(value=True):
-    comfy.model_management.interrupt_current_processing(value)
+def interrupt_processing(value=True, prompt_id=None):
+    comfy.model_management.interrupt_current_processing(value, prompt_id=prompt_id)
 
 MAX_RESOLUTION=16384
 
@@ -58,6 +58,7 @@ class CLIPTextEncode(ComfyNodeABC):
     RETURN_TYPES = (IO.CONDITIONING,)
     OUTPUT_TOOLTIPS = ("A conditioning containing the embedded text used to guide the diffusion model.",)
     FUNCTION = "encode"
+    PERSISTENT_CACHE = True
 
     CATEGORY = "conditioning"
     DESCRIPTION = "Encodes a text prompt using a CLIP model into an embedding that can be used to guide the diffusion model towards generating specific images."
@@ -331,6 +332,7 @@ class VAEEncode:
         return {"required": { "pixels": ("IMAGE", ), "vae": ("VAE", )}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "encode"
+    PERSISTENT_CACHE = True
 
     CATEGORY = "latent"
 
@@ -362,6 +364,7 @@ class VAEEncodeForInpaint:
         return {"required": { "pixels": ("IMAGE", ), "vae": ("VAE", ), "mask": ("MASK", ), "grow_mask_by": ("INT", {"default": 6, "min": 0, "max": 64, "step": 1}),}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "encode"
+    PERSISTENT_CACHE = True
 
     CATEGORY = "latent/inpaint"
 
@@ -523,10 +526,7 @@ class LoadLatent:
     @classmethod
     def IS_CHANGED(s, latent):
         image_path = folder_paths.get_annotated_filepath(latent)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, latent):
@@ -1550,11 +1550,17 @@ class KSamplerAdvanced:
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
 
 class SaveImage:
+    image_format = "png"
+
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
         self.type = "output"
         self.prefix_append = ""
         self.compress_level = 4
+        if args.save_image_format == "png-fast":
+            self.compress_level = 1
+        elif args.save_image_format == "webp-lossless":
+            self.image_format = "webp"
 
     @classmethod
     def INPUT_TYPES(s):
@@ -1572,29 +1578,50 @@ class SaveImage:
     FUNCTION = "save_images"
 
     OUTPUT_NODE = True
+    DEVICE_NODE = False
 
     CATEGORY = "image"
     DESCRIPTION = "Saves the input images to your ComfyUI output directory."
 
-    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
-        filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
-        results = list()
-        for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
+    def write_image(self, path, image, prompt=None, extra_pnginfo=None):
+        i = 255. * image.numpy()
+        img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+        if self.image_format == "webp":
+            exif = img.getexif()
             if not args.disable_metadata:
-                metadata = PngInfo()
                 if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
+                    exif[0x0110] = "prompt:{}".format(json.dumps(prompt))
                 if extra_pnginfo is not None:
+                    inital_exif = 0x010f
                     for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+                        exif[inital_exif] = "{}:{}".format(x, json.dumps(extra_pnginfo[x]))
+                        inital_exif -= 1
+            img.save(path, exif=exif, lossless=True, quality=80, method=0)
+            return
 
+        metadata = None
+        if not args.disable_metadata:
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add_text("prompt", json.dumps(prompt))
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+        img.save(path, pnginfo=metadata, compress_level=self.compress_level)
+
+    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+        filename_prefix += self.prefix_append
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        writer = comfy_execution.background_writer.get_background_writer()
+        images = images.cpu()
+        results = list()
+        for (batch_number, image) in enumerate(images):
             filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-            file = f"{filename_with_batch_num}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
+            file = f"{filename_with_batch_num}_{counter:05}_.{self.image_format}"
+            if writer is not None:
+                writer.submit(os.path.join(full_output_folder, file), self.write_image, image, prompt, extra_pnginfo)
+            else:
+                self.write_image(os.path.join(full_output_folder, file), image, prompt, extra_pnginfo)
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -1632,6 +1659,8 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    DEVICE_NODE = False
+
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
 
@@ -1682,10 +1711,7 @@ class LoadImage:
     @classmethod
     def IS_CHANGED(s, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1709,6 +1735,8 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    DEVICE_NODE = False
+
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = node_helpers.pillow(Image.open, image_path)
@@ -1731,10 +1759,7 @@ class LoadImageMask:
     @classmethod
     def IS_CHANGED(s, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -2283,7 +2308,9 @@ def init_builtin_extra_nodes():
         "nodes_string.py",
         "nodes_camera_trajectory.py",
         "nodes_edit_model.py",
-        "nodes_tcfg.py"
+        "nodes_tcfg.py",
+        "nodes_uncond_cache.py",
+        "nodes_block_cache.py",
     ]
 
     import_failed = []
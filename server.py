@@ -1,6 +1,7 @@
 import os
 import sys
 import asyncio
+import contextvars
 import traceback
 
 import nodes
@@ -26,6 +27,11 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.model_eviction
+import comfy.host_memory
+import comfy.weight_dedup
+import comfy.model_index
+import comfy_execution.background_writer
 from comfy_api import feature_flags
 import node_helpers
 from comfyui_version import __version__
@@ -144,7 +150,30 @@ def create_origin_only_middleware():
 
     return origin_only_middleware
 
+class PerWorkerAttribute:
+    """
+    Attribute with a separate value for each prompt worker thread so that concurrent workers don't send
+    messages to each other's clients. Code running outside of a worker (like the websocket handlers)
+    sees whichever value was set last.
+    """
+    def __set_name__(self, owner, name):
+        self.var = contextvars.ContextVar(name)
+        self.last_value_name = "_last_" + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.var.get(getattr(obj, self.last_value_name, None))
+
+    def __set__(self, obj, value):
+        setattr(obj, self.last_value_name, value)
+        self.var.set(value)
+
 class PromptServer():
+    client_id = PerWorkerAttribute()
+    last_node_id = PerWorkerAttribute()
+    last_prompt_id = PerWorkerAttribute()
+
     def __init__(self, loop):
         PromptServer.instance = self
 
@@ -157,7 +186,7 @@ class PromptServer():
         self.custom_node_manager = CustomNodeManager()
         self.internal_routes = InternalRoutes(self)
         self.supports = ["custom_nodes_from_web"]
-        self.prompt_queue = execution.PromptQueue(self)
+        self.prompt_queue = execution.PromptQueue(self, model_affinity_window=args.queue_model_affinity)
         self.loop = loop
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
@@ -184,8 +213,6 @@ class PromptServer():
         logging.info(f"[Prompt Server] web root: {self.web_root}")
         routes = web.RouteTableDef()
         self.routes = routes
-        self.last_node_id = None
-        self.client_id = None
 
         self.on_prompt_handlers = []
 
@@ -273,6 +300,11 @@ class PromptServer():
             folder = request.match_info.get("folder", None)
             if not folder in folder_paths.folder_names_and_paths:
                 return web.Response(status=404)
+            if request.rel_url.query.get("info", "false") == "true":
+                # Architecture, parameter count and dtype of each file, read from the safetensors headers.
+                model_index = comfy.model_index.get_model_index()
+                info = await asyncio.get_running_loop().run_in_executor(None, model_index.describe_folder, folder)
+                return web.json_response(info)
             files = folder_paths.get_filename_list(folder)
             return web.json_response(files)
 
@@ -446,6 +478,11 @@ class PromptServer():
                 filename = os.path.basename(filename)
                 file = os.path.join(output_dir, filename)
 
+                writer = comfy_execution.background_writer.get_background_writer()
+                if writer is not None:
+                    # The file might still be being written in the background
+                    await asyncio.get_running_loop().run_in_executor(None, writer.wait_for_path, file)
+
                 if os.path.isfile(file):
                     if 'preview' in request.rel_url.query:
                         with Image.open(file) as img:
@@ -575,8 +612,15 @@ class PromptServer():
                         "torch_vram_total": torch_vram_total,
                         "torch_vram_free": torch_vram_free,
                     }
-                ]
+                ],
+                "model_eviction": comfy.model_eviction.get_eviction_policy().get_stats(),
             }
+            host_memory_tier = comfy.host_memory.get_host_memory_tier()
+            if host_memory_tier is not None:
+                system_stats["host_memory"] = host_memory_tier.get_stats()
+            weight_deduplicator = comfy.weight_dedup.get_weight_deduplicator()
+            if weight_deduplicator is not None:
+                system_stats["weight_dedup"] = weight_deduplicator.get_stats()
             return web.json_response(system_stats)
 
         @routes.get("/features")
@@ -658,6 +702,9 @@ class PromptServer():
             current_queue = self.prompt_queue.get_current_queue_volatile()
             queue_info['queue_running'] = current_queue[0]
             queue_info['queue_pending'] = current_queue[1]
+            scheduler_stats = self.prompt_queue.get_scheduler_stats()
+            if scheduler_stats is not None:
+                queue_info['scheduler'] = scheduler_stats
             return web.json_response(queue_info)
 
         @routes.post("/prompt")
@@ -719,7 +766,13 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            try:
+                json_data = await request.json()
+            except json.JSONDecodeError:
+                json_data = {}
+            # Only interrupt this prompt when several prompt workers are running prompts
+            prompt_id = json_data.get("prompt_id", None) if isinstance(json_data, dict) else None
+            nodes.interrupt_processing(prompt_id=prompt_id)
             return web.Response(status=200)
 
         @routes.post("/free")
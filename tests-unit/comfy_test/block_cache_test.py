@@ -0,0 +1,109 @@
+import pytest
+import torch
+
+import comfy.block_cache
+import comfy.ldm.flux.model
+import comfy.ldm.modules.diffusionmodules.mmdit
+import comfy.ldm.wan.model
+import comfy.ops
+
+
+def randomly_initialized(model):
+    g = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for p in list(model.parameters()) + list(model.buffers()):
+            p.copy_(torch.randn(p.shape, generator=g) * 0.2)
+    return model
+
+
+def tiny_flux():
+    model = comfy.ldm.flux.model.Flux(in_channels=4, out_channels=4, vec_in_dim=8, context_in_dim=8, hidden_size=32, mlp_ratio=2.0, num_heads=2,
+                                      depth=2, depth_single_blocks=2, axes_dim=[4, 6, 6], theta=10000, patch_size=2, qkv_bias=True, guidance_embed=False,
+                                      operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(1, 3, 8, generator=g)}, (1, 4, 8, 8)
+
+
+def tiny_mmdit():
+    # The last joint block only outputs image tokens
+    model = comfy.ldm.modules.diffusionmodules.mmdit.MMDiT(patch_size=2, in_channels=4, depth=2, adm_in_channels=8, pos_embed_max_size=16, num_patches=256,
+                                                           context_embedder_config={"target": "torch.nn.Linear", "params": {"in_features": 8, "out_features": 128}},
+                                                           operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(1, 5, 8, generator=g), "y": torch.randn(1, 8, generator=g)}, (1, 4, 16, 16)
+
+
+def tiny_wan():
+    model = comfy.ldm.wan.model.WanModel(patch_size=(1, 2, 2), text_len=5, in_dim=4, dim=32, ffn_dim=64, freq_dim=16, text_dim=8, out_dim=4, num_heads=2,
+                                         num_layers=3, operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(1, 5, 8, generator=g)}, (1, 4, 2, 8, 8)
+
+
+def patched_options(cache, model, uuids=(1,)):
+    blocks = {}
+    count = max(len(m) for m in model.children() if isinstance(m, torch.nn.ModuleList))
+    for kind in ("double_block", "single_block"):
+        for i in range(count):
+            blocks[(kind, i)] = cache.block_patch((kind, i))
+    return {"patches_replace": {"dit": blocks}, "cond_or_uncond": [0] * len(uuids), "uuids": list(uuids)}
+
+
+@torch.no_grad()
+def run(model, cache, x, sigma, inputs, transformer_options, control=None):
+    t = torch.full((x.shape[0],), sigma)
+    with cache.model_call(x, t, transformer_options, control=control):
+        return model(x, t, transformer_options=transformer_options, **inputs)
+
+
+@pytest.mark.parametrize("model_fn", [tiny_flux, tiny_mmdit, tiny_wan])
+def test_block_cache(model_fn):
+    model, inputs, shape = model_fn()
+    x = torch.randn(shape, generator=torch.Generator().manual_seed(1))
+    cache = comfy.block_cache.BlockCache(0.05, model_name="Tiny" + model_fn.__name__)
+    options = patched_options(cache, model)
+
+    with torch.no_grad():
+        expected = [model(x, torch.full((1,), s), **inputs) for s in (0.5, 0.49999, 0.3)]
+
+    # All the blocks run on the first call
+    out = run(model, cache, x, 0.5, inputs, options)
+    assert torch.equal(out, expected[0])
+    assert cache.get_stats()["skipped_calls"] == 0
+
+    # Almost the same input: the output of the blocks is reused
+    out = run(model, cache, x, 0.49999, inputs, options)
+    assert cache.get_stats()["skipped_calls"] == 1
+    assert not torch.equal(out, expected[1])
+    assert ((out - expected[1]).norm() / expected[1].norm()) < 0.01
+
+    # A different batch of conds has its own cache
+    x2 = torch.cat((x, x))
+    run(model, cache, x2, 0.49999, {k: torch.cat((v, v)) for k, v in inputs.items()}, patched_options(cache, model, uuids=(1, 2)))
+    assert cache.get_stats()["skipped_calls"] == 1
+
+    # Large change: everything runs again
+    out = run(model, cache, x * 0.5, 0.3, inputs, options)
+    assert cache.get_stats()["skipped_calls"] == 1
+    with torch.no_grad():
+        assert torch.equal(out, model(x * 0.5, torch.full((1,), 0.3), **inputs))
+
+
+def test_calibration_and_range():
+    model, inputs, shape = tiny_flux()
+    x = torch.randn(shape, generator=torch.Generator().manual_seed(2))
+    cache = comfy.block_cache.BlockCache(0.0, sigma_start=0.6, model_name="TinyFluxCalibration")
+    options = patched_options(cache, model)
+    for sigma in (0.9, 0.8, 0.7):
+        run(model, cache, x * sigma, sigma, inputs, options)
+    # Measured on the calls that ran every block
+    assert cache.scale() != 1.0
+    assert cache.get_stats()["calls"] == 3
+
+    cache.threshold = 1e6
+    # Outside of the sigma range or with a controlnet nothing is skipped
+    run(model, cache, x, 0.65, inputs, options, control={"input": [], "output": []})
+    run(model, cache, x, 0.65, inputs, options)
+    assert cache.get_stats()["skipped_calls"] == 0
+    run(model, cache, x, 0.5, inputs, options)
+    assert cache.get_stats()["skipped_calls"] == 1
@@ -0,0 +1,84 @@
+import math
+
+import pytest
+import torch
+
+import comfy.conds
+import comfy.model_management
+import comfy.samplers
+
+MB = 1024 * 1024
+
+
+class Patcher:
+    def prepare_state(self, timestep):
+        pass
+
+    def apply_hooks(self, hooks):
+        return {}
+
+
+class Model:
+    def __init__(self):
+        self.current_patcher = Patcher()
+        self.batch_sizes = []
+        self.memory_required_calls = 0
+
+    def memory_required(self, input_shape, cond_shapes={}):
+        self.memory_required_calls += 1
+        return math.prod(input_shape) * MB
+
+    def apply_model(self, x, t, c_crossattn=None, transformer_options={}):
+        self.batch_sizes.append(x.shape[0])
+        return x * c_crossattn.mean(dim=(1, 2)).reshape(-1, 1, 1, 1)
+
+
+def cond(value, **kwargs):
+    c = {"model_conds": {"c_crossattn": comfy.conds.CONDCrossAttn(torch.full((1, 4, 8), value))}, "uuid": value}
+    c.update(kwargs)
+    return c
+
+
+@pytest.fixture(autouse=True)
+def free_memory(monkeypatch):
+    # Room for 2 conds in a model call
+    monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda dev=None, torch_free_too=False: 4 * 2 * 2 * 2 * MB * 1.5 + 1)
+
+
+def test_plan_is_reused_between_steps():
+    model = Model()
+    conds = [[cond(1.0), cond(2.0)], [cond(3.0), cond(4.0, timestep_end=0.5)]]
+    x = torch.randn(1, 4, 2, 2)
+    model_options = {"cond_batch_planner": comfy.samplers.CondBatchPlanner()}
+
+    out = comfy.samplers.calc_cond_batch(model, conds, x, torch.tensor([0.9]), model_options)
+    assert model.batch_sizes == [2, 2]
+    planned = model.memory_required_calls
+    expected = comfy.samplers.calc_cond_batch(Model(), conds, x, torch.tensor([0.9]), {})
+    for a, b in zip(out, expected):
+        assert torch.equal(a, b)
+
+    # Same conds: no planning
+    comfy.samplers.calc_cond_batch(model, conds, x, torch.tensor([0.8]), model_options)
+    assert model.memory_required_calls == planned
+    assert model.batch_sizes == [2, 2, 2, 2]
+
+    # One of the conds stops applying: new plan
+    comfy.samplers.calc_cond_batch(model, conds, x, torch.tensor([0.3]), model_options)
+    assert model.memory_required_calls > planned
+    assert model.batch_sizes[4:] == [1, 2]
+
+
+def test_calibrated_memory_factor():
+    model = Model()
+    planner = comfy.samplers.CondBatchPlanner()
+    assert planner.memory_factor(model) == comfy.samplers.CondBatchPlanner.MEMORY_SAFETY_FACTOR
+    # The model was measured using less than estimated: 4 conds fit in the same free memory
+    comfy.samplers.CondBatchPlanner.memory_ratios[model] = 0.5
+    conds = [[cond(1.0), cond(2.0)], [cond(3.0), cond(4.0)]]
+    comfy.samplers.calc_cond_batch(model, conds, torch.randn(1, 4, 2, 2), torch.tensor([0.9]), {"cond_batch_planner": planner})
+    assert model.batch_sizes == [4]
+
+    planner.out_of_memory(model)
+    assert planner.memory_factor(model) > 0.5 * comfy.samplers.CondBatchPlanner.CALIBRATION_MARGIN
+    assert len(planner.plans) == 0
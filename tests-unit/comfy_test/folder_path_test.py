@@ -115,6 +115,55 @@ def test_get_save_image_path(temp_dir):
         assert subfolder == ""
         assert filename_prefix == "test"
 
+def test_get_save_image_path_counter(temp_dir):
+    def save(prefix, count=1, ext="png"):
+        full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(prefix, temp_dir)
+        for i in range(count):
+            open(os.path.join(full_output_folder, f"{filename}_{counter + i:05}_.{ext}"), "w").close()
+        return counter
+
+    with open(os.path.join(temp_dir, "test_00041_.png"), "w"):
+        pass
+    assert save("test") == 42
+    assert save("test", count=3) == 43
+    assert save("test") == 46
+    assert save("other") == 1
+    assert save("sub/test") == 1
+
+    # Files saved by something else with the same names
+    open(os.path.join(temp_dir, "test_00047_.png"), "w").close()
+    assert save("test") == 48
+    open(os.path.join(temp_dir, "test_00100_.webp"), "w").close()
+    newer = os.stat(temp_dir).st_mtime_ns + 10 * 10 ** 9
+    os.utime(temp_dir, ns=(newer, newer))
+    assert save("test", ext="webp") == 101
+    assert save("test") == 102
+
+def test_get_save_image_path_does_not_list_folder(temp_dir):
+    def save():
+        full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path("test", temp_dir)
+        open(os.path.join(full_output_folder, f"{filename}_{counter:05}_.png"), "w").close()
+        return counter
+
+    # The second save scans again to learn the file names used with the prefix
+    assert save() == 1
+    assert save() == 2
+    with patch("os.listdir", side_effect=AssertionError("listdir")):
+        assert [save() for _ in range(3)] == [3, 4, 5]
+
+
+def test_get_save_image_path_prefixes_share_the_folder_index(temp_dir):
+    def save(prefix):
+        full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(prefix, temp_dir)
+        open(os.path.join(full_output_folder, f"{filename}_{counter:05}_.png"), "w").close()
+        return counter
+
+    for name in ("a_00003_.png", "a_b_00007_.png", "c_00001_.png"):
+        open(os.path.join(temp_dir, name), "w").close()
+    with patch("os.listdir", wraps=os.listdir) as listdir:
+        assert [save(p) for p in ("a", "a_b", "c", "a", "a_b", "c", "d")] == [4, 8, 2, 5, 9, 3, 1]
+        assert listdir.call_count == 1
+
 
 def test_base_path_changes(set_base_dir):
     test_dir = os.path.abspath("/test/dir")
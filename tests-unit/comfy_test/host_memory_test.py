@@ -0,0 +1,118 @@
+import gc
+
+import torch
+
+import comfy.host_memory
+import comfy.model_patcher
+import comfy.weight_adapter
+
+MB = 1024 * 1024
+
+
+class Model(torch.nn.Module):
+    def __init__(self, mb):
+        super().__init__()
+        self.linear = torch.nn.Linear(mb * MB // 4 // 64, 64)
+        self.register_buffer("scale", torch.ones(3))
+
+
+def offloaded_patcher(mb):
+    # Pretend the model was loaded on a GPU and is now back on the cpu
+    patcher = comfy.model_patcher.ModelPatcher(Model(mb), load_device=torch.device("cuda"), offload_device=torch.device("cpu"))
+    return patcher
+
+
+def state(model):
+    return {k: v.clone() for k, v in model.state_dict().items()}
+
+
+def test_packs_offloaded_weights_in_pool(tmp_path):
+    tier = comfy.host_memory.HostMemoryTier(16 * MB, pin=False, spill_dir=str(tmp_path))
+    patcher = offloaded_patcher(2)
+    before = state(patcher.model)
+    tier.offloaded(patcher)
+
+    buffer = tier.entries[id(patcher.model)].buffer
+    weight = patcher.model.linear.weight
+    assert buffer.data_ptr() <= weight.data_ptr() < buffer.data_ptr() + buffer.numel()
+    assert isinstance(weight, torch.nn.Parameter)
+    for k, v in state(patcher.model).items():
+        assert torch.equal(v, before[k])
+    assert tier.get_stats()["models_resident"] == 1
+
+    # Offloading again packs in the same buffer
+    tier.offloaded(patcher)
+    assert tier.entries[id(patcher.model)].buffer is buffer
+    assert tier.pool.allocated == buffer.numel()
+
+    # Once the model is gone its buffer is reused
+    del patcher, weight
+    gc.collect()
+    assert tier.get_stats()["models_resident"] == 0
+    tier.offloaded(offloaded_patcher(2))
+    assert tier.pool.reused == 1
+
+
+def test_demotes_least_recently_used_models(tmp_path):
+    tier = comfy.host_memory.HostMemoryTier(5 * MB, pin=False, spill_dir=str(tmp_path))
+    patchers = [offloaded_patcher(2) for _ in range(3)]
+    states = [state(p.model) for p in patchers]
+    # The first model is used again before the third one gets offloaded
+    for p in (patchers[0], patchers[1], patchers[0], patchers[2]):
+        tier.offloaded(p)
+
+    stats = tier.get_stats()
+    assert stats["models_demoted"] == 1 and stats["demotions"] == 1
+    assert stats["resident_bytes"] <= 5 * MB
+    assert tier.entries[id(patchers[1].model)].demoted
+    # The weights of the demoted model are still there, read from the mapped file
+    for p, s in zip(patchers, states):
+        for k, v in state(p.model).items():
+            assert torch.equal(v, s[k])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_releases_buffer_once_fully_loaded(tmp_path):
+    tier = comfy.host_memory.HostMemoryTier(16 * MB, pin=False, spill_dir=str(tmp_path))
+    patcher = offloaded_patcher(2)
+    tier.offloaded(patcher)
+
+    # Partially loaded: the buffer still holds the weights left on the cpu
+    patcher.model.linear.to("meta")
+    tier.loaded(patcher)
+    assert tier.pool.free_bytes() == 0
+
+    patcher.model.to("meta")
+    tier.loaded(patcher)
+    assert tier.get_stats()["models_resident"] == 0
+    assert tier.pool.free_bytes() == tier.pool.allocated
+
+
+def test_keeps_buffer_of_backed_up_weights(tmp_path):
+    tier = comfy.host_memory.HostMemoryTier(16 * MB, pin=False, spill_dir=str(tmp_path))
+    patcher = comfy.model_patcher.ModelPatcher(torch.nn.Sequential(torch.nn.Linear(64, 64, bias=False)), load_device=torch.device("cuda"), offload_device=torch.device("cpu"))
+    before = state(patcher.model)
+    tier.offloaded(patcher)
+
+    # Patch with a LoRA then "load": the patched weight goes to the device, its backup is the packed weight
+    lora = comfy.weight_adapter.LoRAAdapter(set(), (torch.randn(64, 4), torch.randn(4, 64), None, None, None, None))
+    patcher.add_patches({"0.weight": lora}, 0.5)
+    patcher.patch_model()
+    assert "0.weight" in patcher.backup
+    patcher.model[0].weight = torch.nn.Parameter(patcher.model[0].weight.to("meta"), requires_grad=False)
+    tier.loaded(patcher)
+
+    # Offloading another model must not reuse the buffer the backup is in
+    other = torch.nn.Linear(64, 64, bias=False)
+    torch.nn.init.constant_(other.weight, 7.0)
+    tier.offloaded(comfy.model_patcher.ModelPatcher(other, load_device=torch.device("cuda"), offload_device=torch.device("cpu")))
+    assert tier.pool.reused == 0
+
+    patcher.unpatch_model(torch.device("cpu"))
+    for k, v in state(patcher.model).items():
+        assert torch.equal(v, before[k])
+
+    # Once unpatched the model's buffer is released when it is loaded again
+    patcher.model.to("meta")
+    tier.loaded(patcher)
+    assert tier.pool.free_bytes() > 0
@@ -0,0 +1,49 @@
+import pytest
+import safetensors.torch
+import torch
+
+import comfy.utils
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    sd = {
+        "model.weight": torch.randn(16, 8),
+        "model.bias": torch.randn(8).to(torch.bfloat16),
+        "model.scale": torch.tensor(2.0, dtype=torch.float16),
+        "model.odd": torch.arange(3, dtype=torch.uint8),
+        "model.ids": torch.arange(5, dtype=torch.int64),
+        "model.empty": torch.zeros(0, 4),
+    }
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file(sd, path, metadata={"format": "pt"})
+    return path, sd
+
+
+def test_mmap_matches_safetensors(checkpoint):
+    path, sd = checkpoint
+    loaded, metadata = comfy.utils.load_torch_file(path, return_metadata=True)
+    assert metadata == {"format": "pt"}
+    assert list(loaded.keys()) == sorted(sd.keys())
+    for k in sd:
+        assert loaded[k].dtype == sd[k].dtype
+        assert torch.equal(loaded[k], sd[k])
+
+
+def test_mmap_is_copy_on_write(checkpoint):
+    path, sd = checkpoint
+    loaded = comfy.utils.load_torch_file(path)
+    loaded["model.weight"].zero_()
+    # Each tensor has its own storage, which safetensors requires to save them again
+    safetensors.torch.save_file(loaded, path + ".copy")
+    assert torch.equal(comfy.utils.load_torch_file(path)["model.weight"], sd["model.weight"])
+
+
+def test_truncated_file_error(checkpoint):
+    path, sd = checkpoint
+    with open(path, "r+b") as f:
+        f.seek(0, 2)
+        f.truncate(f.tell() - 16)
+    # Falls back to safetensors which reports the problem
+    with pytest.raises(Exception, match="(?i)incomplete"):
+        comfy.utils.load_torch_file(path)
@@ -0,0 +1,59 @@
+import logging
+import time
+
+import torch
+
+import comfy.lora
+import comfy.weight_adapter
+
+
+def lora_stack(shape, count, rank, generator, dtype=torch.float16):
+    patches = []
+    for i in range(count):
+        up = torch.randn(shape[0], rank, generator=generator).to(dtype)
+        down = torch.randn(rank, shape[1], generator=generator).to(dtype)
+        adapter = comfy.weight_adapter.LoRAAdapter(set(), (up, down, float(rank), None, None, None))
+        patches.append((0.2 * (i + 1), adapter, 1.0, None, None))
+    return patches
+
+
+def merge(weights, patches, stack):
+    comfy.lora.STACK_LORA_PATCHES = stack
+    try:
+        start = time.perf_counter()
+        out = [comfy.lora.calculate_weight(patches[k], w.to(torch.float32, copy=True), k) for k, w in weights.items()]
+        return out, time.perf_counter() - start
+    finally:
+        comfy.lora.STACK_LORA_PATCHES = True
+
+
+def test_stacked_matches_sequential():
+    g = torch.Generator().manual_seed(0)
+    weight = torch.randn(64, 32, generator=g)
+    patches = lora_stack((64, 32), 3, 4, g)
+    # A patch that can't be stacked in the middle of the run
+    patches.insert(2, (0.5, (torch.randn(64, 32, generator=g),), 1.0, None, None))
+    stacked = comfy.lora.stack_lora_patches(patches)
+    assert len(stacked) == 3
+    assert isinstance(stacked[0][1], comfy.weight_adapter.StackedLoRAAdapter)
+    assert stacked[2] is patches[3]
+
+    expected, _ = merge({"w": weight}, {"w": patches}, stack=False)
+    out, _ = merge({"w": weight}, {"w": patches}, stack=True)
+    assert torch.allclose(out[0], expected[0], atol=1e-4)
+
+
+def test_lora_stack_benchmark():
+    g = torch.Generator().manual_seed(0)
+    # A few keys of the size of the Flux double block linears and SDXL attention projections, 5 LoRAs each.
+    for name, shape, rank, keys in [("flux", (3072, 3072), 16, 4), ("sdxl", (1280, 1280), 32, 16)]:
+        weights = {"{}.{}".format(name, i): torch.randn(shape, generator=g).to(torch.bfloat16) for i in range(keys)}
+        patches = {k: lora_stack(shape, 5, rank, g) for k in weights}
+        merge(weights, patches, stack=True)
+
+        expected, sequential = merge(weights, patches, stack=False)
+        out, stacked = merge(weights, patches, stack=True)
+        logging.info("{}: {} keys with 5 LoRAs, per patch {:.1f} ms, stacked {:.1f} ms".format(name, keys, sequential * 1000, stacked * 1000))
+        # Timings vary too much between machines to be asserted, they are only reported.
+        for a, b in zip(out, expected):
+            assert torch.allclose(a, b, rtol=1e-3, atol=1e-3)
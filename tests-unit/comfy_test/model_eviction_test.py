@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+import comfy.model_eviction
+import comfy.model_management
+import comfy.model_patcher
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def clean_stats(monkeypatch):
+    monkeypatch.setattr(comfy.model_eviction, "usage_stats", comfy.model_eviction.usage_stats.__class__())
+    monkeypatch.setattr(comfy.model_eviction, "upcoming_models", comfy.model_eviction.upcoming_models.__class__())
+
+
+def patcher(mb):
+    model = torch.nn.Linear(mb * MB // 4, 1, bias=False)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+    patcher.model.model_loaded_weight_memory = mb * MB
+    return patcher
+
+
+def test_default_order_prefers_smaller_models():
+    patchers = [patcher(2), patcher(1)]
+    big, small = [comfy.model_management.LoadedModel(p) for p in patchers]
+    order = comfy.model_eviction.EvictionPolicy().order([(0, big), (1, small)])
+    assert [i for i, _ in order] == [1, 0]
+
+
+def test_cost_policy_keeps_expensive_and_upcoming_models():
+    # LoadedModel only keeps a weak reference to the patcher
+    patchers = [patcher(2) for _ in range(3)]
+    cheap, slow, upcoming = [comfy.model_management.LoadedModel(p) for p in patchers]
+    for m in (cheap, slow, upcoming):
+        comfy.model_eviction.record_use(m.model)
+    # Same size, but the slow one took 10 times as long to load and patch
+    comfy.model_eviction.record_load(cheap.model, 0.1, 2 * MB, 0.0)
+    comfy.model_eviction.record_load(slow.model, 1.0, 2 * MB, 0.5)
+    comfy.model_eviction.record_load(upcoming.model, 0.1, 2 * MB, 0.0)
+    comfy.model_eviction.set_upcoming_models([upcoming.model])
+
+    policy = comfy.model_eviction.CostAwareEvictionPolicy()
+    order = policy.order([(0, upcoming), (1, slow), (2, cheap)])
+    assert [m for _, m in order] == [cheap, upcoming, slow]
+
+    policy.unloaded(cheap, 2 * MB)
+    stats = policy.get_stats()
+    assert stats["evictions"] == 1 and stats["bytes_freed"] == 2 * MB
+    assert stats["estimated_reload_seconds"] == pytest.approx(0.1)
+
+
+def test_unused_models_go_first():
+    patchers = [patcher(2) for _ in range(2)]
+    used, unused = [comfy.model_management.LoadedModel(p) for p in patchers]
+    comfy.model_eviction.record_use(used.model)
+    order = comfy.model_eviction.CostAwareEvictionPolicy().order([(0, used), (1, unused)])
+    assert [m for _, m in order] == [unused, used]
@@ -0,0 +1,78 @@
+import os
+from unittest.mock import patch
+
+import safetensors.torch
+import torch
+
+import comfy.model_index
+import comfy.utils
+
+
+def save_stable_audio(path, prefix):
+    sd = {"{}transformer.rotary_pos_emb.inv_freq".format(prefix): torch.zeros(16)}
+    for i in range(6):
+        sd["{}transformer.layers.{}.weight".format(prefix, i)] = torch.zeros(8, 4, dtype=torch.float16)
+    sd["conditioner.conditioners.seconds_start.weight"] = torch.zeros(4)
+    safetensors.torch.save_file(sd, path)
+    return sd
+
+
+def test_meta_state_dict(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    sd = save_stable_audio(path, "model.model.")
+    meta_sd, metadata = comfy.utils.safetensors_meta_state_dict(path)
+    assert metadata is None
+    assert list(meta_sd.keys()) == sorted(sd.keys())
+    for k in sd:
+        assert meta_sd[k].is_meta
+        assert meta_sd[k].shape == sd[k].shape
+        assert meta_sd[k].dtype == sd[k].dtype
+
+
+def test_describe_model_file(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.safetensors")
+    save_stable_audio(checkpoint, "model.model.")
+    info = comfy.model_index.describe_model_file(checkpoint)
+    assert info["architecture"] == "StableAudio"
+    assert info["parameters"] == 16 + 6 * 32 + 4
+    assert info["diffusion_model_parameters"] == 16 + 6 * 32
+    assert info["dtype"] == "float16"
+    assert info["size"] == os.path.getsize(checkpoint)
+
+    # Diffusion model only file, no prefix
+    unet = str(tmp_path / "unet.safetensors")
+    save_stable_audio(unet, "")
+    assert comfy.model_index.describe_model_file(unet)["architecture"] == "StableAudio"
+
+    other = str(tmp_path / "lora.safetensors")
+    safetensors.torch.save_file({"lora_unet_down.weight": torch.zeros(4, 4)}, other)
+    assert comfy.model_index.describe_model_file(other)["architecture"] is None
+
+    not_safetensors = str(tmp_path / "model.ckpt")
+    torch.save({}, not_safetensors)
+    assert comfy.model_index.describe_model_file(not_safetensors) is None
+
+
+def test_index_reuses_entries(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    save_stable_audio(path, "model.model.")
+    index_path = str(tmp_path / "user" / "model_index.json")
+
+    index = comfy.model_index.ModelIndex(index_path)
+    info = index.describe(path)
+    index.save()
+    assert os.path.exists(index_path)
+
+    # A new index reads the saved entries instead of the file
+    index = comfy.model_index.ModelIndex(index_path)
+    with patch("comfy.model_index.describe_model_file") as describe:
+        assert index.describe(path) == info
+        describe.assert_not_called()
+
+    # A changed file is described again
+    save_stable_audio(path, "")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with patch("comfy.model_index.describe_model_file", return_value={"architecture": "changed"}) as describe:
+        assert index.describe(path) == {"architecture": "changed"}
+        describe.assert_called_once()
@@ -0,0 +1,102 @@
+import contextvars
+import threading
+
+import pytest
+import torch
+
+import comfy.model_management
+import comfy.model_patcher
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    monkeypatch.setattr(comfy.model_management, "current_loaded_models", [])
+    monkeypatch.setattr(comfy.model_management, "processing_prompts", set())
+    monkeypatch.setattr(comfy.model_management, "interrupted_prompts", set())
+    monkeypatch.setattr(comfy.model_management, "interrupt_processing", False)
+
+
+def patcher():
+    model = torch.nn.Linear(4, 4)
+    return comfy.model_patcher.ModelPatcher(model, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+
+
+def in_prompt(prompt_id):
+    """A context like the one a prompt worker executes prompt_id in."""
+    ctx = contextvars.copy_context()
+    ctx.run(comfy.model_management.start_processing, prompt_id)
+    return ctx
+
+
+def loaded():
+    return [m.model for m in comfy.model_management.current_loaded_models]
+
+
+def test_models_in_use_by_other_prompts_are_not_unloaded():
+    a, b = in_prompt("a"), in_prompt("b")
+    model = patcher()
+    a.run(comfy.model_management.load_models_gpu, [model])
+    assert loaded() == [model]
+
+    b.run(comfy.model_management.free_memory, 1e30, torch.device("cpu"))
+    assert loaded() == [model]
+
+    # The prompt using it can still unload it, and anyone can once the prompt is done.
+    a.run(comfy.model_management.free_memory, 1e30, torch.device("cpu"))
+    assert loaded() == []
+    a.run(comfy.model_management.load_models_gpu, [model])
+    a.run(comfy.model_management.finish_processing, "a")
+    b.run(comfy.model_management.free_memory, 1e30, torch.device("cpu"))
+    assert loaded() == []
+
+
+def test_loading_other_models_unpins_the_previous_ones():
+    a, b = in_prompt("a"), in_prompt("b")
+    first, second = patcher(), patcher()
+    a.run(comfy.model_management.load_models_gpu, [first])
+    a.run(comfy.model_management.load_models_gpu, [second])
+    b.run(comfy.model_management.free_memory, 1e30, torch.device("cpu"))
+    assert loaded() == [second]
+
+
+def test_clone_of_a_model_in_use_waits_for_it():
+    a, b = in_prompt("a"), in_prompt("b")
+    model = patcher()
+    clone = model.clone()
+    a.run(comfy.model_management.load_models_gpu, [model])
+
+    done = threading.Event()
+    def load_clone():
+        b.run(comfy.model_management.load_models_gpu, [clone])
+        done.set()
+    thread = threading.Thread(target=load_clone, daemon=True)
+    thread.start()
+    assert not done.wait(0.2)
+    assert loaded() == [model]
+
+    a.run(comfy.model_management.finish_processing, "a")
+    assert done.wait(10)
+    thread.join()
+    assert loaded() == [clone]
+
+
+def test_interrupts_are_per_prompt():
+    a, b = in_prompt("a"), in_prompt("b")
+    comfy.model_management.interrupt_current_processing(prompt_id="a")
+    assert not b.run(comfy.model_management.processing_interrupted)
+    b.run(comfy.model_management.throw_exception_if_processing_interrupted)
+    with pytest.raises(comfy.model_management.InterruptProcessingException):
+        a.run(comfy.model_management.throw_exception_if_processing_interrupted)
+    a.run(comfy.model_management.throw_exception_if_processing_interrupted)
+
+    # Without a prompt id every prompt being executed is interrupted, each one once.
+    comfy.model_management.interrupt_current_processing()
+    for ctx in (a, b):
+        with pytest.raises(comfy.model_management.InterruptProcessingException):
+            ctx.run(comfy.model_management.throw_exception_if_processing_interrupted)
+        ctx.run(comfy.model_management.throw_exception_if_processing_interrupted)
+
+    # Prompts that aren't being executed can't be interrupted ahead of time
+    comfy.model_management.interrupt_current_processing(prompt_id="c")
+    c = in_prompt("c")
+    c.run(comfy.model_management.throw_exception_if_processing_interrupted)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import torch
+
+from comfy.sampler_batching import ModelCallBatcher
+
+
+class Model:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def apply_model(self, x, t, c_crossattn=None, transformer_options={}):
+        self.batch_sizes.append(x.shape[0])
+        return x * t.reshape(-1, 1) + c_crossattn.sum(dim=1)
+
+    def memory_required(self, input_shape, cond_shapes={}):
+        return 0
+
+
+def model_call(batcher, model, seed, results, steps=3, started=None, sample_sigmas=(3.0, 2.0, 1.0, 0.0)):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randn(2, 4, generator=g)
+    c = {"c_crossattn": torch.randn(2, 3, 4, generator=g),
+         "transformer_options": {"cond_or_uncond": [1, 0], "sample_sigmas": torch.tensor(sample_sigmas)}}
+    with batcher.sampling(model):
+        if started is not None:
+            started.wait()
+        for step in range(steps):
+            t = torch.full((2,), float(step + 1))
+            out = batcher.apply_model(model, x, t, c)
+            assert torch.equal(out, x * t.reshape(-1, 1) + c["c_crossattn"].sum(dim=1))
+            x = out
+    results[seed] = x
+
+
+def test_batches_calls_of_concurrent_prompts():
+    model = Model()
+    batcher = ModelCallBatcher(max_batch=4, window=5.0)
+    results = {}
+    started = threading.Barrier(3)
+    threads = [threading.Thread(target=model_call, args=(batcher, model, seed, results), kwargs={"started": started}) for seed in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Every step of the 3 prompts ran as one call, and each got its own output back
+    assert model.batch_sizes == [6, 6, 6]
+    assert batcher.get_stats() == {"calls": 9, "batched_calls": 9}
+    alone = {}
+    model_call(batcher, Model(), 1, alone)
+    assert torch.equal(alone[1], results[1])
+
+
+def test_single_prompt_does_not_wait():
+    model = Model()
+    batcher = ModelCallBatcher(max_batch=4, window=5.0)
+    start = time.perf_counter()
+    model_call(batcher, model, 0, {})
+    assert time.perf_counter() - start < 1.0
+    assert model.batch_sizes == [2, 2, 2]
+
+    # Calls with different shapes aren't merged
+    x = torch.randn(2, 4)
+    with batcher.sampling(model):
+        out = batcher.apply_model(model, x, torch.ones(2), {"c_crossattn": torch.randn(1, 3, 4)})
+    assert out.shape == (2, 4)
+
+
+def test_calls_with_different_options_are_not_merged():
+    model = Model()
+    batcher = ModelCallBatcher(max_batch=4, window=0.5)
+    results = {}
+    started = threading.Barrier(2)
+    schedules = {0: (3.0, 2.0, 1.0, 0.0), 1: (5.0, 2.0, 1.0, 0.0)}
+    threads = [threading.Thread(target=model_call, args=(batcher, model, seed, results), kwargs={"started": started, "sample_sigmas": schedules[seed]}) for seed in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert model.batch_sizes == [2] * 6
+    assert batcher.get_stats()["batched_calls"] == 0
@@ -0,0 +1,122 @@
+import pytest
+import torch
+
+import comfy.ldm.flux.model
+import comfy.ldm.hunyuan_video.model
+import comfy.ldm.modules.diffusionmodules.mmdit
+import comfy.ldm.wan.model
+import comfy.model_patcher
+import comfy.ops
+import comfy.token_merging
+
+
+class Model(torch.nn.Module):
+    def __init__(self, diffusion_model):
+        super().__init__()
+        self.diffusion_model = diffusion_model
+
+
+def randomly_initialized(model):
+    g = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for p in list(model.parameters()) + list(model.buffers()):
+            p.copy_(torch.randn(p.shape, generator=g) * 0.2)
+    return model
+
+
+def tiny_flux():
+    model = comfy.ldm.flux.model.Flux(in_channels=4, out_channels=4, vec_in_dim=8, context_in_dim=8, hidden_size=32, mlp_ratio=2.0, num_heads=2,
+                                      depth=2, depth_single_blocks=2, axes_dim=[4, 6, 6], theta=10000, patch_size=2, qkv_bias=True, guidance_embed=False,
+                                      operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(2, 5, 8, generator=g)}, (2, 4, 16, 16)
+
+
+def tiny_hunyuan_video():
+    model = comfy.ldm.hunyuan_video.model.HunyuanVideo(in_channels=4, out_channels=4, vec_in_dim=8, context_in_dim=8, hidden_size=32, mlp_ratio=2.0, num_heads=2,
+                                                       depth=2, depth_single_blocks=2, axes_dim=[4, 6, 6], theta=256, patch_size=[1, 2, 2], qkv_bias=True,
+                                                       guidance_embed=False, operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    attention_mask = torch.tensor([[1, 1, 1, 1, 0]])
+    return randomly_initialized(model), {"context": torch.randn(2, 5, 8, generator=g), "y": torch.randn(2, 8, generator=g), "attention_mask": attention_mask}, (2, 4, 2, 8, 8)
+
+
+def tiny_wan():
+    model = comfy.ldm.wan.model.WanModel(patch_size=(1, 2, 2), text_len=5, in_dim=4, dim=32, ffn_dim=64, freq_dim=16, text_dim=8, out_dim=4, num_heads=2,
+                                         num_layers=3, operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(2, 5, 8, generator=g)}, (2, 4, 2, 8, 8)
+
+
+def tiny_mmdit():
+    model = comfy.ldm.modules.diffusionmodules.mmdit.MMDiT(patch_size=2, in_channels=4, depth=2, adm_in_channels=8, pos_embed_max_size=16, num_patches=256,
+                                                           context_embedder_config={"target": "torch.nn.Linear", "params": {"in_features": 8, "out_features": 128}},
+                                                           operations=comfy.ops.disable_weight_init)
+    g = torch.Generator().manual_seed(1)
+    return randomly_initialized(model), {"context": torch.randn(2, 5, 8, generator=g), "y": torch.randn(2, 8, generator=g)}, (2, 4, 16, 16)
+
+
+def test_merge_unmerge():
+    g = torch.Generator().manual_seed(0)
+    x = torch.randn(3, 37, 8, generator=g)
+    tm = comfy.token_merging.TokenMerge(x, 0)
+    assert torch.equal(tm.unmerge(tm.merge(x)), x)
+
+    # Sources that are copies of a destination are merged first and come back unchanged
+    x[:, 1] = x[:, 0]
+    x[:, 6] = x[:, 8]
+    tm = comfy.token_merging.TokenMerge(x, 2)
+    merged = tm.merge(x)
+    assert merged.shape == (3, 35, 8)
+    assert torch.allclose(tm.unmerge(merged), x)
+
+    # Batched matching is the same as one sequence at a time
+    x = torch.randn(3, 37, 8, generator=g)
+    tm = comfy.token_merging.TokenMerge(x, 10)
+    merged = tm.merge(x)
+    for i in range(3):
+        single = comfy.token_merging.TokenMerge(x[i:i + 1], 10)
+        assert torch.allclose(single.merge(x[i:i + 1]), merged[i:i + 1])
+        assert torch.equal(single.kept_positions(), tm.kept_positions()[i:i + 1])
+        assert torch.allclose(single.unmerge(merged[i:i + 1]), tm.unmerge(merged)[i:i + 1])
+
+
+@pytest.mark.parametrize("model_fn,blocks", [(tiny_flux, 4), (tiny_hunyuan_video, 4), (tiny_wan, 3), (tiny_mmdit, 2)])
+def test_token_merging(model_fn, blocks, monkeypatch):
+    merges = []
+
+    class TokenMerge(comfy.token_merging.TokenMerge):
+        def __init__(self, x, r):
+            merges.append(r)
+            super().__init__(x, r)
+    monkeypatch.setattr(comfy.token_merging, "TokenMerge", TokenMerge)
+
+    diffusion_model, inputs, shape = model_fn()
+    patcher = comfy.model_patcher.ModelPatcher(Model(diffusion_model), torch.device("cpu"), torch.device("cpu"))
+    x = torch.randn(shape, generator=torch.Generator().manual_seed(2))
+    t = torch.full((shape[0],), 0.5)
+
+    def sample(ratios):
+        transformer_options = {}
+        if ratios is not None:
+            transformer_options = comfy.token_merging.apply_token_merging(patcher, ratios).model_options["transformer_options"]
+        with torch.no_grad():
+            return diffusion_model(x, t, transformer_options=transformer_options, **inputs)
+
+    expected = sample(None)
+    assert torch.isfinite(expected).all()
+    # A ratio too low to merge anything still reorders the tokens, the positional embeddings and
+    # masks must follow them.
+    out = sample([(0, -1, 0.01)])
+    assert (out - expected).norm() / expected.norm() < 1e-4
+    assert merges == [0] * blocks
+
+    out = sample([(0, -1, 0.5)])
+    assert out.shape == expected.shape
+    assert torch.isfinite(out).all()
+    assert not torch.allclose(out, expected, atol=1e-5)
+    assert len(merges) == 2 * blocks and min(merges[blocks:]) > 0
+
+    # Only the blocks in the range are merged
+    out = sample([(100, -1, 0.5)])
+    assert torch.equal(out, expected)
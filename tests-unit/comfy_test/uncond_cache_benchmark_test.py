@@ -0,0 +1,92 @@
+import logging
+import time
+
+import torch
+
+import comfy.conds
+import comfy.k_diffusion.sampling
+import comfy.samplers
+
+
+class Patcher:
+    def prepare_state(self, timestep):
+        pass
+
+    def apply_hooks(self, hooks):
+        return {}
+
+
+class TinyModel:
+    """Tiny randomly initialized denoiser, the prediction depends on the cond and changes smoothly with sigma."""
+    def __init__(self, channels=4, context_dim=8):
+        g = torch.Generator().manual_seed(0)
+        self.current_patcher = Patcher()
+        self.conv = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.proj = torch.nn.Linear(context_dim, channels)
+        with torch.no_grad():
+            for p in list(self.conv.parameters()) + list(self.proj.parameters()):
+                p.copy_(torch.randn(p.shape, generator=g) * 0.3)
+        self.calls = 0
+        self.evaluations = 0
+
+    def memory_required(self, input_shape, cond_shapes={}):
+        return 0
+
+    @torch.no_grad()
+    def apply_model(self, x, t, c_crossattn=None, transformer_options={}):
+        self.calls += 1
+        self.evaluations += x.shape[0]
+        s = t.reshape(-1, 1, 1, 1)
+        emb = self.proj(c_crossattn.mean(dim=1)).reshape(x.shape[0], -1, 1, 1)
+        h = torch.tanh(self.conv(x / (1 + s ** 2).sqrt()) + emb)
+        return (x + h * s ** 2) / (1 + s ** 2)
+
+
+def cond(value, context_dim=8):
+    g = torch.Generator().manual_seed(value)
+    return [{"model_conds": {"c_crossattn": comfy.conds.CONDCrossAttn(torch.randn(1, 4, context_dim, generator=g))}, "uuid": value}]
+
+
+def sample(model, model_options, steps=30, cfg=7.0):
+    sigmas = comfy.k_diffusion.sampling.get_sigmas_karras(steps, 0.03, 14.6)
+    x = torch.randn(1, 4, 16, 16, generator=torch.Generator().manual_seed(1)) * sigmas[0]
+    positive, negative = cond(1), cond(2)
+
+    def denoiser(x, sigma, **kwargs):
+        return comfy.samplers.sampling_function(model, x, sigma, negative, positive, cfg, model_options=model_options)
+
+    start = time.perf_counter()
+    out = comfy.k_diffusion.sampling.sample_euler(denoiser, x, sigmas, disable=True)
+    return out, time.perf_counter() - start
+
+
+def test_interval_one_matches_cfg():
+    expected, _ = sample(TinyModel(), {})
+    cache = comfy.samplers.UncondCache(interval=1)
+    out, _ = sample(TinyModel(), {"uncond_cache": cache})
+    assert torch.equal(out, expected)
+    assert cache.skipped == 0
+
+
+def test_uncond_cache_benchmark():
+    reference_model = TinyModel()
+    reference, reference_seconds = sample(reference_model, {})
+    logging.info("full cfg: {} evaluations, {:.1f} ms".format(reference_model.evaluations, reference_seconds * 1000))
+
+    results = {}
+    for name, options in [("reuse 2, last 70%", dict(interval=2, sigma_start=5.0)),
+                          ("extrapolate 2, last 70%", dict(interval=2, sigma_start=5.0, extrapolate=True)),
+                          ("reuse 3", dict(interval=3)),
+                          ("extrapolate 3", dict(interval=3, extrapolate=True))]:
+        model = TinyModel()
+        cache = comfy.samplers.UncondCache(**options)
+        out, seconds = sample(model, {"uncond_cache": cache})
+        error = ((out - reference).norm() / reference.norm()).item()
+        results[name] = (model.evaluations, error)
+        logging.info("{}: {} evaluations ({} uncond skipped), {:.1f} ms, relative error {:.4f}".format(name, model.evaluations, cache.skipped, seconds * 1000, error))
+        assert model.evaluations == reference_model.evaluations - cache.skipped
+        assert error < 0.05
+
+    # Every third uncond evaluated: a third of the model evaluations saved
+    assert results["reuse 3"][0] == reference_model.evaluations * 2 // 3
+    assert results["reuse 2, last 70%"][0] < reference_model.evaluations
@@ -0,0 +1,90 @@
+import torch
+
+import comfy.host_memory
+import comfy.model_patcher
+import comfy.weight_dedup
+from comfy.cli_args import args
+from comfy.weight_dedup import WeightDeduplicator
+
+
+class Model(torch.nn.Module):
+    def __init__(self, seed):
+        super().__init__()
+        torch.manual_seed(0)
+        self.text_encoder = torch.nn.Linear(256, 256)
+        torch.manual_seed(seed)
+        self.unet = torch.nn.Linear(256, 256)
+
+
+def test_shares_identical_weights():
+    dedup = WeightDeduplicator()
+    a, b = Model(1), Model(2)
+    # A finetune that only changed one value
+    with torch.no_grad():
+        b.text_encoder.bias[0] += 1.0
+    expected = {k: v.clone() for k, v in b.state_dict().items()}
+
+    assert dedup.deduplicate(a) == (0, 0)
+    shared, saved = dedup.deduplicate(b)
+    assert shared == 1 and saved == 256 * 256 * 4
+    assert b.text_encoder.weight.data_ptr() == a.text_encoder.weight.data_ptr()
+    assert b.text_encoder.bias.data_ptr() != a.text_encoder.bias.data_ptr()
+    assert b.unet.weight.data_ptr() != a.unet.weight.data_ptr()
+    assert isinstance(b.text_encoder.weight, torch.nn.Parameter)
+    for k, v in b.state_dict().items():
+        assert torch.equal(v, expected[k])
+
+    # Still shared with the weights of b once a is gone, and doing it again changes nothing
+    del a
+    c = Model(3)
+    assert dedup.deduplicate(c)[0] == 1
+    assert dedup.deduplicate(c)[0] == 0
+    assert dedup.get_stats() == {"tensors_shared": 2, "bytes_saved": 2 * 256 * 256 * 4}
+
+
+def test_inplace_patch_does_not_modify_other_models():
+    dedup = WeightDeduplicator()
+    a, b = Model(1), Model(2)
+    dedup.deduplicate(a)
+    dedup.deduplicate(b)
+    original = a.text_encoder.weight.clone()
+
+    patcher = comfy.model_patcher.ModelPatcher(b, load_device=torch.device("cpu"), offload_device=torch.device("cpu"), weight_inplace_update=True)
+    diff = torch.ones(256, 256)
+    patcher.add_patches({"text_encoder.weight": ("diff", (diff,))}, 1.0)
+    patcher.patch_model()
+    assert torch.equal(b.text_encoder.weight, original + 1.0)
+    assert torch.equal(a.text_encoder.weight, original)
+    patcher.unpatch_model()
+    assert torch.equal(b.text_encoder.weight, original)
+
+
+def test_weights_in_host_ram_buffers_are_not_shared(monkeypatch):
+    monkeypatch.setattr(args, "deduplicate_weights", True)
+    monkeypatch.setattr(args, "host_ram_tier", 1.0)
+    monkeypatch.setattr(comfy.weight_dedup, "weight_deduplicator", None)
+    monkeypatch.setattr(comfy.host_memory, "host_memory_tier", None)
+    tier = comfy.host_memory.get_host_memory_tier()
+
+    def patcher(seed):
+        # Pretend the models are loaded on a GPU
+        return comfy.model_patcher.ModelPatcher(Model(seed), load_device=torch.device("cuda"), offload_device=torch.device("cpu"))
+
+    a = patcher(1)
+    comfy.weight_dedup.deduplicate(a)
+    tier.offloaded(a)
+    b = patcher(2)
+    comfy.weight_dedup.deduplicate(b)
+    expected = {k: v.clone() for k, v in b.model.state_dict().items()}
+
+    # a is loaded again, its buffer goes back to the pool and the next model offloaded gets it
+    a.model.to("meta")
+    tier.loaded(a)
+    c = patcher(3)
+    with torch.no_grad():
+        for p in c.model.parameters():
+            p.fill_(7.0)
+    tier.offloaded(c)
+    assert tier.pool.reused == 1
+    for k, v in b.model.state_dict().items():
+        assert torch.equal(v, expected[k])
@@ -0,0 +1,72 @@
+import safetensors.torch
+import torch
+
+import comfy.utils
+import comfy.weight_loader
+
+
+class Custom(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(3))
+        self.loaded = False
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self.loaded = True
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class Model(torch.nn.Module):
+    def __init__(self, dtype):
+        super().__init__()
+        self.linear = torch.nn.Linear(64, 256, dtype=dtype)
+        self.norm = torch.nn.LayerNorm(256, dtype=dtype)
+        self.register_buffer("persistent", torch.zeros(8, dtype=dtype))
+        self.register_buffer("temporary", torch.zeros(8, dtype=dtype), persistent=False)
+        self.custom = Custom()
+        self.missing = torch.nn.Linear(2, 2)
+
+
+def make_state_dict():
+    sd = Model(torch.float32).state_dict()
+    sd = {k: torch.randn_like(v) for k, v in sd.items() if not k.startswith("missing.")}
+    sd["unexpected"] = torch.ones(2)
+    return sd
+
+
+def test_matches_load_state_dict(tmp_path, monkeypatch):
+    monkeypatch.setattr(comfy.weight_loader, "CHUNK_SIZE", 1024)
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file(make_state_dict(), path)
+    sd = comfy.utils.load_torch_file(path)
+
+    expected = Model(torch.bfloat16)
+    expected_keys = expected.load_state_dict(sd, strict=False)
+    model = Model(torch.bfloat16)
+    stats = comfy.weight_loader.LoadStats()
+    with torch.inference_mode():
+        result = comfy.weight_loader.load_state_dict(model, sd, threads=4, stats=stats)
+    m, u = result
+
+    assert type(result) is type(expected_keys)
+    assert sorted(m) == sorted(expected_keys.missing_keys) == ["missing.bias", "missing.weight"]
+    assert u == expected_keys.unexpected_keys == ["unexpected"]
+    for k, v in expected.state_dict().items():
+        if not k.startswith("missing."):
+            assert torch.equal(model.state_dict()[k], v), k
+    assert model.linear.weight.dtype == torch.bfloat16
+    assert model.custom.loaded
+
+    # custom.weight goes through load_state_dict
+    assert stats.total_bytes == sum(v.nbytes for k, v in expected.state_dict().items() if not k.startswith(("missing.", "custom.")))
+    assert stats.threads == 4
+    assert stats.stages["read/cast"][0] == stats.total_bytes
+    assert stats.throughput() > 0
+
+
+def test_disabled():
+    model = Model(torch.float32)
+    sd = make_state_dict()
+    m, u = comfy.weight_loader.load_state_dict(model, sd, threads=0)
+    assert u == ["unexpected"]
+    assert torch.equal(model.linear.weight, sd["linear.weight"])
@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+import comfy.model_patcher
+import comfy.weight_adapter
+import comfy.weight_patch_cache
+from comfy.cli_args import args
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(64, 64)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(args, "lora_cache_ram", 1)
+    monkeypatch.setattr(comfy.weight_patch_cache, "patched_weight_cache", None)
+    return comfy.weight_patch_cache.get_patched_weight_cache()
+
+
+def lora(seed):
+    g = torch.Generator().manual_seed(seed)
+    weights = (torch.randn(64, 4, generator=g), torch.randn(4, 64, generator=g), None, None, None, None)
+    return comfy.weight_adapter.LoRAAdapter(set(), weights)
+
+
+def patched_weight(patcher, seed, strength=0.5):
+    p = patcher.clone()
+    p.add_patches({"linear.weight": lora(seed)}, strength)
+    p.patch_model()
+    weight = p.model.linear.weight.clone()
+    p.unpatch_model()
+    return weight
+
+
+def test_reuses_patched_weights(cache):
+    patcher = comfy.model_patcher.ModelPatcher(Model(), load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+    original = patcher.model.linear.weight.clone()
+
+    a = patched_weight(patcher, 0)
+    assert cache.get_stats()["misses"] == 1
+    assert torch.equal(patcher.model.linear.weight, original)
+    # Same LoRA loaded again: new tensors with the same content
+    assert torch.equal(patched_weight(patcher, 0), a)
+    assert cache.get_stats()["hits"] == 1
+
+    # A different LoRA or strength is a different entry
+    assert not torch.equal(patched_weight(patcher, 1), a)
+    assert not torch.equal(patched_weight(patcher, 0, strength=1.0), a)
+    assert cache.get_stats()["entries"] == 3
+
+    # Another model with the same key doesn't hit
+    other = comfy.model_patcher.ModelPatcher(Model(), load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+    patched_weight(other, 0)
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_uncacheable_patches():
+    weights = lora(0)
+    digest = comfy.weight_patch_cache.patch_digest([(1.0, weights, 1.0, None, None)])
+    assert digest == comfy.weight_patch_cache.patch_digest([(1.0, lora(0), 1.0, None, None)])
+    assert digest != comfy.weight_patch_cache.patch_digest([(1.0, weights, 1.0, (0, 0, 32), None)])
+    assert comfy.weight_patch_cache.patch_digest([(1.0, weights, 1.0, None, lambda a: a)]) is None
+    assert comfy.weight_patch_cache.patch_digest([(1.0, ("model_as_lora", (torch.ones(2),)), 1.0, None, None)]) is None
+
+
+def test_digest_covers_every_element():
+    up = torch.zeros(64, 4)
+    other = up.clone()
+    other[0, 1] = 1
+    digests = [comfy.weight_patch_cache.patch_digest([(1.0, comfy.weight_adapter.LoRAAdapter(set(), (t, torch.ones(4, 64), None, None, None, None)), 1.0, None, None)]) for t in (up, other)]
+    assert digests[0] != digests[1]
+
+
+def test_large_patch_tensors_are_keyed_by_identity(monkeypatch):
+    monkeypatch.setattr(comfy.weight_patch_cache, "MAX_HASHED_PATCH_BYTES", 1024)
+    # A model merge patch: the weight of another model
+    other_weight = torch.zeros(64, 64)
+    digest = comfy.weight_patch_cache.patch_digest([(0.5, (other_weight,), 0.5, None, None)])
+    assert digest == comfy.weight_patch_cache.patch_digest([(0.5, (other_weight,), 0.5, None, None)])
+    assert digest != comfy.weight_patch_cache.patch_digest([(0.5, (other_weight.clone(),), 0.5, None, None)])
+    other_weight[0, 0] = 1.0
+    assert digest != comfy.weight_patch_cache.patch_digest([(0.5, (other_weight,), 0.5, None, None)])
+
+    # Small ones still by content
+    assert comfy.weight_patch_cache.patch_digest([(1.0, lora(0), 1.0, None, None)]) == comfy.weight_patch_cache.patch_digest([(1.0, lora(0), 1.0, None, None)])
+
+
+def test_evicts_least_recently_used():
+    cache = comfy.weight_patch_cache.PatchedWeightCache(ram_budget=2 * 64 * 64 * 4)
+    for i in range(3):
+        cache.put(("model", str(i)), torch.zeros(64, 64))
+    assert cache.get(("model", "0"), torch.device("cpu")) is None
+    assert cache.get(("model", "2"), torch.device("cpu")) is not None
+    assert cache.get_stats()["ram_used"] == 2 * 64 * 64 * 4
@@ -0,0 +1,93 @@
+import time
+
+import torch
+
+import comfy.model_management
+import comfy.model_patcher
+import comfy.ops
+import comfy.weight_streaming
+from comfy.weight_streaming import WeightStreamer
+
+LAYERS = 6
+TRANSFER_SECONDS = 0.01
+COMPUTE_SECONDS = 0.015
+
+
+def slow_transfer(tensor, dtype, device, stream):
+    # A device with a slow bus
+    time.sleep(TRANSFER_SECONDS)
+    return tensor.to(dtype=dtype, device=device, copy=True)
+
+
+class SlowLinear(comfy.ops.disable_weight_init.Linear):
+    comfy_cast_weights = True
+
+    def forward(self, x):
+        x = super().forward(x)
+        time.sleep(COMPUTE_SECONDS)
+        return x
+
+
+def make_model(streamer):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[SlowLinear(32, 32) for _ in range(LAYERS)])
+    for m in model:
+        torch.nn.init.normal_(m.weight, std=0.2)
+        torch.nn.init.normal_(m.bias)
+        m.weight_function = [lambda w: w * 0.5]
+        if streamer is not None:
+            m.comfy_weight_streamer = streamer
+    return model
+
+
+def run(x, lookahead, steps=3):
+    streamer = WeightStreamer(torch.device("cpu"), lookahead=lookahead, transfer=slow_transfer)
+    model = make_model(streamer)
+    start = time.perf_counter()
+    out = [model(x) for _ in range(steps)]
+    return out, time.perf_counter() - start, streamer
+
+
+def test_streamed_weights_match():
+    x = torch.randn(4, 32)
+    expected = make_model(None)(x)
+    out, _, streamer = run(x, lookahead=2)
+    for o in out:
+        assert torch.equal(o, expected)
+    # The order is recorded on the first step, every later layer was prefetched but the first one
+    assert streamer.get_stats()["misses"] == LAYERS + 1
+    assert streamer.get_stats()["hits"] == 2 * LAYERS - 1
+
+
+def test_prefetch_overlaps_transfers_with_compute():
+    x = torch.randn(4, 32)
+    _, _, baseline = run(x, lookahead=0)
+    _, _, streamed = run(x, lookahead=2)
+    assert baseline.get_stats()["hits"] == 0
+    assert baseline.overlap() == 0.0
+    assert streamed.get_stats()["hits"] == 2 * LAYERS - 1
+    assert streamed.overlap() > 0.4
+
+
+def test_drop_pending_keeps_the_order():
+    x = torch.randn(4, 32)
+    _, _, streamer = run(x, lookahead=2)
+    # The first layers of the next step were prefetched when the last one ran
+    assert len(streamer.pending) == 2
+    streamer.drop_pending()
+    assert len(streamer.pending) == 0
+    assert streamer.get_stats()["modules"] == LAYERS
+    assert streamer.recorded
+
+
+def test_load_reserves_the_lookahead(monkeypatch):
+    def load(lookahead):
+        monkeypatch.setattr(comfy.weight_streaming, "streaming_lookahead", lambda device: lookahead)
+        model = torch.nn.Sequential(*[comfy.ops.disable_weight_init.Linear(32, 32) for _ in range(LAYERS)])
+        patcher = comfy.model_patcher.ModelPatcher(model, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+        layer_size = comfy.model_management.module_size(model[0])
+        patcher.load(torch.device("cpu"), lowvram_model_memory=layer_size * (LAYERS - 1) + 1)
+        return sum(m.comfy_cast_weights for m in model)
+
+    assert load(0) == 1
+    assert load(2) == 3
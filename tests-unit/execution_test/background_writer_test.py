@@ -0,0 +1,48 @@
+import os
+import threading
+
+from comfy_execution.background_writer import BackgroundWriter
+from comfy_execution.utils import CurrentNodeContext
+
+
+def slow_write(path, data, event):
+    event.wait(5)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def failing_write(path):
+    raise ValueError("encoding failed")
+
+
+def test_prompt_done_after_writes(tmp_path):
+    writer = BackgroundWriter(2)
+    event = threading.Event()
+    done = []
+    with CurrentNodeContext("prompt", "9"):
+        writer.submit(tmp_path / "a.png", slow_write, b"a", event)
+        writer.submit(tmp_path / "b.png", slow_write, b"b", event)
+    # The file names are taken right away
+    assert sorted(os.listdir(tmp_path)) == ["a.png", "b.png"]
+
+    writer.when_done("prompt", done.append)
+    assert done == []
+    event.set()
+    writer.wait_for_path(tmp_path / "b.png")
+    assert (tmp_path / "b.png").read_bytes() == b"b"
+    writer.pool.shutdown(wait=True)
+    assert done == [[]]
+
+
+def test_failed_write(tmp_path):
+    writer = BackgroundWriter(1)
+    with CurrentNodeContext("prompt", "9"):
+        writer.submit(tmp_path / "a.png", failing_write)
+    errors = writer.wait("prompt")
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    writer.pool.shutdown(wait=True)
+    assert os.listdir(tmp_path) == []
+
+    done = []
+    writer.when_done("other", done.append)
+    assert done == [[]]
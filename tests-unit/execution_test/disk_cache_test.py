@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from comfy_execution.caching import DiskCache, UnpersistableError, Unhashable, stable_digest, to_hashable
+
+
+def test_stable_digest_ignores_set_order():
+    a = to_hashable({"seed": 1, "text": "a photo", "list": [1, 2.5, None]})
+    b = to_hashable({"list": [1, 2.5, None], "text": "a photo", "seed": 1})
+    assert stable_digest(a) == stable_digest(b)
+    assert stable_digest(a) != stable_digest(to_hashable({"seed": 2, "text": "a photo", "list": [1, 2.5, None]}))
+
+
+def test_stable_digest_rejects_unhashable():
+    with pytest.raises(UnpersistableError):
+        stable_digest(to_hashable([float("NaN")]))
+    with pytest.raises(UnpersistableError):
+        stable_digest(to_hashable([Unhashable()]))
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024 * 1024, node_classes=["VAEEncode"])
+    key = to_hashable(["VAEEncode", ("pixels", ("ANCESTOR", 0, 0))])
+    latent = {"samples": torch.randn(1, 4, 8, 8), "batch_index": [0]}
+    cache.set("VAEEncode", key, [[latent]])
+
+    # A new instance only sees what is on disk
+    cache = DiskCache(str(tmp_path), 1024 * 1024, node_classes=["VAEEncode"])
+    value = cache.get("VAEEncode", key)
+    assert torch.equal(value[0][0]["samples"], latent["samples"])
+    assert value[0][0]["batch_index"] == [0]
+    assert cache.get("VAEEncode", to_hashable(["VAEEncode", "other"])) is None
+    assert cache.get("CLIPTextEncode", key) is None
+
+
+def test_disk_cache_sees_entries_written_by_other_processes(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024 * 1024, node_classes=["VAEEncode"])
+    other = DiskCache(str(tmp_path), 1024 * 1024, node_classes=["VAEEncode"])
+    key = to_hashable(["VAEEncode", ("pixels", ("ANCESTOR", 0, 0))])
+    assert cache.get("VAEEncode", key) is None
+    other.set("VAEEncode", key, [[torch.ones(2)]])
+    assert torch.equal(cache.get("VAEEncode", key)[0][0], torch.ones(2))
+
+
+def test_disk_cache_skips_unserializable(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024 * 1024, node_classes=["CLIPTextEncode"])
+    key = to_hashable(["CLIPTextEncode", ("text", "a photo")])
+    cache.set("CLIPTextEncode", key, [[[[torch.zeros(1, 77, 8), {"hooks": object()}]]]])
+    assert cache.get("CLIPTextEncode", key) is None
+    assert cache.total_size == 0
+
+
+def test_disk_cache_evicts_oldest(tmp_path):
+    tensor_size = 64 * 1024 * 4
+    cache = DiskCache(str(tmp_path), int(tensor_size * 2.5), node_classes=["Canny"])
+    keys = [to_hashable(["Canny", ("low_threshold", i / 10)]) for i in range(4)]
+    for key in keys:
+        cache.set("Canny", key, [[torch.zeros(64 * 1024)]])
+    assert cache.total_size <= cache.max_size
+    assert cache.get("Canny", keys[0]) is None
+    assert cache.get("Canny", keys[-1]) is not None
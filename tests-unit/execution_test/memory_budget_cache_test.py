@@ -0,0 +1,101 @@
+import asyncio
+
+import torch
+
+from comfy_execution.caching import CacheKeySetID, LRUCache, MemoryBudgetCache, get_output_storages
+from comfy_execution.graph import DynamicPrompt
+
+MB = 1024 * 1024
+
+
+def run_prompt(cache, node_ids):
+    prompt = {node_id: {"class_type": "Test", "inputs": {}} for node_id in node_ids}
+    asyncio.run(cache.set_prompt(DynamicPrompt(prompt), node_ids, None))
+    cache.clean_unused()
+
+
+def make_output(mb):
+    return [[torch.zeros(mb * MB, dtype=torch.uint8)]]
+
+
+def test_output_storages_count_views_once():
+    t = torch.zeros(MB, dtype=torch.uint8)
+    storages = get_output_storages([[t, t[:10]], {"samples": t.view(1024, 1024)}])
+    assert len(storages) == 1
+    assert list(storages.values()) == [(MB, False)]
+
+
+def test_evicts_only_over_budget():
+    cache = MemoryBudgetCache(CacheKeySetID, ram_budget=3 * MB)
+    run_prompt(cache, ["1", "2"])
+    cache.set("1", make_output(1))
+    cache.set("2", make_output(1))
+    run_prompt(cache, ["3"])
+    cache.set("3", make_output(1))
+    assert cache.get_stats()["entries"] == 3
+    assert cache.ram_used == 3 * MB
+
+
+def test_never_evicts_current_prompt():
+    cache = MemoryBudgetCache(CacheKeySetID, ram_budget=MB)
+    run_prompt(cache, ["1", "2"])
+    cache.set("1", make_output(1))
+    cache.set("2", make_output(1))
+    assert cache.get("1") is not None
+    assert cache.get("2") is not None
+    assert cache.ram_used == 2 * MB
+    run_prompt(cache, ["3"])
+    assert cache.get_stats()["entries"] == 1
+
+
+def test_evicts_cheapest_to_recompute_per_byte():
+    ui = LRUCache(CacheKeySetID, max_size=100)
+    cache = MemoryBudgetCache(CacheKeySetID, ram_budget=4 * MB, linked_caches=[ui])
+    run_prompt(cache, ["slow", "fast", "big"])
+    run_prompt(ui, ["slow", "fast", "big"])
+    for node_id, size, seconds in [("slow", 1, 10.0), ("fast", 1, 0.1), ("big", 2, 1.0)]:
+        cache.set(node_id, make_output(size))
+        cache.record_execution_time(node_id, seconds)
+        ui.set(node_id, {"output": node_id})
+
+    run_prompt(cache, ["new"])
+    cache.set("new", make_output(1))
+    # "fast" is 0.1 s/MB and "big" 0.5 s/MB, "slow" is 10 s/MB
+    assert ("fast", "Test") not in cache.cache
+    assert ("big", "Test") in cache.cache
+    assert ("slow", "Test") in cache.cache
+    assert ("fast", "Test") not in ui.cache
+    assert cache.ram_used <= cache.ram_budget
+
+
+def test_shared_memory_is_freed_with_last_entry():
+    cache = MemoryBudgetCache(CacheKeySetID, ram_budget=MB)
+    shared = torch.zeros(MB, dtype=torch.uint8)
+    run_prompt(cache, ["1", "2"])
+    cache.set("1", [[shared]])
+    cache.set("2", [[shared[:MB // 2]]])
+    assert cache.ram_used == MB
+
+    run_prompt(cache, ["3"])
+    cache.set("3", [[torch.zeros(MB, dtype=torch.uint8)]])
+    # Neither entry frees anything by itself, both have to go.
+    assert ("1", "Test") not in cache.cache
+    assert ("2", "Test") not in cache.cache
+    assert ("3", "Test") in cache.cache
+    assert cache.ram_used == MB
+
+
+def test_forgets_keys_of_evicted_entries():
+    ui = LRUCache(CacheKeySetID, max_size=2 ** 62)
+    cache = MemoryBudgetCache(CacheKeySetID, ram_budget=2 * MB, linked_caches=[ui])
+    for i in range(20):
+        node_ids = [str(i), "never_cached_{}".format(i)]
+        run_prompt(cache, node_ids)
+        run_prompt(ui, node_ids)
+        cache.set(str(i), make_output(1))
+        ui.set(str(i), {"output": i})
+    cache.clean_unused()
+    assert len(cache.cache) == 2 and len(ui.cache) == 2
+    # The keys of the current prompt and of the cached entries
+    assert len(cache.used_generation) <= 3
+    assert len(ui.used_generation) <= 3
@@ -0,0 +1,19 @@
+import nodes
+from comfy_execution.parallel import NodeDispatcher, node_uses_device
+
+
+def test_only_declared_cpu_nodes_leave_the_device_thread():
+    # Nodes that only take and return images can still run on the torch device
+    assert node_uses_device(nodes.ImageScale)
+    assert node_uses_device(nodes.KSampler)
+    assert not node_uses_device(nodes.LoadImage)
+    assert not node_uses_device(nodes.LoadImageMask)
+
+    dispatcher = NodeDispatcher(2)
+    try:
+        assert dispatcher.pool_for(nodes.ImageScale) is dispatcher.device_pool
+        assert dispatcher.pool_for(nodes.LoadImage) is dispatcher.cpu_pool
+        assert dispatcher.pool_for(nodes.SaveImage) is dispatcher.output_pool
+        assert dispatcher.pool_for(nodes.PreviewImage) is dispatcher.output_pool
+    finally:
+        dispatcher.shutdown()
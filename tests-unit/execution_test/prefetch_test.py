@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+import torch
+
+import comfy.model_management
+import comfy.model_patcher
+import folder_paths
+from comfy_execution.prefetch import ModelPrefetcher, prompt_model_paths
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(folder_paths, "folder_names_and_paths", {"checkpoints": ([str(tmp_path)], {".safetensors"})})
+    monkeypatch.setattr(comfy.model_management, "model_files", {})
+    for name, size in [("a.safetensors", 3), ("b.safetensors", 5), ("c.safetensors", 1)]:
+        with open(tmp_path / name, "wb") as f:
+            f.write(b"\0" * size * MB)
+    return tmp_path
+
+
+def loader_prompt(*names):
+    return {str(i): {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": name}} for i, name in enumerate(names)}
+
+
+def test_reads_files_within_ram_budget(models_dir):
+    prompt = loader_prompt("a.safetensors", "b.safetensors", "c.safetensors", "missing.safetensors")
+    assert prompt_model_paths(prompt) == [str(models_dir / n) for n in ("a.safetensors", "b.safetensors", "c.safetensors")]
+
+    # Half of the free RAM is the budget: a and b fit, c doesn't anymore.
+    prefetcher = ModelPrefetcher(free_ram=lambda: 16 * MB, load_model=None)
+    prefetcher.run([prompt])
+    assert prefetcher.bytes_read == 8 * MB
+    assert list(prefetcher.warm.keys()) == [str(models_dir / "a.safetensors"), str(models_dir / "b.safetensors")]
+
+    # Files read recently aren't read again
+    prefetcher.run([loader_prompt("a.safetensors", "c.safetensors")])
+    assert prefetcher.bytes_read == 9 * MB
+
+
+class FakeModel:
+    def model_size(self):
+        return 4 * MB
+
+    def loaded_size(self):
+        return 1 * MB
+
+
+def test_loads_models_in_memory_after_running_prompt_loads(models_dir, monkeypatch):
+    model = FakeModel()
+    comfy.model_management.register_model_file(model, str(models_dir / "a.safetensors"))
+    monkeypatch.setattr(comfy.model_management, "models_load_count", 0)
+    loaded = []
+    def load_model(model, reserved):
+        loaded.append((model, reserved, comfy.model_management.models_load_count))
+    prefetcher = ModelPrefetcher(free_ram=lambda: 16 * MB, load_model=load_model)
+
+    # The running prompt still needs the file size of c and the part of a that isn't loaded
+    running = loader_prompt("a.safetensors", "c.safetensors")
+    thread = threading.Thread(target=prefetcher.run, args=([loader_prompt("a.safetensors", "b.safetensors")], None, 0, running))
+    thread.start()
+    comfy.model_management.load_models_gpu([])
+    thread.join()
+    # The file of a model in memory isn't read, and it waits for the running prompt to load its models.
+    assert loaded == [(model, 4 * MB, 1)]
+    assert prefetcher.bytes_read == 5 * MB
+
+
+def test_prefetch_model_gpu_respects_free_memory(monkeypatch):
+    # Pretend the cpu is a device with 64 KB free
+    KB = 1024
+    monkeypatch.setattr(comfy.model_management, "is_device_cpu", lambda device: False)
+    monkeypatch.setattr(comfy.model_management, "vram_state", comfy.model_management.VRAMState.NORMAL_VRAM)
+    monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda device=None, torch_free_too=False: 64 * KB)
+    monkeypatch.setattr(comfy.model_management, "minimum_inference_memory", lambda: 16 * KB)
+    monkeypatch.setattr(comfy.model_management, "extra_reserved_memory", lambda: 0)
+    monkeypatch.setattr(comfy.model_management, "current_loaded_models", [])
+
+    def patcher(kb):
+        model = torch.nn.Linear(kb * KB // 4, 1, bias=False)
+        return comfy.model_patcher.ModelPatcher(model, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+
+    big = patcher(64)
+    assert not comfy.model_management.prefetch_model_gpu(big)
+    small = patcher(32)
+    # The memory the running prompt still needs isn't used
+    assert not comfy.model_management.prefetch_model_gpu(small, memory_reserved=24 * KB)
+    assert comfy.model_management.prefetch_model_gpu(small)
+    assert comfy.model_management.models_prefetching == []
+    assert len(comfy.model_management.current_loaded_models) == 1
+    assert not comfy.model_management.current_loaded_models[0].currently_used
+    # A clone of a loaded model shares its weights
+    assert not comfy.model_management.prefetch_model_gpu(small.clone())
@@ -0,0 +1,107 @@
+import pytest
+from execution import PromptQueue, get_prompt_model_files
+
+
+class MockServer:
+    def queue_updated(self):
+        pass
+
+
+def make_item(number, ckpt_name):
+    prompt = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}},
+        "2": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "seed": number}},
+    }
+    return (number, "prompt_{}".format(number), prompt, {}, ["2"])
+
+
+def drain(queue, affinity=None):
+    order = []
+    while queue.get_tasks_remaining() - len(queue.currently_running) > 0:
+        item, item_id = queue.get(affinity=affinity)
+        queue.currently_running.pop(item_id)
+        order.append(item[0])
+    return order
+
+
+def test_prompt_model_files():
+    assert get_prompt_model_files(make_item(0, "a.safetensors")[2]) == frozenset([("ckpt_name", "a.safetensors")])
+    assert get_prompt_model_files({"1": {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo"}}}) == frozenset()
+
+
+def test_fifo_without_scheduler():
+    queue = PromptQueue(MockServer())
+    for n, ckpt in enumerate(["a.safetensors", "b.safetensors", "a.safetensors", "b.safetensors"]):
+        queue.put(make_item(n, ckpt))
+    assert drain(queue) == [0, 1, 2, 3]
+    assert queue.get_scheduler_stats() is None
+
+
+def test_model_affinity_groups_prompts():
+    queue = PromptQueue(MockServer(), model_affinity_window=4)
+    for n, ckpt in enumerate(["a.safetensors", "b.safetensors", "a.safetensors", "b.safetensors"]):
+        queue.put(make_item(n, ckpt))
+    assert drain(queue) == [0, 2, 1, 3]
+    stats = queue.get_scheduler_stats()
+    assert stats["model_swaps"] == 1
+    assert stats["model_swaps_avoided"] == 1
+
+
+@pytest.mark.parametrize("window", [1, 2, 3])
+def test_model_affinity_is_fair(window):
+    queue = PromptQueue(MockServer(), model_affinity_window=window + 1)
+    queue.put(make_item(0, "a.safetensors"))
+    queue.put(make_item(1, "b.safetensors"))
+    for n in range(2, 20):
+        queue.put(make_item(n, "a.safetensors"))
+    order = drain(queue)
+    # The prompt using the other model can only be passed over `window + 1` times
+    assert order.index(1) <= window + 2
+
+
+def test_model_affinity_forgets_prompts_that_leave_the_queue():
+    queue = PromptQueue(MockServer(), model_affinity_window=4)
+    for n, ckpt in enumerate(["a.safetensors", "b.safetensors", "c.safetensors", "a.safetensors", "a.safetensors"]):
+        queue.put(make_item(n, ckpt))
+    item, item_id = queue.get()
+    queue.currently_running.pop(item_id)
+    item, item_id = queue.get()
+    queue.currently_running.pop(item_id)
+    assert set(queue.scheduler.skipped) == {"prompt_1", "prompt_2"}
+
+    queue.delete_queue_item(lambda x: x[1] == "prompt_1")
+    assert set(queue.scheduler.skipped) == {"prompt_2"}
+    queue.wipe_queue()
+    assert queue.scheduler.skipped == {}
+
+
+def test_worker_affinity():
+    queue = PromptQueue(MockServer())
+    for n, ckpt in enumerate(["a.safetensors", "b.safetensors", "a.safetensors", "b.safetensors"]):
+        queue.put(make_item(n, ckpt))
+    worker_models = get_prompt_model_files(make_item(0, "b.safetensors")[2])
+    assert drain(queue, lambda item: len(get_prompt_model_files(item[2]) & worker_models)) == [1, 3, 0, 2]
+
+
+@pytest.mark.parametrize("model_affinity_window", [0, 4])
+def test_prompts_queued_at_the_front_run_first(model_affinity_window):
+    queue = PromptQueue(MockServer(), model_affinity_window=model_affinity_window)
+    for n, ckpt in enumerate(["a.safetensors", "a.safetensors", "b.safetensors"]):
+        queue.put(make_item(n, ckpt))
+    # Queued at the front, with the model of the prompt that ran before them first
+    queue.put(make_item(-2, "b.safetensors"))
+    queue.put(make_item(-1, "a.safetensors"))
+    worker_models = get_prompt_model_files(make_item(0, "a.safetensors")[2])
+    order = drain(queue, lambda item: len(get_prompt_model_files(item[2]) & worker_models))
+    assert order[:2] == [-1, -2]
+    assert order[2:] == [0, 1, 2]
+
+
+def test_flags_reach_every_worker():
+    queue = PromptQueue(MockServer())
+    queue.register_worker(0)
+    queue.register_worker(1)
+    queue.set_flag("free_memory", True)
+    assert queue.get_flags(worker_id=0) == {"free_memory": True}
+    assert queue.get_flags(worker_id=0) == {}
+    assert queue.get_flags(worker_id=1) == {"free_memory": True}
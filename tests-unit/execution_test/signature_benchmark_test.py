@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+
+import torch
+
+import comfy_execution.caching
+import folder_paths
+from comfy.utils import tensor_digest
+from comfy_execution.caching import CacheKeySetInputSignature, SignatureDigestCache, Unhashable, to_hashable
+from comfy_execution.graph import DynamicPrompt
+
+
+class FakeIsChangedCache:
+    def __init__(self, values=None):
+        self.values = values or {}
+
+    async def get(self, node_id):
+        return self.values.get(node_id, False)
+
+
+def upscale_node(source, scale=1.5):
+    return {"class_type": "LatentUpscaleBy", "inputs": {"samples": [source, 0], "upscale_method": "nearest-exact", "scale_by": scale}}
+
+
+def make_prompt(chains, length, prefix=""):
+    prompt = {prefix + "root": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}}}
+    for c in range(chains):
+        source = prefix + "root"
+        for i in range(length):
+            node_id = "{}{}_{}".format(prefix, c, i)
+            prompt[node_id] = upscale_node(source, 1.0 + c / 100)
+            source = node_id
+    return prompt
+
+
+def signatures(prompt, is_changed=None):
+    keys = CacheKeySetInputSignature(DynamicPrompt(prompt), list(prompt.keys()), FakeIsChangedCache(is_changed))
+    asyncio.run(keys.add_keys(list(prompt.keys())))
+    return keys.keys
+
+
+def test_same_subgraph_same_key():
+    a = signatures(make_prompt(2, 3))
+    b = signatures(make_prompt(2, 3, prefix="other_"))
+    assert a["1_2"] == b["other_1_2"]
+    assert a["0_2"] != a["1_2"]
+
+
+def test_change_only_invalidates_downstream():
+    prompt = make_prompt(2, 4)
+    before = signatures(prompt)
+    prompt["0_1"]["inputs"]["upscale_method"] = "bilinear"
+    after = signatures(prompt)
+    assert before["0_0"] == after["0_0"]
+    assert before["0_1"] != after["0_1"]
+    assert before["0_3"] != after["0_3"]
+    assert all(before["1_{}".format(i)] == after["1_{}".format(i)] for i in range(4))
+
+
+def test_digests_are_reused_across_prompts(monkeypatch):
+    monkeypatch.setattr(comfy_execution.caching, "signature_digests", SignatureDigestCache(max_size=12))
+    digests = comfy_execution.caching.signature_digests
+    prompt = make_prompt(2, 3)
+    before = signatures(prompt)
+    assert (digests.hits, digests.misses) == (0, 7)
+
+    # Only the changed node and the ones downstream of it are hashed again
+    prompt["0_1"]["inputs"]["upscale_method"] = "bilinear"
+    after = signatures(prompt)
+    assert (digests.hits, digests.misses) == (5, 9)
+    assert before["0_0"] == after["0_0"] and before["0_2"] != after["0_2"]
+
+    # Values that compare equal but don't have the same digest aren't mixed up
+    prompt["0_0"]["inputs"]["scale_by"] = 2
+    one = signatures(prompt)["0_0"]
+    prompt["0_0"]["inputs"]["scale_by"] = 2.0
+    assert signatures(prompt)["0_0"] != one
+    assert len(digests.digests) == 12
+
+
+def test_uncomparable_is_changed_propagates():
+    keys = signatures(make_prompt(1, 3), is_changed={"0_1": float("NaN")})
+    assert isinstance(keys["0_0"], bytes)
+    assert isinstance(keys["0_1"], Unhashable)
+    assert isinstance(keys["0_2"], Unhashable)
+
+
+def test_signature_benchmark():
+    # 20 branches of 50 nodes, with deep ancestries this used to be quadratic in the number of nodes.
+    prompt = make_prompt(20, 50)
+    signatures(prompt)
+    start = time.perf_counter()
+    for _ in range(3):
+        keys = signatures(prompt)
+    elapsed = (time.perf_counter() - start) / 3
+    logging.info("Signatures for {} nodes: {:.1f} ms".format(len(keys), elapsed * 1000))
+    assert len(keys) == len(prompt)
+    assert elapsed < 2.0
+
+    # A single chain deeper than the recursion limit
+    prompt = make_prompt(1, 2000)
+    assert len(signatures(prompt)) == 2001
+
+
+class Seed:
+    def __init__(self, value):
+        self.value = value
+
+    def __comfy_hash__(self):
+        return ["Seed", self.value]
+
+
+def test_tensor_and_custom_constants():
+    prompt = make_prompt(1, 1)
+    prompt["0_0"]["inputs"]["scale_by"] = torch.ones(2, 3)
+    prompt["root"]["inputs"]["batch_size"] = Seed(1)
+    a = signatures(prompt)
+    prompt["0_0"]["inputs"]["scale_by"] = torch.ones(2, 3)
+    prompt["root"]["inputs"]["batch_size"] = Seed(1)
+    b = signatures(prompt)
+    assert isinstance(a["0_0"], bytes)
+    assert a == b
+
+    prompt["0_0"]["inputs"]["scale_by"] = torch.ones(3, 2)
+    assert signatures(prompt)["0_0"] != a["0_0"]
+    prompt["root"]["inputs"]["batch_size"] = Seed(2)
+    assert signatures(prompt)["root"] != a["root"]
+
+    prompt["root"]["inputs"]["batch_size"] = object()
+    assert isinstance(signatures(prompt)["0_0"], Unhashable)
+
+
+def test_tensor_digest_tracks_inplace_changes():
+    t = torch.zeros(3 << 20)
+    digest = tensor_digest(t)
+    assert tensor_digest(t.clone()) == digest
+    t[-1] = 1
+    assert tensor_digest(t) != digest
+    assert to_hashable([t]) == to_hashable([t.clone()])
+
+
+def test_images_differing_in_one_channel_have_different_keys():
+    a = torch.zeros(1, 1024, 1024, 3)
+    b = a.clone()
+    b[..., 1] = 1.0
+    assert tensor_digest(a) != tensor_digest(b)
+    assert to_hashable([a]) != to_hashable([b])
+    assert comfy_execution.caching.stable_digest([a]) != comfy_execution.caching.stable_digest([b])
+
+
+def test_tensor_digest_of_inference_tensors():
+    with torch.inference_mode():
+        t = torch.zeros(8)
+        digest = tensor_digest(t)
+        t[0] = 1
+    assert tensor_digest(t) != digest
+
+
+def test_replacing_a_model_file_changes_the_key(tmp_path, monkeypatch):
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "checkpoints", ([str(tmp_path)], folder_paths.supported_pt_extensions))
+    model = tmp_path / "replaced_model.safetensors"
+    model.write_bytes(b"old")
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "replaced_model.safetensors"}}}
+    before = signatures(prompt)["1"]
+    assert signatures(prompt)["1"] == before
+
+    model.write_bytes(b"new model")
+    assert signatures(prompt)["1"] != before
@@ -0,0 +1,30 @@
+import hashlib
+import os
+
+import folder_paths
+
+
+def test_fingerprint_matches_sha256(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"\x89PNG" + os.urandom(3 * 1024 * 1024))
+    assert folder_paths.get_file_fingerprint(str(path)) == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_fingerprint_only_rehashes_on_stat_change(tmp_path, monkeypatch):
+    path = tmp_path / "latent.latent"
+    path.write_bytes(b"a" * 1024)
+    first = folder_paths.get_file_fingerprint(str(path))
+
+    opened = []
+    real_open = open
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        return real_open(*args, **kwargs)
+    monkeypatch.setattr("builtins.open", counting_open)
+
+    assert folder_paths.get_file_fingerprint(str(path)) == first
+    assert opened == []
+
+    path.write_bytes(b"b" * 2048)
+    assert folder_paths.get_file_fingerprint(str(path)) != first
+    assert len(opened) == 1
@@ -8,6 +8,7 @@ import torch
 from typing import Union, Dict
 import json
 import subprocess
+import tempfile
 import websocket #NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
 import uuid
 import urllib.request
@@ -117,10 +118,12 @@ class TestExecution:
     # Initialize server and client
     #
     @fixture(scope="class", autouse=True, params=[
-        # (use_lru, lru_size)
-        (False, 0),
-        (True, 0),
-        (True, 100),
+        # (use_lru, lru_size, parallel_workers, disk_cache)
+        (False, 0, 0, False),
+        (True, 0, 0, False),
+        (True, 100, 0, False),
+        (False, 0, 4, False),
+        (False, 0, 0, True),
     ])
     def _server(self, args_pytest, request):
         # Start server
@@ -131,9 +134,13 @@ class TestExecution:
             '--port', str(args_pytest["port"]),
             '--extra-model-paths-config', 'tests/inference/extra_model_paths.yaml',
         ]
-        use_lru, lru_size = request.param
+        use_lru, lru_size, parallel_workers, disk_cache = request.param
         if use_lru:
             pargs += ['--cache-lru', str(lru_size)]
+        if parallel_workers > 0:
+            pargs += ['--parallel-execution', str(parallel_workers)]
+        if disk_cache:
+            pargs += ['--disk-cache-size', '1', '--disk-cache-directory', tempfile.mkdtemp()]
         print("Running server with args:", pargs)  # noqa: T201
         p = subprocess.Popen(pargs)
         yield